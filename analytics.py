@@ -1,11 +1,15 @@
+import json
+import math
 import os
 import random
-import statistics
+import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 from pybloom import BloomFilter
 
 from cleaner import *
+from profiling import timed
 from utils import *
 
 
@@ -24,6 +28,7 @@ def build_ngram_from_tokens(tokens, n):
     return count
 
 
+@timed('build_ngram')
 def build_ngram(file,
                 outfile=None,
                 bf=None,
@@ -166,6 +171,7 @@ def estimate_overlap(source_files,
     return results
 
 
+@timed('estimate_overlap_bf')
 def estimate_overlap_bf(bf, target_file, gran='word', n=8, header=0):
     """ Estimate overlapping of target_file with an existing bloomfilter
     gran: granularity of the token. It can be 'word' or 'char'
@@ -201,32 +207,399 @@ def estimate_overlap_bf(bf, target_file, gran='word', n=8, header=0):
     return result
 
 
+class RunningStats:
+    """ Streaming mean/variance/min/max with Welford's algorithm.
+    Two RunningStats can be merged, so workers can profile separately.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def stdev(self):
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+
+class QuantileSketch:
+    """ Approximate quantiles of non-negative values with log-spaced buckets.
+    Every quantile is within relative_accuracy of the true value. Memory
+    grows with log(max / min) rather than with the number of values, and
+    sketches can be merged.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, x):
+        self.count += 1
+        if x <= 0:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(x) / self.log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.zeros += other.zeros
+        for key, value in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + value
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = max(0, math.ceil(q * self.count) - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+def estimate_llm_tokens(num_chars):
+    """ Rough number of LLM tokens for num_chars of English text
+    """
+    return math.ceil(num_chars / 4)
+
+
 def file_stats(file):
     """ Return statistics about line lengths and average character per words
     """
-    line_lengths, token_lengths = [], []
+    line_lengths = RunningStats()
+    line_quantiles = QuantileSketch()
+    total_tokens, total_chars = 0, 0
     with open(file, 'r') as f:
-        line = f.readline()
-        while line:
+        for line in f:
             tokens = line.split()
-            line_lengths.append(len(tokens))
-            line_token_lengths = [len(token) for token in tokens]
-            token_lengths.append([len(tokens),
-                                  sum(line_token_lengths) / len(tokens)])
-            line = f.readline()
-
-    total_tokens = sum([pair[0] for pair in token_lengths])
-    total_chars = sum([pair[0] * pair[1] for pair in token_lengths])
-    average_chars = total_chars / total_tokens
+            line_lengths.add(len(tokens))
+            line_quantiles.add(len(tokens))
+            total_tokens += len(tokens)
+            total_chars += sum(len(token) for token in tokens)
+
+    if line_lengths.count == 0:
+        raise ValueError(f'{file} is empty')
+    average_chars = total_chars / total_tokens if total_tokens else 0.0
     print(f'Character per word: average = {average_chars}.')
     print(f'Word count per line:'
-          f'\n\taverage = {statistics.mean(line_lengths)},'
-          f'\n\tmedian = {statistics.median(line_lengths)},'
-          f'\n\tmax = {max(line_lengths)},'
-          f'\n\tmin = {min(line_lengths)},'
-          f'\n\tstddev = {statistics.stdev(line_lengths)}.')
-    return statistics.mean(line_lengths), average_chars
+          f'\n\taverage = {line_lengths.mean},'
+          f'\n\tmedian = {line_quantiles.quantile(0.5)},'
+          f'\n\tmax = {line_lengths.max},'
+          f'\n\tmin = {line_lengths.min},'
+          f'\n\tstddev = {line_lengths.stdev}.')
+    return line_lengths.mean, average_chars
+
+
+def _site_page_files(site_folder, clean_only=True):
+    """ Page files of a scraped site. If clean_only and the site has a
+    clean_files.list, only the pages that survived filter_files are used.
+    """
+    clean_list = os.path.join(site_folder, 'clean_files.list')
+    if clean_only and os.path.exists(clean_list):
+        with open(clean_list, 'r') as f:
+            names = [os.path.basename(line.strip()) for line in f
+                     if line.strip()]
+    else:
+        names = os.listdir(site_folder)
+    return [os.path.join(site_folder, name) for name in names
+            if name.endswith('.txt') and name.split('_')[0].isdigit()]
+
+
+def _empty_profile():
+    return {
+        'pages': 0,
+        'tokens': 0,
+        'chars': 0,
+        'lines': 0,
+        'dup_lines': 0,
+        'page_tokens': RunningStats(),
+        'page_tokens_q': QuantileSketch(),
+        'page_llm_tokens_q': QuantileSketch(),
+    }
+
+
+def profile_site(site_folder, clean_only=True, header=1):
+    """ Single pass over the pages of one scraped site.
+    Return a dict of RunningStats/QuantileSketch and counters that can be
+    merged with merge_profiles.
+
+    header: number of lines of each page to skip (the url).
+    """
+    profile = _empty_profile()
+    seen = set()
+    for file in _site_page_files(site_folder, clean_only):
+        page_tokens, page_chars = 0, 0
+        try:
+            with open(file, 'r') as f:
+                for _ in range(header):
+                    f.readline()
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    hashed = get_hash(line)
+                    if hashed in seen:
+                        profile['dup_lines'] += 1
+                    else:
+                        seen.add(hashed)
+                    profile['lines'] += 1
+                    page_tokens += len(line.split())
+                    page_chars += len(line) + 1
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Can't read {file}: {e}")
+            continue
+        profile['pages'] += 1
+        profile['tokens'] += page_tokens
+        profile['chars'] += page_chars
+        profile['page_tokens'].add(page_tokens)
+        profile['page_tokens_q'].add(page_tokens)
+        profile['page_llm_tokens_q'].add(estimate_llm_tokens(page_chars))
+    return profile
+
+
+def merge_profiles(profiles):
+    """ Merge the output of several profile_site calls
+    """
+    total = _empty_profile()
+    for profile in profiles:
+        for key in ['pages', 'tokens', 'chars', 'lines', 'dup_lines']:
+            total[key] += profile[key]
+        for key in ['page_tokens', 'page_tokens_q', 'page_llm_tokens_q']:
+            total[key].merge(profile[key])
+    return total
+
+
+def summarize_profile(profile):
+    """ Turn a profile into plain numbers
+    """
+    lines = profile['lines']
+    return {
+        'pages': profile['pages'],
+        'tokens': profile['tokens'],
+        'chars': profile['chars'],
+        'llm_tokens': estimate_llm_tokens(profile['chars']),
+        'dup_ratio': profile['dup_lines'] / lines if lines else 0.0,
+        'page_tokens_mean': profile['page_tokens'].mean,
+        'page_tokens_stdev': profile['page_tokens'].stdev,
+        'page_tokens_p50': profile['page_tokens_q'].quantile(0.5),
+        'page_tokens_p90': profile['page_tokens_q'].quantile(0.9),
+        'page_tokens_p99': profile['page_tokens_q'].quantile(0.99),
+        'page_llm_tokens_p99': profile['page_llm_tokens_q'].quantile(0.99),
+    }
+
+
+def profile_corpus(root='scraped', clean_only=True, max_workers=None,
+                   outfile=None):
+    """ Profile every site folder under root in parallel.
+    Return (per_site, global) summaries. Duplicate ratios count lines
+    repeated within a site, since each site is sent to the LLM separately.
+
+    outfile: if specified, write the report as JSON.
+    """
+    sites = sorted(name for name in os.listdir(root)
+                   if os.path.isdir(os.path.join(root, name)))
+    folders = [os.path.join(root, site) for site in sites]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        profiles = list(executor.map(profile_site,
+                                     folders,
+                                     [clean_only] * len(folders),
+                                     chunksize=8))
+
+    per_site = {site: summarize_profile(profile)
+                for site, profile in zip(sites, profiles)}
+    corpus = summarize_profile(merge_profiles(profiles))
+    corpus['sites'] = len(sites)
+    print(f'{corpus["sites"]} sites, {corpus["pages"]} pages, '
+          f'{corpus["tokens"]} tokens, {corpus["chars"]} characters, '
+          f'~{corpus["llm_tokens"]} LLM tokens, '
+          f'duplicate ratio {corpus["dup_ratio"]:.3f}')
+
+    if outfile:
+        with open(outfile, 'w') as out:
+            json.dump({'global': corpus, 'sites': per_site}, out, indent=4)
+    return per_site, corpus
+
+
+class CountMinSketch:
+    """ Count-min sketch for approximate counts of a stream of keys.
+    Memory is fixed at width * depth counters no matter how many distinct
+    keys are added. Estimates never undercount.
+    """
+
+    def __init__(self, width=2 ** 16, depth=4):
+        self.width = width
+        self.depth = depth
+        self.tables = [[0] * width for _ in range(depth)]
+
+    def _indexes(self, key):
+        h = hash(key)
+        h1 = h & 0xffffffff
+        h2 = ((h >> 32) & 0xffffffff) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        """ Add count to key and return the new estimated count of key
+        """
+        estimate = None
+        for table, idx in zip(self.tables, self._indexes(key)):
+            table[idx] += count
+            if estimate is None or table[idx] < estimate:
+                estimate = table[idx]
+        return estimate
+
+    def estimate(self, key):
+        return min(table[idx]
+                   for table, idx in zip(self.tables, self._indexes(key)))
+
+
+def _entropy_tokens(line, gran='word', uncase=True, alphanumeric=True):
+    """ Tokenize a line the same way build_ngram does.
+    For gran='char', the tokens are the characters of the cleaned line.
+    """
+    if uncase:
+        line = line.lower()
+    if gran == 'word':
+        if alphanumeric:
+            line = remove_non_alphanumeric(line)
+        return collapse_white_spaces(line).split()
+    return list(collapse_white_spaces(remove_non_alpha(line)).strip())
+
+
+def estimate_entropy_lines(lines,
+                           gran='word',
+                           max_n=10,
+                           uncase=True,
+                           alphanumeric=True,
+                           width=2 ** 16,
+                           depth=4,
+                           normalized=False):
+    """ Streaming estimate of the Shannon entropy (in bits) of the
+    n-gram distribution for n = 1..max_n over an iterable of lines.
+
+    Each order keeps a count-min sketch so memory stays bounded. With
+    N n-grams seen and counts c_i, H = log2(N) - sum(c_i * log2(c_i)) / N,
+    where the sum is updated incrementally from the sketch estimates.
+
+    normalized: return H / log2(N) instead, between 0 (one n-gram
+    repeated) and 1 (every n-gram distinct), so that it doesn't grow with
+    the length of the text. Orders with fewer than 2 n-grams are 1.0.
+
+    Return a dict {n: entropy}. Orders with no n-gram have entropy 0.0.
+    """
+    if gran not in set(['word', 'char']):
+        raise ValueError("gran has to be 'word' or 'char'")
+    sketches = [CountMinSketch(width, depth) for _ in range(max_n)]
+    totals = [0] * max_n
+    sums = [0.0] * max_n
+    window = []
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        for token in _entropy_tokens(line, gran, uncase, alphanumeric):
+            window.append(token)
+            if len(window) > max_n:
+                window.pop(0)
+            for n in range(1, len(window) + 1):
+                key = ' '.join(window[-n:])
+                c = sketches[n - 1].add(key)
+                sums[n - 1] += c * math.log2(c)
+                if c > 1:
+                    sums[n - 1] -= (c - 1) * math.log2(c - 1)
+                totals[n - 1] += 1
+
+    entropies = {}
+    for n in range(1, max_n + 1):
+        total = totals[n - 1]
+        if normalized and total < 2:
+            entropies[n] = 1.0
+        elif total == 0:
+            entropies[n] = 0.0
+        else:
+            entropies[n] = max(0.0, math.log2(total) - sums[n - 1] / total)
+            if normalized:
+                entropies[n] = min(1.0, entropies[n] / math.log2(total))
+    return entropies
+
+
+def estimate_entropy(file,
+                     gran='word',
+                     max_n=10,
+                     header=0,
+                     uncase=True,
+                     alphanumeric=True,
+                     width=2 ** 16,
+                     depth=4,
+                     normalized=False):
+    """ Estimate the n-gram entropy of file for n = 1..max_n
+    See estimate_entropy_lines.
+
+    header: number of lines of each file to skip. It's because in our format,
+            the first line is the url
+    """
+    with open(file, 'r') as f:
+        for _ in range(header):
+            f.readline()
+        return estimate_entropy_lines(f,
+                                      gran=gran,
+                                      max_n=max_n,
+                                      uncase=uncase,
+                                      alphanumeric=alphanumeric,
+                                      width=width,
+                                      depth=depth,
+                                      normalized=normalized)
+
+
+def is_low_entropy(file, threshold, gran='word', n=3, header=0):
+    """ Return True if the normalized n-gram entropy of file (between 0
+    and 1, see estimate_entropy_lines) is below threshold. Pages made of
+    repeated navigation, tag clouds or placeholder text have few distinct
+    n-grams and score low; short pages like a contact or pricing page are
+    not penalized for their length.
+    """
+    entropy = estimate_entropy(file, gran=gran, max_n=n, header=header, normalized=True)[n]
+    return entropy < threshold
 
 
-def estimate_entropy(file, gran='word', max_n=10):
-    pass
+if __name__ == "__main__":
+    profile_corpus(sys.argv[1] if len(sys.argv) > 1 else 'scraped',
+                   outfile='corpus_profile.json')
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from openai.types.chat import ChatCompletion
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+logger = logging.getLogger('batch')
+
+ENDPOINT = '/v1/chat/completions'
+
+# Provider limit on the requests of one batch. Bigger stages are split.
+MAX_REQUESTS = 50000
+
+# Terminal batch statuses. Anything else is still running.
+FINISHED = {'completed', 'failed', 'expired', 'cancelled'}
+
+# Batches that stopped early but have the requests they finished in their
+# output file
+PARTIAL = {'expired', 'cancelled'}
+
+
+def custom_id(stage, key):
+    """ Stable id of a request: the stage and a hash of its key, so the
+    same site chunk or lead gets the same id on every run
+    """
+    digest = hashlib.md5(json.dumps(key, default=str).encode()).hexdigest()[:20]
+    return f'{stage}-{digest}'
+
+
+def write_requests(path, stage, requests):
+    """ Write {key: chat completion kwargs} as a batch input file.
+    Return {custom_id: key}.
+    """
+    ids = {}
+    with open(path, 'w') as out:
+        for key, body in requests.items():
+            request_id = custom_id(stage, key)
+            ids[request_id] = key
+            out.write(json.dumps({'custom_id': request_id, 'method': 'POST',
+                                  'url': ENDPOINT, 'body': body},
+                                 ensure_ascii=False) + '\n')
+    return ids
+
+
+def read_results(text):
+    """ Parse a batch output file. Return ({custom_id: ChatCompletion},
+    {custom_id: error message}).
+    """
+    results, errors = {}, {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get('response') or {}
+        if item.get('error') or response.get('status_code') != 200:
+            errors[item['custom_id']] = item.get('error') or response.get('body')
+            continue
+        results[item['custom_id']] = ChatCompletion.model_validate(response['body'])
+    return results, errors
+
+
+class BatchRunner:
+    """ Runs a stage's chat completions through the Batch API.
+
+    Each stage part gets out_dir/<stage>_<part>_requests.jsonl and a state
+    file holding the batch id and a hash of the input. Running the same
+    input again picks up the batch already submitted (or its saved
+    results) instead of paying for it twice, so an interrupted overnight
+    run can simply be restarted.
+
+    complete_all has the same interface as llm.LLMExecutor.complete_all.
+    Requests that failed in the batch, or were not reached before it
+    expired or was cancelled, are logged and left out of the results.
+    With a cache (llmcache.ResponseCache), cached requests are not sent
+    and batch results are added to it. on_result(key, response) is
+    called for each result once its batch part is done.
+    """
+
+    def __init__(self, client, out_dir=f'{dir_path}/batches', poll_interval=60,
+                 max_requests=MAX_REQUESTS, cache=None):
+        self.client = client
+        self.cache = cache
+        self.out_dir = out_dir
+        self.poll_interval = poll_interval
+        self.max_requests = max_requests
+        os.makedirs(out_dir, exist_ok=True)
+
+    def complete_all(self, stage, requests, on_result=None):
+        """ {key: chat completion kwargs} -> {key: ChatCompletion}
+        """
+        results = {}
+        if self.cache is not None:
+            for key, kwargs in requests.items():
+                cached = self.cache.get(kwargs)
+                if cached is not None:
+                    results[key] = cached
+                    if on_result is not None:
+                        on_result(key, cached)
+        keys = [key for key in requests if key not in results]
+        for part, start in enumerate(range(0, len(keys), self.max_requests)):
+            chunk = {key: requests[key] for key in keys[start:start + self.max_requests]}
+            for key, response in self._run_part(stage, part, chunk).items():
+                results[key] = response
+                if self.cache is not None:
+                    self.cache.put(requests[key], response)
+                if on_result is not None:
+                    on_result(key, response)
+        return {key: results[key] for key in requests if key in results}
+
+    def _run_part(self, stage, part, requests):
+        prefix = os.path.join(self.out_dir, f'{stage}_{part}')
+        ids = write_requests(f'{prefix}_requests.jsonl', stage, requests)
+        with open(f'{prefix}_requests.jsonl', 'rb') as f:
+            input_hash = hashlib.sha1(f.read()).hexdigest()
+
+        state = {}
+        if os.path.exists(f'{prefix}_state.json'):
+            with open(f'{prefix}_state.json', 'r') as f:
+                state = json.load(f)
+            if state.get('input_hash') != input_hash:
+                state = {}
+
+        if state.get('status') == 'completed' and os.path.exists(f'{prefix}_results.jsonl'):
+            logger.info('Using saved results of batch %s for %s', state['batch_id'], stage)
+            with open(f'{prefix}_results.jsonl', 'r') as f:
+                results, errors = read_results(f.read())
+        else:
+            # A batch that failed, expired or was cancelled is submitted again.
+            # With a cache, the requests it did finish are served from it.
+            if state.get('status') in FINISHED - {'completed'}:
+                state = {}
+            if not state.get('batch_id'):
+                with open(f'{prefix}_requests.jsonl', 'rb') as f:
+                    input_file = self.client.files.create(file=f, purpose='batch')
+                batch = self.client.batches.create(
+                    input_file_id=input_file.id, endpoint=ENDPOINT,
+                    completion_window='24h', metadata={'stage': stage, 'part': str(part)})
+                state = {'batch_id': batch.id, 'input_hash': input_hash, 'status': batch.status}
+                self._save_state(prefix, state)
+                logger.info('Submitted batch %s: %d %s requests', batch.id, len(requests), stage)
+            batch = self._wait(state['batch_id'])
+            state['status'] = batch.status
+            self._save_state(prefix, state)
+            if batch.status not in PARTIAL | {'completed'}:
+                raise ValueError(f'Batch {batch.id} for {stage} ended as {batch.status}: {batch.errors}')
+            if batch.status in PARTIAL:
+                counts = batch.request_counts
+                logger.warning('Batch %s for %s ended as %s, keeping its %s finished requests',
+                               batch.id, stage, batch.status,
+                               f'{counts.completed}/{counts.total}' if counts else 'partial')
+            text = self.client.files.content(batch.output_file_id).text if batch.output_file_id else ''
+            with open(f'{prefix}_results.jsonl', 'w') as out:
+                out.write(text)
+            results, errors = read_results(text)
+            if batch.error_file_id:
+                errors.update(read_results(self.client.files.content(batch.error_file_id).text)[1])
+
+        for request_id, error in errors.items():
+            logger.error('Batch request %s (%s) failed: %s', request_id, ids.get(request_id), error)
+        missing = len(ids) - len(results) - len(errors)
+        if missing > 0:
+            logger.error('%d %s requests got no answer, run the stage again for them', missing, stage)
+        return {ids[request_id]: response for request_id, response in results.items()
+                if request_id in ids}
+
+    def _wait(self, batch_id):
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in FINISHED:
+                return batch
+            counts = batch.request_counts
+            logger.info('Batch %s %s: %s', batch_id, batch.status,
+                        f'{counts.completed}/{counts.total}' if counts else '')
+            time.sleep(self.poll_interval)
+
+    def _save_state(self, prefix, state):
+        with open(f'{prefix}_state.json', 'w') as out:
+            json.dump(state, out)
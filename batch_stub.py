@@ -0,0 +1,192 @@
+import argparse
+import email.parser
+import email.policy
+import http.server
+import json
+import threading
+import time
+import uuid
+
+
+def default_responder(body):
+    """ Content of the stub's answer to a chat completion request: an empty
+    JSON object when JSON was asked for, a fixed line otherwise
+    """
+    if (body.get('response_format') or {}).get('type') == 'json_object':
+        return '{}'
+    return 'Categorization: Low Fit (stub response)'
+
+
+def completion(body, content):
+    """ A chat.completion body as the Batch API returns it
+    """
+    prompt_tokens = sum(len(str(m.get('content') or '')) for m in body.get('messages', [])) // 4
+    completion_tokens = len(content) // 4 + 1
+    return {
+        'id': f'chatcmpl-{uuid.uuid4().hex[:24]}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'stub'),
+        'choices': [{'index': 0, 'finish_reason': 'stop',
+                     'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens},
+    }
+
+
+class BatchStub:
+    """ In-memory imitation of the Files and Batches endpoints used by
+    batch.BatchRunner. A batch is 'validating', then 'in_progress' for
+    delay seconds, then 'completed' with one output line per request.
+    responder(body) returns the completion content of a request, or raises
+    to make that request fail (it then goes to the error file).
+    With expire_after, a batch ends 'expired' once that many requests are
+    answered, and the output file only has those.
+    """
+
+    def __init__(self, responder=default_responder, delay=1.0, expire_after=None):
+        self.responder = responder
+        self.delay = delay
+        self.expire_after = expire_after
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.RLock()
+
+    def add_file(self, content, filename, purpose):
+        file_id = f'file-{uuid.uuid4().hex[:24]}'
+        with self.lock:
+            self.files[file_id] = {'id': file_id, 'object': 'file', 'bytes': len(content),
+                                   'created_at': int(time.time()), 'filename': filename,
+                                   'purpose': purpose, 'status': 'processed',
+                                   'content': content}
+        return self.file_object(file_id)
+
+    def file_object(self, file_id):
+        return {key: value for key, value in self.files[file_id].items() if key != 'content'}
+
+    def create_batch(self, params):
+        batch_id = f'batch_{uuid.uuid4().hex[:24]}'
+        lines = self.files[params['input_file_id']]['content'].decode().splitlines()
+        batch = {'id': batch_id, 'object': 'batch', 'endpoint': params['endpoint'],
+                 'input_file_id': params['input_file_id'],
+                 'completion_window': params['completion_window'],
+                 'status': 'validating', 'created_at': int(time.time()),
+                 'metadata': params.get('metadata'), 'output_file_id': None,
+                 'error_file_id': None,
+                 'request_counts': {'total': len(lines), 'completed': 0, 'failed': 0}}
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self._process, args=(batch_id, lines), daemon=True).start()
+        return batch
+
+    def _process(self, batch_id, lines):
+        batch = self.batches[batch_id]
+        batch['status'] = 'in_progress'
+        time.sleep(self.delay)
+        outputs, errors = [], []
+        expired = self.expire_after is not None and len(lines) > self.expire_after
+        for line in lines[:self.expire_after] if expired else lines:
+            request = json.loads(line)
+            try:
+                content = self.responder(request['body'])
+            except Exception as e:
+                errors.append({'id': f'batch_req_{uuid.uuid4().hex[:16]}',
+                               'custom_id': request['custom_id'], 'response': None,
+                               'error': {'code': 'stub_error', 'message': str(e)}})
+                continue
+            outputs.append({'id': f'batch_req_{uuid.uuid4().hex[:16]}',
+                            'custom_id': request['custom_id'],
+                            'response': {'status_code': 200, 'request_id': uuid.uuid4().hex,
+                                         'body': completion(request['body'], content)},
+                            'error': None})
+        to_file = lambda items: '\n'.join(json.dumps(item) for item in items).encode()
+        with self.lock:
+            if outputs:
+                batch['output_file_id'] = self.add_file(to_file(outputs), 'output.jsonl', 'batch_output')['id']
+            if errors:
+                batch['error_file_id'] = self.add_file(to_file(errors), 'errors.jsonl', 'batch_output')['id']
+            batch['request_counts'] = {'total': len(lines), 'completed': len(outputs),
+                                       'failed': len(errors)}
+            if expired:
+                batch['expired_at'] = int(time.time())
+                batch['status'] = 'expired'
+            else:
+                batch['completed_at'] = int(time.time())
+                batch['status'] = 'completed'
+
+
+class BatchStubHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.endswith('/files'):
+            # Multipart form with 'purpose' and 'file' parts
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode() + body)
+            parts = {part.get_param('name', header='content-disposition'): part
+                     for part in message.iter_parts()}
+            file_part = parts['file']
+            return self.reply(stub.add_file(file_part.get_payload(decode=True),
+                                            file_part.get_filename(),
+                                            parts['purpose'].get_content().strip()))
+        if self.path.endswith('/batches'):
+            return self.reply(stub.create_batch(json.loads(body)))
+        self.reply({'error': {'message': f'Unknown path {self.path}'}}, 404)
+
+    def do_GET(self):
+        stub = self.server.stub
+        parts = self.path.rstrip('/').split('/')
+        if len(parts) >= 2 and parts[-2] == 'batches' and parts[-1] in stub.batches:
+            return self.reply(stub.batches[parts[-1]])
+        if parts[-1] == 'content' and parts[-2] in stub.files:
+            content = stub.files[parts[-2]]['content']
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        if parts[-2] == 'files' and parts[-1] in stub.files:
+            return self.reply(stub.file_object(parts[-1]))
+        self.reply({'error': {'message': f'Unknown path {self.path}'}}, 404)
+
+    def reply(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port=0, responder=default_responder, delay=1.0, expire_after=None):
+    """ Start the stub in a thread. Point the client at the returned base
+    url, e.g. OpenAI(api_key='stub', base_url=url). Return (url, server).
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), BatchStubHandler)
+    server.daemon_threads = True
+    server.stub = BatchStub(responder, delay, expire_after)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}/v1', server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Batch API')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=1.0,
+                        help='seconds each batch stays in progress')
+    args = parser.parse_args()
+    url, server = serve(args.port, delay=args.delay)
+    print(f'Batch stub on {url}. Run: OPENAI_BASE_URL={url} OPENAI_API_KEY=stub python icp.py --batch')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+import argparse
+import json
+import math
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import crawl
+import download
+from bench_fixtures import SITE_PROFILES, FixtureServer
+from memory import MemoryMonitor
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+# Every run on this machine is appended to RESULTS_FILE (not committed).
+# BASELINE_FILE is committed: the reference run of each scenario that
+# --compare falls back to when RESULTS_FILE has no run of another commit.
+# Rewrite it with --save-baseline after a change that moves the numbers,
+# on a clean tree so it records the commit.
+RESULTS_FILE = os.path.join(dir_path, 'bench_results', 'crawl.jsonl')
+BASELINE_FILE = os.path.join(dir_path, 'bench_results', 'crawl_baseline.jsonl')
+
+# Metrics compared by --compare, and whether higher is better
+METRICS = {
+    'pages_per_sec': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'cpu_ms_per_page': False,
+    'peak_rss_mb': False,
+}
+
+
+class FetchRecorder:
+    """ Wraps download_page where the crawler looks it up and records the
+    latency and size of every fetch
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.original = crawl.download_page
+
+    def download_page(self, *args, **kwargs):
+        start = time.perf_counter()
+        code, page = self.original(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.bytes += len(page)
+        return code, page
+
+    def __enter__(self):
+        crawl.download_page = download.download_page = self.download_page
+        return self
+
+    def __exit__(self, *exc):
+        crawl.download_page = download.download_page = self.original
+
+
+def percentile(values, q):
+    """ Nearest-rank percentile, 0 for no values
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def cpu_seconds():
+    """ User and system time of this process and its reaped children
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def count_pages(root='scraped'):
+    """ Pages written, from the index.urls of every site folder
+    """
+    pages = 0
+    for site in os.listdir(root):
+        index_file = os.path.join(root, site, 'index.urls')
+        if os.path.exists(index_file):
+            with open(index_file, 'r') as f:
+                pages += sum(1 for line in f if line.strip())
+    return pages
+
+
+def run_process_website(server):
+    for url in server.urls:
+        download.process_website(url)
+
+
+def run_download_pages(server):
+    for site in server.sites:
+        domain = download.extract_domain(site.url)
+        link_file = os.path.join('to_scrape', f'{domain}_urls.txt')
+        with open(link_file, 'w') as f:
+            f.write('\n'.join(site.page_urls()) + '\n')
+        budget = crawl.SiteBudget(**download.SITE_BUDGET)
+        crawl.download_pages(link_file, os.path.join('scraped', domain),
+                             timeout=30, budget=budget)
+
+
+def run_pipeline(server):
+    download.CrawlPipeline().run(server.urls)
+
+
+SCENARIOS = {
+    'process_website': run_process_website,
+    'download_pages': run_download_pages,
+    'pipeline': run_pipeline,
+}
+
+
+def run_scenario(name, profiles=None, scale=1):
+    """ Crawl the fixture sites with one scenario in a scratch directory.
+    Return its metrics.
+    """
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix=f'bench_{name}_')
+    try:
+        os.chdir(workdir)
+        for folder in ['websites', 'to_scrape', 'scraped']:
+            os.makedirs(folder)
+        with FixtureServer(profiles, scale) as server, FetchRecorder() as fetches:
+            monitor = MemoryMonitor(interval=0.1)
+            monitor.start()
+            cpu_start, start = cpu_seconds(), time.perf_counter()
+            SCENARIOS[name](server)
+            seconds = time.perf_counter() - start
+            cpu = cpu_seconds() - cpu_start
+            monitor.stop()
+            monitor.sample()
+        pages = count_pages()
+        latencies = [1000 * latency for latency in fetches.latencies]
+        return {
+            'scenario': name,
+            'sites': len(server.sites),
+            'fetches': len(latencies),
+            'pages': pages,
+            'bytes': fetches.bytes,
+            'seconds': round(seconds, 3),
+            'pages_per_sec': round(pages / seconds, 2) if seconds else 0.0,
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'cpu_ms_per_page': round(1000 * cpu / pages, 2) if pages else 0.0,
+            'peak_rss_mb': round(monitor.peak / 2 ** 20, 1),
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_commit():
+    """ Short hash of HEAD, with -dirty if the tree has changes
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=dir_path,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               cwd=dir_path, capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_results(results, path=RESULTS_FILE):
+    """ Append one line per scenario to the results file
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    meta = {'time': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit()}
+    with open(path, 'a') as out:
+        for result in results:
+            out.write(json.dumps({**meta, **result}) + '\n')
+
+
+def load_results(path=RESULTS_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_baseline(results, path=BASELINE_FILE):
+    """ Replace the baseline run of each scenario in results
+    """
+    meta = {'time': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit()}
+    runs = {run['scenario']: run for run in load_results(path)}
+    runs.update({result['scenario']: {**meta, **result} for result in results})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as out:
+        for run in runs.values():
+            out.write(json.dumps(run) + '\n')
+
+
+def compare(path=RESULTS_FILE, baseline=None, baseline_path=BASELINE_FILE):
+    """ Print the latest run of each scenario next to the latest run from
+    another commit (or from the baseline commit) and the change in percent.
+    Without one, the run of baseline_path is used.
+    """
+    results = load_results(path)
+    saved = {run['scenario']: run for run in load_results(baseline_path)}
+    for scenario in dict.fromkeys(result['scenario'] for result in results):
+        runs = [result for result in results if result['scenario'] == scenario]
+        latest = runs[-1]
+        previous = [run for run in runs[:-1] if run['commit'] != latest['commit']
+                    and (baseline is None or run['commit'].startswith(baseline))]
+        if not previous and scenario in saved and baseline is None:
+            previous = [saved[scenario]]
+        print(f'\n{scenario}: {latest["commit"]}'
+              + (f' vs {previous[-1]["commit"]}' if previous else ' (no earlier commit)'))
+        for metric, higher_is_better in METRICS.items():
+            line = f'  {metric:<18}{latest[metric]:>12}'
+            if previous:
+                before = previous[-1][metric]
+                change = 100 * (latest[metric] - before) / before if before else 0.0
+                better = change > 0 if higher_is_better else change < 0
+                line += f'{before:>12}{change:>+9.1f}%' + ('' if abs(change) < 5 else ' better' if better else ' worse')
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline crawl benchmarks against local fixture sites')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--sites', nargs='+', choices=list(SITE_PROFILES), default=None,
+                        help='fixture site profiles, one site each (default: all)')
+    parser.add_argument('--scale', type=float, default=1, help='multiply the pages of every site')
+    parser.add_argument('--out', default=RESULTS_FILE)
+    parser.add_argument('--compare', action='store_true', help='only compare saved results')
+    parser.add_argument('--baseline', default=None, help='commit to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help=f'also record this run as the committed baseline ({BASELINE_FILE})')
+    args = parser.parse_args()
+
+    if not args.compare:
+        results = []
+        for name in args.scenarios:
+            print(f'Running {name}...')
+            results.append(run_scenario(name, args.sites, args.scale))
+            print(json.dumps(results[-1]))
+        save_results(results, args.out)
+        if args.save_baseline:
+            save_baseline(results)
+    compare(args.out, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
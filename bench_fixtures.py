@@ -0,0 +1,202 @@
+import gzip
+import http.server
+import random
+import socket
+import struct
+import threading
+import time
+
+# Sentences are drawn from this text so that pages read like English and
+# justext keeps their paragraphs instead of dropping them as boilerplate.
+TEXT = """We build software that helps growing teams manage their customers and
+their sales pipeline in one place. Our platform connects with the tools you
+already use, so your data is always where you need it. Thousands of companies
+trust us to keep their records accurate and their people focused on the work
+that matters. The product was designed with feedback from hundreds of sales
+leaders who wanted a simpler way to track deals. Every plan includes support
+from a team that answers within hours and knows the product inside out. You
+can start with a free trial and move to a paid plan when you are ready. Our
+customers report that they close more deals and spend less time on manual
+data entry after the first month. Security is part of everything we do, and
+all of your data is encrypted at rest and in transit. We publish guides,
+webinars and case studies to help you get the most out of the platform. The
+company was founded by engineers who had spent years building internal tools
+for large enterprises. Today we serve customers in healthcare, finance,
+retail and education across more than forty countries. If you have questions
+about pricing or want to see a demo, our team is happy to talk with you."""
+
+SENTENCES = [s.strip().replace('\n', ' ') + '.' for s in TEXT.split('.') if s.strip()]
+WORDS = TEXT.lower().replace('.', '').replace(',', '').split()
+
+NAV = '<nav><a href="/">Home</a> | <a href="/pricing">Pricing</a> | <a href="/about">About</a> | <a href="/contact">Contact</a></nav>'
+FOOTER = '<footer>Copyright 2024. All rights reserved. Privacy | Terms | Cookies</footer>'
+
+# What each fixture site looks like. pages are served at /page-<i>, which
+# download.filter_top_level_urls keeps.
+#   sitemaps: > 1 serves /sitemap.xml as a sitemap index of that many sitemaps
+#   gzip: the child sitemaps are .xml.gz files
+#   delay: seconds before every response (a slow host)
+#   reset_every: every n-th page resets the connection
+#   huge_every, huge_bytes: every n-th page has a body of huge_bytes
+SITE_PROFILES = {
+    'plain': {'pages': 40},
+    'index': {'pages': 60, 'sitemaps': 3},
+    'gzip': {'pages': 40, 'sitemaps': 2, 'gzip': True},
+    'slow': {'pages': 20, 'delay': 0.2},
+    'reset': {'pages': 30, 'reset_every': 5},
+    'huge': {'pages': 20, 'huge_every': 10, 'huge_bytes': 20 * 1024 * 1024},
+}
+
+
+def make_page(name, idx, seed=0):
+    """ Deterministic HTML page of 2 to 40 KB for page idx of site name
+    """
+    rnd = random.Random(f'{seed}-{name}-{idx}')
+    paragraphs = []
+    for _ in range(rnd.randint(3, 40)):
+        # One real sentence, then sentences of words drawn from the text,
+        # which keep its stopword density but not its n-grams, so pages
+        # aren't near duplicates of each other
+        sentences = [rnd.choice(SENTENCES)]
+        for _ in range(rnd.randint(2, 6)):
+            sentences.append(' '.join(rnd.choices(WORDS, k=rnd.randint(8, 20))).capitalize() + '.')
+        paragraphs.append('<p>' + ' '.join(sentences) + '</p>')
+    return (f'<html><head><title>{name} page {idx}</title></head><body>{NAV}'
+            f'<h1>{name.capitalize()} page {idx}</h1>{"".join(paragraphs)}'
+            f'{FOOTER}</body></html>').encode()
+
+
+def _urlset(urls):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            + ''.join(f'<url><loc>{url}</loc></url>' for url in urls)
+            + '</urlset>').encode()
+
+
+def _sitemap_index(urls):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            + ''.join(f'<sitemap><loc>{url}</loc></sitemap>' for url in urls)
+            + '</sitemapindex>').encode()
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        site = self.server.site
+        profile = site.profile
+        if profile.get('delay'):
+            time.sleep(profile['delay'])
+        path = self.path.split('?')[0]
+        if path == '/sitemap.xml':
+            return self.reply(site.sitemap())
+        if path.startswith('/sitemap-'):
+            body = site.child_sitemap(path)
+            return self.reply(body, 'application/x-gzip' if path.endswith('.gz') else 'application/xml')
+        if path.startswith('/page-') and path[6:].isdigit():
+            idx = int(path[6:])
+            if idx < profile['pages']:
+                return self.page(idx)
+        return self.reply(None)
+
+    def page(self, idx):
+        profile = self.server.site.profile
+        if profile.get('reset_every') and idx % profile['reset_every'] == 0:
+            # Linger 0 makes close() send a RST instead of a FIN
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+            self.connection.close()
+            return
+        body = make_page(self.server.site.name, idx)
+        if profile.get('huge_every') and idx % profile['huge_every'] == 0:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            try:
+                for _ in range(profile['huge_bytes'] // len(body) + 1):
+                    self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            return
+        self.reply(body, 'text/html')
+
+    def reply(self, body, content_type='application/xml'):
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class FixtureSite:
+    """ One fixture site served on its own loopback address, so each site
+    gets its own domain key and scraped/ folder
+    """
+
+    def __init__(self, name, profile, host):
+        self.name = name
+        self.profile = profile
+        self.server = http.server.ThreadingHTTPServer((host, 0), FixtureHandler)
+        self.server.daemon_threads = True
+        self.server.site = self
+        self.url = f'http://{host}:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name=f'fixture-{name}', daemon=True)
+
+    def page_urls(self):
+        return [f'{self.url}/page-{i}' for i in range(self.profile['pages'])]
+
+    def child_names(self):
+        ext = '.xml.gz' if self.profile.get('gzip') else '.xml'
+        return [f'/sitemap-{k}{ext}' for k in range(self.profile.get('sitemaps', 1))]
+
+    def sitemap(self):
+        if self.profile.get('sitemaps', 1) > 1:
+            return _sitemap_index([self.url + name for name in self.child_names()])
+        return _urlset(self.page_urls())
+
+    def child_sitemap(self, path):
+        names = self.child_names()
+        if path not in names:
+            return None
+        body = _urlset(self.page_urls()[names.index(path)::len(names)])
+        return gzip.compress(body, mtime=0) if path.endswith('.gz') else body
+
+
+class FixtureServer:
+    """ Serves the fixture sites named in profiles (names of SITE_PROFILES,
+    repeated as needed) on 127.0.0.2, 127.0.0.3, ...
+    Linux routes all of 127.0.0.0/8 to loopback. On macOS the extra
+    addresses need an alias first: sudo ifconfig lo0 alias 127.0.0.2 up
+    """
+
+    def __init__(self, profiles=None, scale=1):
+        self.sites = []
+        for i, name in enumerate(profiles or list(SITE_PROFILES)):
+            profile = dict(SITE_PROFILES[name])
+            profile['pages'] = max(1, int(profile['pages'] * scale))
+            self.sites.append(FixtureSite(f'{name}{i}', profile, f'127.0.0.{i + 2}'))
+
+    def __enter__(self):
+        for site in self.sites:
+            site.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        for site in self.sites:
+            site.server.shutdown()
+            site.server.server_close()
+
+    @property
+    def urls(self):
+        return [site.url for site in self.sites]
@@ -0,0 +1,260 @@
+import argparse
+import gc
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+from pybloom import BloomFilter
+
+from analytics import build_ngram_from_tokens, estimate_overlap_bf
+from bench_crawl import git_commit
+from bench_fixtures import NAV, FOOTER, SENTENCES, WORDS
+from cleaner import clean_page, collapse_white_spaces, connect_lines
+from utils import get_hash, is_number
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+BASELINE_FILE = os.path.join(dir_path, 'bench_results', 'text_baseline.json')
+
+# Input sizes in bytes, 1 KB to 10 MB
+SIZES = [2 ** 10, 2 ** 13, 2 ** 16, 2 ** 20, 10 * 2 ** 20]
+
+# A benchmark fails when its throughput at a size drops below
+# (1 - TOLERANCE) of the baseline, or when its fitted complexity exponent
+# grows by more than EXPONENT_TOLERANCE (e.g. linear turning quadratic).
+TOLERANCE = 0.25
+EXPONENT_TOLERANCE = 0.3
+
+# Each size is timed for at least MIN_TIME seconds in total and the best of
+# the runs is kept
+MIN_TIME = 0.3
+MAX_RUNS = 20
+
+
+def make_text(size, seed=0):
+    """ About size characters of English-like text, in lines of 40 to 120
+    characters with a blank line between paragraphs
+    """
+    rnd = random.Random(seed)
+    lines, total = [], 0
+    while total < size:
+        line = rnd.choice(SENTENCES) + ' ' + ' '.join(rnd.choices(WORDS, k=rnd.randint(2, 12)))
+        if rnd.random() < 0.2:
+            line += '  ' + ' ' * rnd.randint(1, 4) + rnd.choice(['12,000', '3.5', '-7', 'x'])
+        lines.append(line)
+        if rnd.random() < 0.1:
+            lines.append('')
+        total += len(line) + 1
+    return '\n'.join(lines)[:size]
+
+
+def make_html(size, seed=0):
+    paragraphs = ''.join(f'<p>{line}</p>' for line in make_text(size, seed).split('\n') if line)
+    return f'<html><body>{NAV}{paragraphs}{FOOTER}</body></html>'.encode()
+
+
+def _text_input(size):
+    return (make_text(size),), size
+
+
+def _html_input(size):
+    page = make_html(size)
+    return (page,), len(page)
+
+
+def _tokens_input(size):
+    return (make_text(size).split(), 8), size
+
+
+def _lines_input(size):
+    lines = make_text(size).split('\n')
+    return (lines,), size
+
+
+def _number_input(size):
+    rnd = random.Random(0)
+    tokens = [rnd.choice(['239,000,000', '32.0323', '.230', '-12', 'revenue', '1,00,0', '42'])
+              for _ in range(size // 8)]
+    return (tokens,), size
+
+
+def _overlap_input(size):
+    """ A Bloom filter of the n-grams of one text and a file of another
+    text sharing half its lines
+    """
+    bf = BloomFilter(capacity=max(1000, size // 2), error_rate=1e-4)
+    source = make_text(size, seed=1).split('\n')
+    for line in source:
+        for key in build_ngram_from_tokens(line.lower().split(), 8):
+            bf.add(key)
+    target = source[::2] + make_text(size // 2, seed=2).split('\n')
+    fd, path = tempfile.mkstemp(suffix='.txt', prefix='bench_overlap_')
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(target))
+    return (bf, path), size
+
+
+def _hash_lines(lines):
+    for line in lines:
+        get_hash(line)
+
+
+def _number_tokens(tokens):
+    for token in tokens:
+        is_number(token)
+
+
+# name: (function, input builder). The builder returns the call arguments
+# and the number of bytes they stand for.
+BENCHMARKS = {
+    'cleaner.collapse_white_spaces': (collapse_white_spaces, _text_input),
+    'cleaner.connect_lines': (connect_lines, _text_input),
+    'cleaner.clean_page': (clean_page, _html_input),
+    'analytics.build_ngram_from_tokens': (build_ngram_from_tokens, _tokens_input),
+    'analytics.estimate_overlap_bf': (estimate_overlap_bf, _overlap_input),
+    'utils.get_hash': (_hash_lines, _lines_input),
+    'utils.is_number': (_number_tokens, _number_input),
+}
+
+
+def time_call(fn, args, min_time=MIN_TIME, max_runs=MAX_RUNS):
+    """ Best wall time of fn(*args) over as many runs as fit in min_time
+    """
+    best, total, runs = float('inf'), 0.0, 0
+    while runs < max_runs and (runs == 0 or total < min_time):
+        gc.collect()
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+        runs += 1
+    return best
+
+
+def fit_exponent(points):
+    """ Slope of log(time) against log(size) by least squares: about 1 for
+    linear code, 2 for quadratic code
+    """
+    points = [(math.log(size), math.log(seconds)) for size, seconds in points if seconds > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+
+def complexity(exponent):
+    if exponent is None:
+        return '?'
+    if exponent < 0.5:
+        return 'O(1)'
+    if exponent < 1.25:
+        return 'O(n)'
+    if exponent < 1.6:
+        return 'O(n log n)'
+    return f'O(n^{exponent:.1f})'
+
+
+def run_benchmark(name, sizes=SIZES):
+    """ Time one benchmark at every size. Return its throughput per size in
+    MB/s and its fitted exponent.
+    """
+    fn, make_input = BENCHMARKS[name]
+    throughput, points = {}, []
+    for size in sizes:
+        args, num_bytes = make_input(size)
+        try:
+            seconds = time_call(fn, args)
+        finally:
+            if make_input is _overlap_input:
+                os.remove(args[1])
+        points.append((num_bytes, seconds))
+        throughput[str(size)] = num_bytes / seconds / 2 ** 20
+    exponent = fit_exponent(points)
+    return {'throughput': throughput, 'exponent': exponent}
+
+
+def check(results, baseline, tolerance=TOLERANCE, exponent_tolerance=EXPONENT_TOLERANCE):
+    """ Compare results with the baseline. Return a list of regressions.
+    """
+    failures = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for size, value in result['throughput'].items():
+            before = base['throughput'].get(size)
+            if before and value < (1 - tolerance) * before:
+                failures.append(f'{name} at {int(size)} bytes: {value:.2f} MB/s, '
+                                f'baseline {before:.2f} MB/s')
+        if (result['exponent'] is not None and base.get('exponent') is not None
+                and result['exponent'] > base['exponent'] + exponent_tolerance):
+            failures.append(f'{name}: grows as {complexity(result["exponent"])}, '
+                            f'baseline {complexity(base["exponent"])}')
+    return failures
+
+
+def print_results(results, baseline):
+    print(f'{"benchmark":<36}{"size":>10}{"MB/s":>10}{"baseline":>10}')
+    for name, result in results.items():
+        base = baseline.get(name, {}).get('throughput', {})
+        for size, value in result['throughput'].items():
+            before = f'{base[size]:.2f}' if size in base else '-'
+            print(f'{name:<36}{int(size):>10}{value:>10.2f}{before:>10}')
+        print(f'{"":<36}{"fit":>10}{complexity(result["exponent"]):>10}')
+
+
+def load_baseline(path=BASELINE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)['benchmarks']
+
+
+def save_baseline(results, path=BASELINE_FILE):
+    """ Baselines are only comparable on the machine that recorded them
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    baseline = load_baseline(path)
+    baseline.update(results)
+    with open(path, 'w') as out:
+        json.dump({'commit': git_commit(), 'python': sys.version.split()[0],
+                   'benchmarks': baseline}, out, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the text and n-gram functions')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--max-size', type=int, default=SIZES[-1], help='largest input in bytes')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='record these results as the baseline instead of checking them')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    sizes = [size for size in SIZES if size <= args.max_size]
+    results = {}
+    for name in args.only:
+        print(f'Running {name}...')
+        results[name] = run_benchmark(name, sizes)
+    baseline = load_baseline(args.baseline)
+    print_results(results, baseline)
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print(f'Baseline saved to {args.baseline}')
+        return
+    failures = check(results, baseline, args.tolerance)
+    for failure in failures:
+        print('REGRESSION', failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
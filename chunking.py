@@ -0,0 +1,116 @@
+import math
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Encoding of the gpt-4o models
+ENCODING = 'o200k_base'
+
+# Tokens of site content sent in one extraction call. Content is split on
+# paragraph boundaries into chunks of about this size, and sites smaller
+# than it are packed together up to it.
+CHUNK_TOKENS = 25000
+
+# Most sites in one packed call, so the JSON answer stays well under the
+# model's output limit
+PACK_SITES = 8
+
+_encoding = None
+
+
+def count_tokens(text):
+    """ Tokens of text with tiktoken, or an estimate of 4 characters per
+    token when it isn't installed or its encoding can't be loaded (it is
+    downloaded on first use)
+    """
+    global _encoding
+    if tiktoken is not None and _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding(ENCODING)
+        except (OSError, ValueError) as e:
+            print(f"Could not load the {ENCODING} encoding, estimating tokens instead: {e}")
+            _encoding = False
+    if not _encoding:
+        return math.ceil(len(text) / 4)
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+# Boundaries to cut at, from the most to the least preferred. The
+# separator stays at the end of the piece before it, so the pieces add up
+# to the original text.
+BOUNDARIES = [r'(?<=\n\n)', r'(?<=\n)', r'(?<=[.!?] )', r'(?<=\s)']
+
+
+def _pieces(text, max_chars, level=0):
+    """ Split text into pieces of at most max_chars: paragraphs, then
+    lines, sentences and words of a piece that is still too long
+    """
+    if len(text) <= max_chars:
+        return [text]
+    if level == len(BOUNDARIES):
+        # A single word longer than a chunk
+        return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+    pieces = []
+    for piece in re.split(BOUNDARIES[level], text):
+        if piece:
+            pieces.extend(_pieces(piece, max_chars, level + 1))
+    return pieces
+
+
+def split_text(text, max_tokens=CHUNK_TOKENS):
+    """ Chunks of text of at most about max_tokens, cut between paragraphs
+    where possible. The chunks are about the same size: 1.1 times
+    max_tokens gives two halves, not a full chunk and a nearly empty one.
+
+    The whole text is counted with the tokenizer and the pieces are sized
+    by their share of its characters.
+    """
+    total = count_tokens(text)
+    if total <= max_tokens:
+        return [text] if text.strip() else []
+    count = math.ceil(total / max_tokens)
+    max_chars = max(1, int(len(text) * max_tokens / total))
+    pieces = _pieces(text, math.ceil(len(text) / count))
+    # Cut at the piece boundary nearest to each of count equal parts
+    chunks, current, current_chars, done = [], [], 0, 0
+    for piece in pieces:
+        boundary = (len(chunks) + 1) * len(text) / count
+        if current and (current_chars + len(piece) > max_chars or done + len(piece) / 2 > boundary):
+            chunks.append(''.join(current))
+            current, current_chars = [], 0
+        current.append(piece)
+        current_chars += len(piece)
+        done += len(piece)
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+
+def plan_chunks(sites, max_tokens=CHUNK_TOKENS, pack_sites=PACK_SITES):
+    """ Group {website: content} into extraction calls.
+
+    Return a list of calls, each a list of (website, chunk, text). A site
+    bigger than max_tokens gets one call per chunk; smaller sites are
+    packed, biggest first, into calls of up to max_tokens and pack_sites
+    sites.
+    """
+    calls, small = [], []
+    for website, content in sites.items():
+        chunks = split_text(content, max_tokens)
+        if len(chunks) > 1:
+            calls.extend([(website, chunk, text)] for chunk, text in enumerate(chunks))
+        elif chunks:
+            small.append((count_tokens(chunks[0]), website, chunks[0]))
+    packs = []
+    for tokens, website, text in sorted(small, key=lambda item: -item[0]):
+        for pack in packs:
+            if pack[0] + tokens <= max_tokens and len(pack[1]) < pack_sites:
+                pack[0] += tokens
+                pack[1].append((website, 0, text))
+                break
+        else:
+            packs.append([tokens, [(website, 0, text)]])
+    return calls + [units for _, units in packs]
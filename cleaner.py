@@ -8,6 +8,7 @@ import html
 import justext
 from unidecode import unidecode
 
+from profiling import timed
 from utils import *
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -103,6 +104,7 @@ def connect_lines(txt, line_sep='\n'):
     return result + curr
 
 
+@timed('clean_page')
 def clean_page(page):
     try:
         page = page.decode('utf-8')
@@ -7,17 +7,22 @@ import logging
 import re
 import socket
 import ssl
+import threading
 import time
 import urllib.request
+from contextlib import contextmanager
 
 import requests
-import tldextract
 
 from cleaner import *
+from domains import get_host, registered_domain
+from profiling import timed
 from utils import *
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+logger = logging.getLogger(__name__)
+
 
 def exists(url):
     request = requests.get(url)
@@ -40,55 +45,195 @@ def to_skip(link, extensions=None, domains=None):
     for ext in extensions:
         if link.endswith(ext):
             return True
-    raw_url = get_raw_url(link)
-    subdomain, domain, suffix = tldextract.extract(link)
-    if domain in domains:
+    host = get_host(link)
+    registered = registered_domain(host)
+    if registered.split('.')[0] in domains:
         return True
-    if '.'.join([domain, suffix]) in domains:
+    if registered in domains:
         return True
-    if '.'.join([subdomain, domain, suffix]) in domains:
+    if host in domains:
         return True
     return False
 
 
-def download_page(link, context=None, timeout=10, retries=3, backoff_factor=0.3):
+class SiteBudget:
+    """ Time, page and byte allowance for crawling one site.
+    seconds, pages and max_bytes can each be None for no limit.
+    Once any limit is hit, reason says which one ('deadline', 'pages' or
+    'bytes') and the site's result is partial.
+
+    Only the time the site's fetches are running counts against seconds
+    (see running), not the time its pages wait in a queue behind other
+    sites.
+    """
+
+    def __init__(self, seconds=None, pages=None, max_bytes=None):
+        self.seconds = seconds or None
+        self.max_pages = pages
+        self.max_bytes = max_bytes
+        self.pages = 0
+        self.bytes = 0
+        self.reason = None
+        self.used = 0.0
+        self.active = 0
+        self.started = None
+        self.lock = threading.RLock()
+
+    @contextmanager
+    def running(self):
+        """ Count the time of the block against the deadline. Blocks that
+        overlap (concurrent fetches of the site) count once.
+        """
+        with self.lock:
+            if self.active == 0:
+                self.started = time.monotonic()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+                if self.active == 0:
+                    self.used += time.monotonic() - self.started
+
+    def elapsed(self):
+        """ Seconds of fetching charged to the site so far
+        """
+        with self.lock:
+            if self.active:
+                return self.used + time.monotonic() - self.started
+            return self.used
+
+    def past_deadline(self):
+        if self.seconds is not None and self.elapsed() >= self.seconds:
+            self.reason = self.reason or 'deadline'
+            return True
+        return False
+
+    def exhausted(self):
+        if self.past_deadline():
+            return True
+        if self.max_bytes is not None and self.bytes >= self.max_bytes:
+            self.reason = self.reason or 'bytes'
+            return True
+        return False
+
+    def take_page(self):
+        """ Reserve one page fetch. Return False if the budget is used up.
+        """
+        with self.lock:
+            if self.exhausted():
+                return False
+            if self.max_pages is not None and self.pages >= self.max_pages:
+                self.reason = self.reason or 'pages'
+                return False
+            self.pages += 1
+            return True
+
+    def charge(self, num_bytes):
+        with self.lock:
+            self.bytes += num_bytes
+
+    def timeout(self, timeout):
+        """ timeout shortened to what is left until the deadline
+        """
+        if self.seconds is None:
+            return timeout
+        return max(0.1, min(timeout, self.seconds - self.elapsed()))
+
+    def remaining_bytes(self):
+        if self.max_bytes is None:
+            return None
+        return max(0, self.max_bytes - self.bytes)
+
+    def to_dict(self):
+        return {'pages': self.pages, 'bytes': self.bytes, 'seconds': round(self.elapsed(), 1),
+                'reason': self.reason}
+
+
+def read_body(response, max_bytes=None, budget=None, chunk_size=1 << 16):
+    """ Read a response in chunks, stopping at max_bytes or at the budget's
+    deadline. Return (body, complete).
+    """
+    chunks, size = [], 0
+    while max_bytes is None or size < max_bytes:
+        if budget is not None and budget.past_deadline():
+            return b''.join(chunks), False
+        to_read = chunk_size if max_bytes is None else min(chunk_size, max_bytes - size)
+        chunk = response.read(to_read)
+        if not chunk:
+            return b''.join(chunks), True
+        chunks.append(chunk)
+        size += len(chunk)
+    return b''.join(chunks), not response.read(1)
+
+
+@timed('download_page')
+def download_page(link, context=None, timeout=10, retries=3, backoff_factor=0.3, budget=None):
     """
     Return code, page
     0: successfully read (write to index)
     1: bad_url (write to bad_url)
     2: unicode error (write to non_ascii_urls)
     3. bad_connection_urls
+    4. over the site's budget (write to budget_urls)
 
     When code is not 0, return ''
+
+    budget: SiteBudget of the site. The call's time is charged to it.
+            Each attempt's timeout is cut to the deadline, retries stop
+            at the deadline and the body is cut at the remaining bytes. A
+            cut body is returned with code 0.
     """
+    if budget is None:
+        return _download_page(link, context, timeout, retries, backoff_factor)
+    with budget.running():
+        return _download_page(link, context, timeout, retries, backoff_factor, budget)
+
+
+def _download_page(link, context=None, timeout=10, retries=3, backoff_factor=0.3, budget=None):
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
     }
 
     for attempt in range(retries):
+        if budget is not None and budget.exhausted():
+            return 4, ''
+        attempt_timeout = budget.timeout(timeout) if budget is not None else timeout
         try:
             req = urllib.request.Request(link, headers=headers)
-            response = urllib.request.urlopen(req, context=context, timeout=timeout)
-            page = response.read()
+            response = urllib.request.urlopen(req, context=context, timeout=attempt_timeout)
+            if budget is None:
+                return 0, response.read()
+            page, complete = read_body(response, budget.remaining_bytes(), budget)
+            budget.charge(len(page))
+            if not complete:
+                logger.warning('Body of %s cut by the site budget', link)
+                budget.exhausted()
+                if not page:
+                    return 4, ''
             return 0, page
         
         except (ValueError, urllib.error.HTTPError, urllib.error.URLError, http.client.HTTPException) as e:
-            logging.warning(f'Error {e} for {link}')
+            logger.warning('Error %s for %s', e, link)
             return 1, ''
         
         except UnicodeError as e:
-            logging.warning(f'UnicodeError for {link}')
+            logger.warning('UnicodeError for %s', link)
             return 2, ''
         
         except (ConnectionResetError, http.client.RemoteDisconnected, ConnectionError, socket.timeout, ssl.SSLError) as e:
-            logging.warning(f'ConnectionError or Timeout on attempt {attempt+1} for {link}')
+            logger.warning('ConnectionError or Timeout on attempt %d for %s', attempt + 1, link)
             if attempt < retries - 1:
-                time.sleep(backoff_factor * (2 ** attempt))  # exponential backoff
+                delay = backoff_factor * (2 ** attempt)  # exponential backoff
+                if budget is not None:
+                    delay = min(delay, budget.timeout(delay))
+                time.sleep(delay)
                 continue
             return 3, ''
         
         except Exception as e:
-            logging.error(f'Unexpected error: {e} for {link}')
+            logger.error('Unexpected error: %s for %s', e, link)
             return 1, ''
 
     return 1, ''
@@ -112,7 +257,9 @@ def download_pages(link_file,
                    timeout=30,
                    default_skip=False,
                    extensions=[],
-                   domains=[]):
+                   domains=[],
+                   diagnostics=False,
+                   budget=None):
     """
     link_file (str):
         file contains links to pages to crawl. Each line contains one URL.
@@ -137,6 +284,14 @@ def download_pages(link_file,
         You can also add your own domains and extensions to skip with domains
         and extensions and arguments.
 
+    budget (SiteBudget):
+        limits on the time, pages and bytes spent on this site. Links left
+        when it runs out are written to budget.urls.
+
+    diagnostics (bool):
+        True to log the unprintable characters of every page at DEBUG level.
+        It scans every character, so it is off by default.
+
     In the folder:
             Each URL is downloaded into a file, indexed by the order in which
             it is downloaded.
@@ -170,6 +325,7 @@ def download_pages(link_file,
     bad_urls = open(os.path.join(folder, 'bad.urls'), 'a')
     non_ascii_urls = open(os.path.join(folder, 'non_ascii.urls'), 'a')
     empty_urls = open(os.path.join(folder, 'empty.urls'), 'a')
+    budget_urls = open(os.path.join(folder, 'budget.urls'), 'a')
 
     ctx = ssl.create_default_context()
     ctx.check_hostname = False
@@ -190,13 +346,19 @@ def download_pages(link_file,
         #     print('Skip', link)
         #     continue
 
-        code, page = download_page(link, ctx, timeout)
+        if budget is not None and not budget.take_page():
+            budget_urls.write(link + '\n')
+            continue
+
+        code, page = download_page(link, ctx, timeout, budget=budget)
         if code == 1:
             bad_urls.write(link + '\n')
         elif code == 2:
             non_ascii_urls.write(link + '\n')
         elif code == 3:
             bad_connection_urls.write(link + '\n')
+        elif code == 4:
+            budget_urls.write(link + '\n')
         if code > 0:
             continue
 
@@ -213,7 +375,8 @@ def download_pages(link_file,
         with open(f'{folder}/{idx}_{name}.txt', 'w') as out:
             out.write(link + '\n' + txt)
 
-        print(find_unprintable(txt))
+        if diagnostics and logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Unprintable characters in %s: %s', link, find_unprintable(txt))
         index.write('{}\n'.format(link))
         idx += 1
 
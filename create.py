@@ -1,10 +1,13 @@
+import heapq
+import math
 import os
-import random
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 from pybloom import BloomFilter
 
 from analytics import *
+from memory import sizeof
 from utils import *
 
 
@@ -27,32 +30,49 @@ def filter_files(files,
                  capacity=100000000,
                  error_rate=1e-7,
                  header=0,
-                 interval=1000000):
+                 interval=1000000,
+                 min_entropy=None,
+                 entropy_n=3):
     """ Include only files that has less than threshold n-gram overlapping
         with the current dataset.
     Names of all the files that are deemed duplicated are stored in
         dupped_files.list
     Names of all the files used for the dataset are stored in
         clean_files.list
+    Names of all the files dropped for low information content are stored in
+        low_entropy_files.list
 
     Args:
         header (int):
             number of lines of each file to skip. It's because in our format,
             the first line is the url
+        min_entropy (float):
+            if set, drop pages whose normalized entropy_n-gram entropy
+            (between 0 and 1) is below min_entropy before the overlap check.
 
     """
     with open(files) as file:
         lines = [line.rstrip() for line in file]
     sorted_files = sort_files_by_size(lines)
     bf = BloomFilter(capacity=capacity, error_rate=error_rate)
+    print(f'Bloom filter for {len(lines)} files: {sizeof(bf) / 2 ** 20:.1f} MB')
     p=files.split("/")
     save_path='/'.join(p[:-1])
     dupped_files = open(f'{save_path}/dupped_files.list', 'w')
     clean_files = open(f'{save_path}/clean_files.list', 'w')
+    low_entropy_files = open(f'{save_path}/low_entropy_files.list', 'w')
 
     dup_count = 0
 
     for size, file in sorted_files:
+        if min_entropy is not None and is_low_entropy(file,
+                                                      min_entropy,
+                                                      gran=gran,
+                                                      n=entropy_n,
+                                                      header=header):
+            print("Low entropy", file)
+            low_entropy_files.write(file.strip() + '\n')
+            continue
         overlap = estimate_overlap_bf(bf, file, gran=gran, n=n, header=header)
         if overlap > threshold:
             print("Dup", file)
@@ -67,11 +87,76 @@ def filter_files(files,
                              alphanumeric=True,
                              interval=interval)
             clean_files.write(file.strip() + '\n')
+    dupped_files.close()
+    clean_files.close()
+    low_entropy_files.close()
     total = len(files)
     print(f'{dup_count} duplicated out of {total}: {dup_count / total}')
 
 
-def partition(file, outfold, test_size=0.1, valid_size=0.1):
+def _hash_unit(line, seed=''):
+    """ Map a line to a stable float in [0, 1) from the md5 of its content
+    """
+    digest = get_hash(seed + line.strip())
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+
+def _k_smallest_hashes(file, k, seed='', lower=0.0):
+    """ One streaming pass returning the k smallest distinct line hashes
+    that are >= lower, in increasing order. Memory is O(k).
+    """
+    heap, kept = [], set()
+    with open(file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            h = _hash_unit(line, seed)
+            if h < lower or h in kept:
+                continue
+            if len(heap) < k:
+                heapq.heappush(heap, -h)
+                kept.add(h)
+            elif h < -heap[0]:
+                kept.discard(-heapq.heapreplace(heap, -h))
+                kept.add(h)
+    return sorted(-h for h in heap)
+
+
+def _count_cutoff(hashes, k):
+    """ Cutoff so that exactly the first k of the sorted hashes fall below it
+    """
+    if len(hashes) < k:
+        return 1.0
+    return math.nextafter(hashes[k - 1], 1.0)
+
+
+def _partition_cutoffs(file, valid_size, test_size, seed=''):
+    """ Return (valid_cutoff, test_cutoff) on the hash space.
+    A line with hash h goes to valid if h < valid_cutoff, to test if
+    valid_cutoff <= h < test_cutoff and to train otherwise.
+    Sizes > 1 are absolute numbers of distinct lines and need one extra
+    streaming pass over the file.
+    """
+    valid_size = max(valid_size, 0)
+    test_size = max(test_size, 0)
+    valid_count, test_count = valid_size > 1, test_size > 1
+
+    if valid_count:
+        k = int(valid_size) + (int(test_size) if test_count else 0)
+        hashes = _k_smallest_hashes(file, k, seed)
+        valid_cutoff = _count_cutoff(hashes, int(valid_size))
+        if test_count:
+            return valid_cutoff, _count_cutoff(hashes, k)
+        return valid_cutoff, min(1.0, valid_cutoff + test_size)
+
+    if test_count:
+        hashes = _k_smallest_hashes(file, int(test_size), seed, valid_size)
+        return valid_size, _count_cutoff(hashes, int(test_size))
+    return valid_size, min(1.0, valid_size + test_size)
+
+
+def partition(file, outfold, test_size=0.1, valid_size=0.1, seed='',
+              buffering=1 << 20):
     """
     outfold will contain:
     train.txt
@@ -81,18 +166,46 @@ def partition(file, outfold, test_size=0.1, valid_size=0.1):
     You can choose not to include test or valid by setting its size to -1
     If the size is a fraction of 1, it'll be divided based on that ration.
     If it's an integer larger than 1, test/valid will contain that number of samples
+
+    Each line is assigned by a stable hash of its content (salted with seed),
+    so splits are reproducible and duplicated lines always land in the same
+    split. The input is streamed and memory doesn't grow with its size.
     """
     os.makedirs(outfold, exist_ok=True)
-    files = [open(f'{outfold}/{filename}', 'w')
+    valid_cutoff, test_cutoff = _partition_cutoffs(file, valid_size,
+                                                   test_size, seed)
+    files = [open(f'{outfold}/{filename}', 'w', buffering=buffering)
              for filename in ['train.txt', 'valid.txt', 'test.txt']]
-    adjusted_test_size = test_size / (1 - valid_size)
+    counts = [0, 0, 0]
     with open(file, 'r') as f:
-        for line in f.readlines():
+        for line in f:
             if not line.strip():
                 continue
-            if random.random() < valid_size:
-                files[1].write(line)
-            elif random.random() < adjusted_test_size:
-                files[2].write(line)
+            h = _hash_unit(line, seed)
+            if h < valid_cutoff:
+                split = 1
+            elif h < test_cutoff:
+                split = 2
             else:
-                files[0].write(line)
+                split = 0
+            files[split].write(line)
+            counts[split] += 1
+    for out in files:
+        out.close()
+    print(f'{file}: train {counts[0]}, valid {counts[1]}, test {counts[2]}')
+    return counts
+
+
+def partition_files(files, outfold, test_size=0.1, valid_size=0.1, seed='',
+                    max_workers=None):
+    """ Partition several files in parallel.
+    Each file is split into outfold/<filename>/{train,valid,test}.txt
+    """
+    if isinstance(files, str):
+        files = [files]
+    outfolds = [os.path.join(outfold, get_filename(file)) for file in files]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(partition, file, fold, test_size,
+                                   valid_size, seed)
+                   for file, fold in zip(files, outfolds)]
+        return [future.result() for future in futures]
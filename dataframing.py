@@ -1,76 +1,112 @@
+import hashlib
 import os
 import pandas as pd
 import re
+import sys
 
-import os
-import pandas as pd
+from domains import domain_keys, valid_urls
+from memory import peak_rss_bytes, record_size, sizeof, sizes
+import profiling
+from store import Store
 
-def load_and_concatenate_files(directory):
-    # List to hold final data
-    data = []
-
-    # Crawl through the directory and its subdirectories
-    for root, dirs, files in os.walk(directory):
-        subdirectory_name = os.path.basename(root)
-        # Check if subdirectory has .txt files that begin with numeral_
-        txt_files = [f for f in files if f.endswith('.txt') and f.split('_')[0].isdigit()]
-
-        if txt_files:
-            clean_files_list_path = os.path.join(root, 'clean_files.list')
-
-                # Check if clean_files.list exists in the subdirectory
-            if os.path.exists(clean_files_list_path):
-                with open(clean_files_list_path, 'r') as list_file:
-                    clean_files = list_file.read().splitlines()
-
-                # Filter and sort the files by the numeric prefix
-                clean_files = [f for f in clean_files if os.path.basename(f).split('_')[0].isdigit() and os.path.basename(f) != 'filenames.txt']
-                clean_files.sort(key=lambda x: int(os.path.basename(x).split('_')[0]))
-                clean_files = clean_files[:25]
-                concatenated_content = ""
-
-                # Load and concatenate the contents of all files listed in clean_files.list
-                for clean_file_path in clean_files:
-                    # Prepend the root directory to the relative paths in clean_files.list
-                    full_file_path = os.path.join(directory, clean_file_path)
-                    if os.path.exists(full_file_path):
-                        with open(full_file_path, 'r') as f:
-                            content = f.read().strip()
-                            concatenated_content += content + "\n"
-                            if not content:
-                                print(f"Warning: {full_file_path} is empty.")
-                    else:
-                        print(f"Warning: {full_file_path} does not exist.")
-
-                    # Append the subdirectory name and concatenated content to the data list
-                if concatenated_content.strip():
-                    data.append({
-                            'website': subdirectory_name,
-                            'content': concatenated_content.strip(),
-                            'len': len(concatenated_content.strip())
-                        })
-                else:
-                    print(f"Warning: No content to concatenate in {subdirectory_name}.")
-
-    # Create a DataFrame from the data
-    df = pd.DataFrame(data)
-    df.to_csv("iiq.csv")
-    return df
-
-def is_valid_url(url):
-    if isinstance(url, str):
-        regex = re.compile(
-            r'^(https?|ftp)://'  # http:// or https:// or ftp://
-            r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
-            r'localhost|'  # localhost...
-            r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|'  # ...or ipv4
-            r'\[?[A-F0-9]*:[A-F0-9:]+\]?)'  # ...or ipv6
-            r'(?::\d+)?'  # optional port
-            r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-        return re.match(regex, url) is not None
-    return False
+def get_site_clean_files(site_folder):
+    """ Paths listed in the site's clean_files.list, sorted by their numeric
+    prefix and capped at 25 pages. Return None if the site has no list.
+    """
+    clean_files_list_path = os.path.join(site_folder, 'clean_files.list')
+    if not os.path.exists(clean_files_list_path):
+        return None
+    with open(clean_files_list_path, 'r') as list_file:
+        clean_files = list_file.read().splitlines()
+
+    # Filter and sort the files by the numeric prefix
+    clean_files = [f for f in clean_files if os.path.basename(f).split('_')[0].isdigit() and os.path.basename(f) != 'filenames.txt']
+    clean_files.sort(key=lambda x: int(os.path.basename(x).split('_')[0]))
+    return clean_files[:25]
+
+def site_fingerprint(directory, clean_files):
+    """ Hash of the clean file list and the size and mtime of each file.
+    It changes whenever a page is added, dropped or rewritten.
+    """
+    hashed = hashlib.md5()
+    for clean_file_path in clean_files:
+        full_file_path = os.path.join(directory, clean_file_path)
+        try:
+            stat = os.stat(full_file_path)
+            hashed.update(f'{clean_file_path}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+        except FileNotFoundError:
+            hashed.update(f'{clean_file_path}:missing\n'.encode())
+    return hashed.hexdigest()
+
+def concatenate_site(directory, site, clean_files):
+    concatenated_content = ""
+
+    # Load and concatenate the contents of all files listed in clean_files.list
+    for clean_file_path in clean_files:
+        # Prepend the root directory to the relative paths in clean_files.list
+        full_file_path = os.path.join(directory, clean_file_path)
+        if os.path.exists(full_file_path):
+            with open(full_file_path, 'r') as f:
+                content = f.read().strip()
+                concatenated_content += content + "\n"
+                if not content:
+                    print(f"Warning: {full_file_path} is empty.")
+        else:
+            print(f"Warning: {full_file_path} does not exist.")
+
+    if not concatenated_content.strip():
+        print(f"Warning: No content to concatenate in {site}.")
+        return None
+    return {
+        'website': site,
+        'content': concatenated_content.strip(),
+        'len': len(concatenated_content.strip())
+    }
+
+def load_and_concatenate_files(directory, store=None):
+    """ Aggregate the clean pages of every site under directory/scraped into
+    the store's site_contents table.
+
+    Each site is fingerprinted by its clean file list and file mtimes, and
+    only sites whose fingerprint changed since the last run are re-read.
+    Each record is written to the store as soon as it is built. Sites that
+    no longer have a clean file list or any content are removed from the
+    table, so their old content isn't extracted again.
+    Return the (website, len) of every aggregated site.
+    """
+    store = store or Store()
+    scraped = os.path.join(directory, 'scraped')
+    known = dict(store.read('site_contents', columns=['website', 'fingerprint']).itertuples(index=False))
+    updated, unchanged = 0, 0
+    current = set()
+
+    with os.scandir(scraped) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            clean_files = get_site_clean_files(entry.path)
+            if clean_files is None:
+                continue
+            fingerprint = site_fingerprint(directory, clean_files)
+            if known.get(entry.name) == fingerprint:
+                unchanged += 1
+                current.add(entry.name)
+                continue
+            record = concatenate_site(directory, entry.name, clean_files)
+            if record is not None:
+                record['fingerprint'] = fingerprint
+                store.append('site_contents', record)
+                updated += 1
+                current.add(entry.name)
+
+    removed = store.delete('site_contents', 'website', set(known) - current)
+    print(f"Aggregated {updated} changed sites, {unchanged} unchanged, {removed} removed.")
+    return store.read('site_contents', columns=['website', 'len'])
 
 def clean_url(url):
+    """ Deprecated: strips only the scheme and the last TLD, so different
+    TLDs and subdomains collide. Use domains.domain_key instead.
+    """
     if isinstance(url, str):
         # Remove the http://, https://, and www.
         url = re.sub(r'^https?://(www\.)?', '', url)
@@ -80,27 +116,65 @@ def clean_url(url):
         url = url.rstrip('/')
         return url
 
-def main():
+LEAD_COLUMNS = ['LinkedInUrl', 'Title', 'Website', 'CompanyName', 'Industry']
+# Repetitive fields are read as categories: one copy of each distinct value
+LEAD_DTYPES = {
+    'LinkedInUrl': 'string',
+    'Title': 'string',
+    'Website': 'category',
+    'CompanyName': 'category',
+    'Industry': 'category',
+}
+
+def read_leads(path, downloaded_websites, chunksize=100000):
+    """ Stream a lead export in chunks of chunksize rows.
+    Only LEAD_COLUMNS are parsed. Each chunk is filtered to valid urls,
+    keyed with domains.domain_keys and joined against downloaded_websites
+    (an Index or set of crawled site keys) before it is yielded, so memory
+    is bounded by the chunk size rather than by the export size.
+    """
+    reader = pd.read_csv(path, usecols=LEAD_COLUMNS, dtype=LEAD_DTYPES, chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk[valid_urls(chunk['Website']) & valid_urls(chunk['LinkedInUrl'])]
+        chunk = chunk.assign(website=domain_keys(chunk['Website']))
+        chunk = chunk[chunk['website'].isin(downloaded_websites)]
+        if len(chunk):
+            yield chunk
+
+def ingest_leads(path, downloaded_websites, store, chunksize=100000):
+    """ Write the leads of a crawled website to the store chunk by chunk.
+    The leads of earlier exports are removed first, so the store holds the
+    current export only, as the xlsx written on each run used to.
+    Return the number of lead rows kept.
+    """
+    removed = store.clear('leads')
+    if removed:
+        print(f"Removed {removed} lead rows of the previous export.")
+    kept = 0
+    for chunk in read_leads(path, downloaded_websites, chunksize):
+        record_size('leads_chunk', chunk)
+        kept += store.append('leads', chunk.rename(columns={'Website': 'WebsiteUrl'}))
+    return kept
+
+def main(export_excel=False):
     directory_path = '/Users/akshaymijar/icp-filtering' 
-    websites_df = load_and_concatenate_files(directory_path)
-    print("Loaded website data into dataframe.")
+    store = Store()
+    websites_df = load_and_concatenate_files(directory_path, store=store)
+    print(f"Loaded website data into dataframe ({sizeof(websites_df) / 2 ** 20:.1f} MB).")
     #print(websites_df.info())
-    leads_df=pd.read_csv("/Users/akshaymijar/icp-filtering/rb2b30cleaned.csv")
-    filtered_df = leads_df[leads_df['Website'].apply(is_valid_url)]
-    filtered_df = filtered_df[filtered_df['LinkedInUrl'].apply(is_valid_url)]
-    columns_subset = ['LinkedInUrl','Title','Website','CompanyName']
-    final_df = filtered_df[columns_subset]
-    leads_final_df=final_df.copy()
-    leads_final_df['website'] = leads_final_df['Website'].apply(clean_url)
-    print("Loaded leads sheet, cleaned up the website urls to join on.")
-    print(leads_final_df.info())
-    downloaded_websites=set(sorted(websites_df["website"].to_list()))
-    lead_websites=set(sorted(leads_final_df["website"].to_list()))
-    print(f"No. of downloaded websites: {len(downloaded_websites)} No. of lead websites: {len(lead_websites)}")
-    leads_final_df = leads_final_df[leads_final_df['website'].isin(downloaded_websites)]
-    result_df = pd.merge(leads_final_df, websites_df, on='website', how='left')
-    result_df.to_excel('lead_website_contents_newrun.xlsx', index=False)
-    print("Lead website sheets concatenated with website content")
+    downloaded_websites = pd.Index(websites_df["website"].unique())
+    kept = ingest_leads("/Users/akshaymijar/icp-filtering/rb2b30cleaned.csv", downloaded_websites, store)
+    print(f"No. of downloaded websites: {len(downloaded_websites)} No. of lead rows matched: {kept}")
+    print("Lead rows written to the store, joined with website content on read")
+    if export_excel:
+        store.export_excel(store.read_lead_contents(), 'lead_website_contents_newrun.xlsx')
+    store.close()
+    print(f"Peak RSS {peak_rss_bytes() / 2 ** 20:.0f} MB, largest structures: {sizes()}")
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    profile = profiling.from_argv()
+    try:
+        main(export_excel='--excel' in sys.argv)
+    finally:
+        if profile:
+            profiling.write_report('profile_dataframing')
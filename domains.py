@@ -0,0 +1,89 @@
+import functools
+import re
+
+import pandas as pd
+import tldextract
+
+# Compiled once at import instead of once per row
+URL_RE = re.compile(
+    r'^(https?|ftp)://'  # http:// or https:// or ftp://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|'  # ...or ipv4
+    r'\[?[A-F0-9]*:[A-F0-9:]+\]?)'  # ...or ipv6
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+# Scheme, credentials, then the host up to the port, path, query or fragment
+HOST_RE = r'^(?:[a-z][a-z0-9+.-]*://)?(?:[^@/]*@)?([^:/?#]*)'
+
+# Private suffixes (e.g. wixsite.com, github.io) count as public suffixes so
+# that different customers of the same host don't share a key. The bundled
+# suffix list snapshot is used so keys don't depend on network access.
+_extract = tldextract.TLDExtract(suffix_list_urls=(),
+                                 include_psl_private_domains=True)
+
+
+@functools.lru_cache(maxsize=1 << 18)
+def registered_domain(host):
+    """ Registered domain of a host name, e.g.
+    'news.google.co.uk' -> 'google.co.uk'
+    Hosts without a known suffix (localhost, IPs) are returned unchanged.
+    """
+    ext = _extract(host)
+    if ext.domain and ext.suffix:
+        return f'{ext.domain}.{ext.suffix}'
+    return ext.domain or host
+
+
+def get_host(url):
+    """ Lowercased host of a url, without port and leading www.
+    """
+    host = re.match(HOST_RE, url.strip().lower()).group(1)
+    if host.startswith('www.'):
+        host = host[4:]
+    return host.rstrip('.')
+
+
+def domain_key(url):
+    """ Canonical site key of a url. It is the registered domain, so
+    acme.com and acme.io don't collide and blog.acme.com maps to acme.com.
+    Used as the scraped/<key> folder name and as the join key between
+    leads and crawled contents.
+    """
+    if not isinstance(url, str) or not url.strip():
+        return None
+    return registered_domain(get_host(url))
+
+
+def is_valid_url(url):
+    if isinstance(url, str):
+        return URL_RE.match(url) is not None
+    return False
+
+
+def valid_urls(series):
+    """ Vectorized is_valid_url over a pandas column
+    """
+    return series.astype('string').str.match(URL_RE).fillna(False).astype(bool)
+
+
+def domain_keys(series):
+    """ Vectorized domain_key over a pandas column.
+    Hosts are extracted with one regex pass, then each distinct host goes
+    through the memoized registered_domain only once. A categorical column
+    is resolved on its categories only.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = series.cat.categories
+        keys = domain_keys(pd.Series(categories, dtype=object))
+        return series.map(dict(zip(categories, keys))).astype(object)
+    hosts = (series.astype('string')
+             .str.strip()
+             .str.lower()
+             .str.extract(HOST_RE, expand=False)
+             .str.replace(r'^www\.', '', regex=True)
+             .str.rstrip('.'))
+    mapping = {host: registered_domain(host) for host in hosts.dropna().unique()
+               if host}
+    return hosts.map(mapping).astype(object).where(hosts.map(mapping).notna(), None)
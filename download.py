@@ -1,46 +1,23 @@
+import hashlib
+import json
 import os
 import logging
+import queue
+import ssl
 import sys
+import threading
 from urllib.parse import urlparse
 from urls import traverse_sitemap
-from crawl import download_pages
+from crawl import SiteBudget, download_page, download_pages
+from cleaner import clean_page
 from create import filter_files
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
-
-# Ensure the logs directory exists
-log_dir = 'logs'
-os.makedirs(log_dir, exist_ok=True)
-
-# Define log filename and path
-log_filename = datetime.now().strftime("script_%Y%m%d_%H%M%S.log")
-log_filepath = os.path.join(log_dir, log_filename)
-
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,  # Set to DEBUG for more granular logs
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filepath),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-
-# Redirect stdout and stderr to logging
-class StreamToLogger:
-    def __init__(self, logger, log_level=logging.INFO):
-        self.logger = logger
-        self.log_level = log_level
-
-    def write(self, buf):
-        for line in buf.rstrip().splitlines():
-            self.logger.log(self.log_level, line.rstrip())
-
-    def flush(self):
-        pass
-
-sys.stdout = StreamToLogger(logging.getLogger('STDOUT'), logging.INFO)
-sys.stderr = StreamToLogger(logging.getLogger('STDERR'), logging.ERROR)
+from domains import domain_key
+from logconfig import pool_kwargs, setup_logging
+from memory import MemoryMonitor, install_snapshot_signal, parse_size, record_size
+import profiling
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+logger = logging.getLogger('download')
 
 def is_top_level(url, domain):
     parsed_url = urlparse(url)
@@ -48,17 +25,18 @@ def is_top_level(url, domain):
     segments = path.split("/")
     return len(segments) == 1
 
-def process_website(website_url):
+def process_website(website_url, budget=None):
     try:
         website_url = website_url.strip()
         if not website_url:
-            logging.debug(f"Skipping empty website URL")
+            logger.debug("Skipping empty website URL")
             return
 
+        budget = SiteBudget(**{**SITE_BUDGET, **(budget or {})})
         sitemap_url = f"{website_url}/sitemap.xml"
-        urls = get_sitemap_urls(sitemap_url)
+        urls = get_sitemap_urls(sitemap_url, budget)
         if not urls:
-            logging.debug(f"No URLs found for {sitemap_url}")
+            logger.debug(f"No URLs found for {sitemap_url}")
             return
 
         domain = extract_domain(website_url)
@@ -68,24 +46,24 @@ def process_website(website_url):
         output_file_path = save_top_level_urls(top_level_urls, domain)
 
         download_folder = os.path.join('scraped', domain)
-        download_website_pages(output_file_path, download_folder, domain)
+        download_website_pages(output_file_path, download_folder, domain, budget)
 
         process_downloaded_files(download_folder)
     except Exception as e:
-        logging.critical(f"Critical error while processing {website_url}: {e}")
+        logger.critical(f"Critical error while processing {website_url}: {e}")
 
-def get_sitemap_urls(sitemap_url):
+def get_sitemap_urls(sitemap_url, budget=None):
     try:
-        urls = traverse_sitemap(sitemap_url)
+        urls = traverse_sitemap(sitemap_url, budget)
         if not urls:
-            logging.warning(f"No URLs found for {sitemap_url}")
+            logger.warning(f"No URLs found for {sitemap_url}")
         return urls
     except Exception as e:
-        logging.error(f"Failed to traverse sitemap {sitemap_url}: {e}")
-        return sitemap_url.split("/")[:-1]
+        logger.error(f"Failed to traverse sitemap {sitemap_url}: {e}")
+        return []
 
 def extract_domain(website_url):
-    return website_url.split(".")[-2]
+    return domain_key(website_url)
 
 def save_urls_to_file(urls, domain):
     file_path = os.path.join('websites', f'{domain}_urls.txt')
@@ -93,9 +71,9 @@ def save_urls_to_file(urls, domain):
         with open(file_path, 'w') as file:
             for url in urls:
                 file.write(url + "\n")
-        logging.info(f"URLs written to {file_path}")
+        logger.info(f"URLs written to {file_path}")
     except Exception as e:
-        logging.error(f"Failed to save URLs to {file_path}: {e}")
+        logger.error(f"Failed to save URLs to {file_path}: {e}")
 
 def filter_top_level_urls(urls, domain):
     top_level_urls = [url.strip() for url in urls if is_top_level(url, domain)]
@@ -107,21 +85,21 @@ def save_top_level_urls(top_level_urls, domain):
         with open(output_file_path, 'w') as output_file:
             for top_level_url in top_level_urls:
                 output_file.write(top_level_url + "\n")
-        logging.info(f"Top-level URLs written to {output_file_path}")
+        logger.info(f"Top-level URLs written to {output_file_path}")
         return output_file_path
     except Exception as e:
-        logging.error(f"Failed to save top-level URLs to {output_file_path}: {e}")
+        logger.error(f"Failed to save top-level URLs to {output_file_path}: {e}")
         return None
 
-def download_website_pages(output_file_path, download_folder, domain):
+def download_website_pages(output_file_path, download_folder, domain, budget=None):
     if output_file_path:
         try:
-            download_pages(output_file_path, download_folder, timeout=30, default_skip=True, extensions=[], domains=[])
-            logging.info(f"Downloaded pages for {domain} into {download_folder}")
+            download_pages(output_file_path, download_folder, timeout=30, default_skip=True, extensions=[], domains=[], budget=budget)
+            logger.info(f"Downloaded pages for {domain} into {download_folder}")
         except TimeoutError:
-            logging.error(f"Download timeout for {domain}")
+            logger.error(f"Download timeout for {domain}")
         except Exception as e:
-            logging.error(f"Failed to download pages for {domain}: {e}")
+            logger.error(f"Failed to download pages for {domain}: {e}")
 
 def process_downloaded_files(root_directory):
     for dirpath, _, filenames in os.walk(root_directory):
@@ -133,39 +111,315 @@ def process_downloaded_files(root_directory):
                 with open(output_file, 'w') as f:
                     for path in full_paths:
                         f.write(path + '\n')
-                filter_files(output_file, threshold=0.5, gran='word', n=8, capacity=100000000, error_rate=1e-7, header=0, interval=1000000)
-                logging.info(f"Filtered files for directory {dirpath} using filter_files.")
+                filter_files(output_file, threshold=0.5, gran='word', n=8, capacity=100000000, error_rate=1e-7, header=0, interval=1000000, min_entropy=0.5, entropy_n=3)
+                logger.info(f"Filtered files for directory {dirpath} using filter_files.")
+            except Exception as e:
+                logger.error(f"Failed to filter files in {dirpath}: {e}")
+
+# Workers per stage. Sitemap and fetch are I/O bound and run in threads,
+# clean and dedup are CPU bound and run in processes.
+STAGE_CONCURRENCY = {
+    'sitemap': 8,
+    'fetch': 32,
+    'clean': os.cpu_count() or 4,
+    'dedup': 2,
+}
+
+# Items waiting between stages. A full queue blocks the stage feeding it.
+STAGE_QUEUE_SIZE = {
+    'sitemap': 64,
+    'fetch': 512,
+    'clean': 64,
+    'dedup': 16,
+}
+
+# download_page codes other than 0 and the file the url is recorded in
+BAD_URL_FILES = {1: 'bad.urls', 2: 'non_ascii.urls', 3: 'connection.urls', 4: 'budget.urls'}
+
+# Most a single site may cost, from sitemap discovery to the last page.
+# A site that hits a limit keeps what it has and is recorded as partial.
+SITE_BUDGET = {
+    'seconds': 300,
+    'pages': 100,
+    'max_bytes': 50 * 1024 * 1024,
+}
+
+# RSS (this process and its pools) the crawl should stay under, in bytes.
+# The check is process-level: above MEMORY_HIGH_WATER of it, every new site
+# and fetch waits until memory goes down, for at most MEMORY_WAIT seconds
+# each, whichever site is using the memory. Waits are not charged to the
+# site's SITE_BUDGET seconds. None disables throttling.
+MEMORY_BUDGET = None
+MEMORY_HIGH_WATER = 0.85
+MEMORY_WAIT = 60
+
+class Stage:
+    """ A pool of threads taking items from a bounded queue.
+    For CPU-bound stages, each thread hands its item to a process pool of
+    the same size, so the stage never runs more than `workers` items.
+    """
+    def __init__(self, name, func, workers, maxsize, processes=False, memory=None):
+        self.name = name
+        self.func = func
+        self.memory = memory
+        self.peak_rss = 0
+        self.queue = queue.Queue(maxsize=maxsize)
+        # Workers log through the parent's listener
+        self.pool = ProcessPoolExecutor(max_workers=workers, **pool_kwargs()) if processes else None
+        self.threads = [threading.Thread(target=self._run, name=f'{name}-{i}', daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            key = (self.name, threading.get_ident())
+            if self.memory is not None:
+                self.memory.track(key)
+            try:
+                self.func(self, item)
             except Exception as e:
-                logging.error(f"Failed to filter files in {dirpath}: {e}")
+                logger.error("Stage %s failed on %s: %s", self.name, item[2] if isinstance(item, tuple) else item, e)
+            finally:
+                if self.memory is not None:
+                    self.peak_rss = max(self.peak_rss, self.memory.untrack(key))
+                self.queue.task_done()
+
+    def submit(self, fn, *args):
+        """ Run fn in the stage's process pool if it has one
+        """
+        if self.pool is None:
+            return fn(*args)
+        return profiling.call_in_pool(self.pool, fn, *args)
 
-def main():
+    def join(self):
+        self.queue.join()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+class SiteState:
+    """ Pages of one site still in flight. The site goes to the dedup stage
+    when its last page is written.
+    """
+    def __init__(self, website_url, domain, folder, budget=None):
+        self.website_url = website_url
+        self.domain = domain
+        self.folder = folder
+        self.budget = budget or SiteBudget()
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return self.website_url
+
+    def add_pages(self, count):
+        with self.lock:
+            self.pending += count
+
+    def page_done(self):
+        with self.lock:
+            self.pending -= 1
+            return self.pending == 0
+
+    def record(self, filename, link):
+        with self.lock:
+            with open(os.path.join(self.folder, filename), 'a') as f:
+                f.write(link + '\n')
+
+class CrawlPipeline:
+    """ download.main as four stages connected by bounded queues:
+    sitemap discovery -> page fetch -> HTML cleaning -> Bloom dedup.
+    Each stage is sized independently with STAGE_CONCURRENCY.
+
+    on_done(website_url, status) is called from a stage thread when a site
+    is finished, with status 'done', 'partial' (it ran out of budget) or
+    'empty' (no urls in the sitemap).
+
+    budget: overrides of SITE_BUDGET. Each site gets its own SiteBudget
+            when its sitemap discovery starts.
+    memory_budget: overrides MEMORY_BUDGET. RSS is sampled either way and
+            the process-wide peak while each site and stage was running is
+            logged. Sites share the process, so this is not what one site used.
+    """
+    def __init__(self, concurrency=None, queue_size=None, timeout=30, on_done=None, budget=None,
+                 memory_budget=None):
+        self.budget = {**SITE_BUDGET, **(budget or {})}
+        self.memory = MemoryMonitor(budget=memory_budget or MEMORY_BUDGET,
+                                    high_water=MEMORY_HIGH_WATER)
+        self.memory.start()
+        self.on_done = on_done or (lambda website_url, status: None)
+        concurrency = {**STAGE_CONCURRENCY, **(concurrency or {})}
+        queue_size = {**STAGE_QUEUE_SIZE, **(queue_size or {})}
+        self.timeout = timeout
+        self.ctx = ssl.create_default_context()
+        self.ctx.check_hostname = False
+        self.ctx.verify_mode = ssl.CERT_NONE
+        # Created downstream first so each stage can feed the next one
+        self.dedup = Stage('dedup', self._dedup, concurrency['dedup'], queue_size['dedup'], processes=True, memory=self.memory)
+        self.clean = Stage('clean', self._clean, concurrency['clean'], queue_size['clean'], processes=True, memory=self.memory)
+        self.fetch = Stage('fetch', self._fetch, concurrency['fetch'], queue_size['fetch'], memory=self.memory)
+        self.sitemap = Stage('sitemap', self._sitemap, concurrency['sitemap'], queue_size['sitemap'], memory=self.memory)
+        self.stages = [self.sitemap, self.fetch, self.clean, self.dedup]
+
+    def submit(self, website_url):
+        website_url = website_url.strip()
+        if website_url:
+            self.sitemap.put(website_url)
+
+    def drain(self):
+        """ Wait until every submitted site has gone through all stages
+        """
+        # Stages only feed downstream, so once a stage's queue is drained
+        # everything it will ever send to the next stage is queued.
+        for stage in self.stages:
+            stage.join()
+
+    def close(self):
+        for stage in self.stages:
+            stage.close()
+        self.memory.stop()
+        report = self.memory_report()
+        logger.info("Peak RSS %.0f MB", report['peak_bytes'] / 2 ** 20, extra={'memory': report})
+
+    def memory_report(self):
+        """ Peak RSS overall and per stage, and the largest structures seen
+        """
+        report = self.memory.summary()
+        report['stages'] = {stage.name: stage.peak_rss for stage in self.stages}
+        return report
+
+    def _finish(self, website_url, status):
+        peak = self.memory.untrack(website_url)
+        logger.debug("Peak process RSS %.0f MB while crawling %s", peak / 2 ** 20, website_url)
+        self.on_done(website_url, status)
+        return peak
+
+    def run(self, websites):
+        for website_url in websites:
+            self.submit(website_url)
+        self.drain()
+        self.close()
+
+    def _sitemap(self, stage, website_url):
+        # New sites are the work that grows memory the most, hold them first.
+        # The budget doesn't exist yet, so the wait isn't charged to it.
+        self.memory.wait_for_room(website_url, MEMORY_WAIT)
+        self.memory.track(website_url)
+        budget = SiteBudget(**self.budget)
+        urls = get_sitemap_urls(f"{website_url}/sitemap.xml", budget)
+        if not urls:
+            logger.debug("No URLs found for %s", website_url)
+            self._finish(website_url, 'partial' if budget.reason else 'empty')
+            return
+        domain = extract_domain(website_url)
+        save_urls_to_file(urls, domain)
+        top_level_urls = filter_top_level_urls(urls, domain)
+        save_top_level_urls(top_level_urls, domain)
+
+        folder = os.path.join('scraped', domain)
+        os.makedirs(folder, exist_ok=True)
+        index_file = os.path.join(folder, 'index.urls')
+        done = set()
+        if os.path.exists(index_file):
+            with open(index_file, 'r') as f:
+                done = set(line.strip() for line in f)
+        todo = [(idx, link) for idx, link in enumerate(top_level_urls) if link not in done]
+        if not todo:
+            self._finish(website_url, 'done')
+            return
+        site = SiteState(website_url, domain, folder, budget)
+        site.add_pages(len(todo))
+        for idx, link in todo:
+            self.fetch.put((site, idx, link))
+
+    def _fetch(self, stage, item):
+        site, idx, link = item
+        code, page = 1, ''
+        try:
+            if site.budget.take_page():
+                # Outside download_page, so the wait isn't charged to the site
+                self.memory.wait_for_room(link, MEMORY_WAIT)
+                code, page = download_page(link, self.ctx, self.timeout, budget=site.budget)
+                record_size('response', size=len(page))
+            else:
+                code = 4
+        finally:
+            if code > 0:
+                site.record(BAD_URL_FILES.get(code, 'bad.urls'), link)
+                self._page_done(site)
+        if code == 0:
+            self.clean.put((site, idx, link, page))
+
+    def _clean(self, stage, item):
+        site, idx, link, page = item
+        try:
+            # Pages already fetched are kept even when the budget ran out
+            txt = stage.submit(clean_page, page)
+            if not txt:
+                logger.debug('Empty page %s', link, extra={'site': site.domain})
+                site.record('empty.urls', link)
+                return
+            name = hashlib.sha1(link.encode()).hexdigest()
+            with open(os.path.join(site.folder, f'{idx}_{name}.txt'), 'w') as out:
+                out.write(link + '\n' + txt)
+            site.record('index.urls', link)
+        finally:
+            self._page_done(site)
+
+    def _page_done(self, site):
+        if site.page_done():
+            self.dedup.put(site)
+
+    def _dedup(self, stage, site):
+        stage.submit(process_downloaded_files, site.folder)
+        status = 'partial' if site.budget.reason else 'done'
+        usage = {'status': status, **site.budget.to_dict(),
+                 'process_peak_rss_bytes': self._finish(site.website_url, status)}
+        with open(os.path.join(site.folder, 'budget.json'), 'w') as f:
+            json.dump(usage, f)
+        logger.info("Finished %s", site.folder, extra={'stage': 'dedup', **usage})
+
+def main(concurrency=None, levels=None, memory_budget=None):
+    setup_logging('script', levels=levels)
+    # kill -USR1 <pid> writes a tracemalloc snapshot to logs/
+    install_snapshot_signal()
     try:
         os.makedirs('websites', exist_ok=True)
-        logging.info('Created "websites" directory.')
+        logger.info('Created "websites" directory.')
 
         os.makedirs('to_scrape', exist_ok=True)
-        logging.info('Created "to_scrape" directory.')
+        logger.info('Created "to_scrape" directory.')
 
         os.makedirs('scraped', exist_ok=True)
-        logging.info('Created "scraped" directory.')
+        logger.info('Created "scraped" directory.')
 
         with open('leads.txt', 'r') as infile:
             websites = infile.readlines()
 
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            futures = {executor.submit(process_website, website_url): website_url for website_url in websites}
-
-            for future in as_completed(futures):
-                website_url = futures[future]
-                try:
-                    future.result(timeout=60)  # Adding timeout for future results
-                except TimeoutError:
-                    logging.error(f"Processing of {website_url} timed out.")
-                except Exception as e:
-                    logging.error(f"Exception occurred while processing {website_url}: {e}")
+        CrawlPipeline(concurrency, memory_budget=memory_budget).run(websites)
 
     except Exception as main_e:
-        logging.critical(f"Critical error in the main script: {main_e}")
+        logger.critical(f"Critical error in the main script: {main_e}")
 
 if __name__ == "__main__":
-    main()
+    profile = profiling.from_argv()
+    memory_budget = next((parse_size(arg.split('=', 1)[1]) for arg in sys.argv
+                          if arg.startswith('--memory-budget=')), None)
+    try:
+        main(memory_budget=memory_budget)
+    finally:
+        if profile:
+            profiling.write_report('profile_download')
@@ -1,12 +1,28 @@
 from openai import OpenAI
 from dotenv import load_dotenv
 import os 
+import sys
 import json 
 import pandas as pd 
 from datetime import datetime
 import logging
 from collections import defaultdict
 
+import profiling
+from profiling import timed
+from store import Store
+from llm import LLMExecutor, RPM, TPM
+from batch import BatchRunner
+from llmcache import ResponseCache
+from journal import Journal
+from memory import peak_rss_bytes, sizeof
+from chunking import plan_chunks
+from merging import FAN_IN, SYNTH_TOKENS, group_extractions, premerge_extractions
+from scoring import (COMPANY_CRITERIA, company_profile, decision_makers, fit_key, format_lead_record,
+                     format_scoring, normalize_title, parse_category, title_fit_rule, validate_fit,
+                     validate_lead_records)
+from prefilter import screen
+
 logging.basicConfig(
     filename='logs/gpt4_usage.log',
     level=logging.INFO,
@@ -20,40 +36,88 @@ def log_gpt4_response(response):
     prompt_tokens = usage.prompt_tokens
     completion_tokens = usage.completion_tokens
     total_tokens = usage.total_tokens
+    # Prompt tokens served from the provider's prefix cache
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = (details.cached_tokens or 0) if details else 0
     log_data = {
         "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
         "completion_tokens": completion_tokens,
         "total_tokens": total_tokens,
+        "cache_hit": getattr(response, 'cache_hit', False),
         "content": content
     }
     logging.info(json.dumps(log_data, ensure_ascii=False))
 
-def format_data(client,data, fields=None):
-    fields = {
-        "About": "What does the company do?",
-        "Mission": "What problems do they solve for?",
-        "Products": "List of products mentioned",
-        "Pricing": "List of pricing tiers",
-        "Customers": "Information about customers, including names and industries",
-        "Testimonials": "Customer testimonials, including the name of the person providing the testimonial and their role if mentioned.",
-        "Industries & Segments": "Industries and market segments that the company focuses on"
-    }
+def message_content(response):
+    """ Stripped text of a response. Raise ValueError when the model
+    refused or sent no content.
+    """
+    message = response.choices[0].message
+    if getattr(message, 'refusal', None):
+        raise ValueError(f"Refused: {message.refusal}")
+    if message.content is None:
+        raise ValueError(f"No content (finish reason {response.choices[0].finish_reason})")
+    return message.content.strip()
+
+def complete_journaled(runner, journal, stage, requests, parse):
+    """ {key: parse(key, response)} of {key: chat completion kwargs}. Each
+    value is written to the journal (journal.Journal, or None) as soon as
+    its call returns, and requests already in it aren't sent again. A
+    response that parse rejects with ValueError is left out, like a failed
+    call, and dropped from the runner's response cache so that a rerun asks
+    again.
+    """
+    values = journal.completed(stage, requests) if journal is not None else {}
+    if values:
+        print(f"{stage}: {len(values)} of {len(requests)} calls done in an earlier run")
 
+    def record(key, response):
+        try:
+            values[key] = parse(key, response)
+        except ValueError as e:
+            print(f"{stage} {key}: {e}")
+            if runner.cache is not None:
+                runner.cache.invalidate(requests[key])
+            return
+        if journal is not None:
+            journal.record(stage, key, requests[key], values[key])
+
+    runner.complete_all(stage, {key: request for key, request in requests.items() if key not in values},
+                        on_result=record)
+    return {key: values[key] for key in requests if key in values}
+
+EXTRACTION_FIELDS = {
+    "About": "What does the company do?",
+    "Mission": "What problems do they solve for?",
+    "Products": "List of products mentioned",
+    "Pricing": "List of pricing tiers",
+    "Customers": "Information about customers, including names and industries",
+    "Testimonials": "Customer testimonials, including the name of the person providing the testimonial and their role if mentioned.",
+    "Industries & Segments": "Industries and market segments that the company focuses on"
+}
 
+def extraction_system_message(fields):
     field_instructions = "\n".join([f"{field}: {description}" for field, description in fields.items()])
 
-    system_message = f"""You are an intelligent web data extraction agent. Your task is to perform extractive question answering on the input website text corpus and extract the following fields: {fields.keys()} into JSON format. The JSON should strictly contain only the relevant information extracted from the input website text, 
+    return f"""You are an intelligent web data extraction agent. Your task is to perform extractive question answering on the input website text corpus and extract the following fields: {fields.keys()} into JSON format. The JSON should strictly contain only the relevant information extracted from the input website text, 
     with no additional commentary, explanations, or extraneous information. In case you can't find the answer to any of the required fields, answer as null.
     Please process the following text and provide the output in pure JSON format with no words before or after the JSON.
     Extract the following information with these descriptions:
     {field_instructions}"""
 
+def format_data_request(data, fields=None):
+    """ Chat completion arguments of the extraction of one content chunk
+    """
+    fields = EXTRACTION_FIELDS
+
+    system_message = extraction_system_message(fields)
 
     user_message = f"Page content:\n\n{data}\n\nInformation to extract: {fields}"
 
 
 
-    response = client.chat.completions.create(
+    return dict(
         model="gpt-4o-2024-08-06",
         response_format={ "type": "json_object"},
         messages=[
@@ -68,9 +132,10 @@ def format_data(client,data, fields=None):
         ]
     )
 
+def parse_format_data(response):
     if response and response.choices:
         log_gpt4_response(response)
-        formatted_data = response.choices[0].message.content.strip()
+        formatted_data = message_content(response)
         print(f"Formatted data received from API: {formatted_data}")
 
         try:
@@ -83,27 +148,129 @@ def format_data(client,data, fields=None):
         return parsed_json
     else:
         raise ValueError("The OpenAI API response did not contain the expected choices data.")
+
+@timed('format_data')
+def format_data(llm,data, fields=None):
+    return parse_format_data(llm.create(**format_data_request(data, fields)))
+
+def format_sites_request(sites, fields=None):
+    """ Extraction of several small sites ({website: content}) in one call,
+    answered as a JSON object keyed by website
+    """
+    fields = EXTRACTION_FIELDS
+
+    system_message = extraction_system_message(fields) + """
+    The input holds the text of several websites, each under a '### Website:' heading. Extract the fields of each website from its own text only, and answer with one JSON object whose keys are the website names exactly as given and whose values are the extracted fields of that website."""
+
+    pages = "\n\n".join(f"### Website: {website}\n\n{content}" for website, content in sites.items())
+    user_message = f"Websites content:\n\n{pages}\n\nInformation to extract for each website: {fields}"
+
+    return dict(
+        model="gpt-4o-2024-08-06",
+        response_format={ "type": "json_object"},
+        messages=[
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_message}
+        ]
+    )
+
+def parse_extraction_call(key, response):
+    """ [website, chunk, extraction] of each site chunk of an extraction
+    call. key: the (website, chunk) pairs of the call.
+    """
+    if len(key) == 1:
+        return [[*key[0], parse_format_data(response)]]
+    extractions = parse_format_sites(response, [website for website, _ in key])
+    return [[website, chunk, extractions[website]] for website, chunk in key if website in extractions]
+
+def parse_format_sites(response, websites):
+    """ {website: extraction} of a format_sites_request. Websites missing
+    from the answer are left out.
+    """
+    parsed_json = parse_format_data(response)
+    extractions = {}
+    for website in websites:
+        if isinstance(parsed_json.get(website), dict):
+            extractions[website] = parsed_json[website]
+        else:
+            print(f"No extraction for {website} in packed response")
+    return extractions
     
 
-def synthesize_context(client,context_list):
+def synthesize_context_request(context_list):
     combined_input = "\n\n".join(str(obj) for obj in context_list)
     messages = [
         {"role": "system", "content": "You are a helpful assistant."},
         {"role": "user", "content": f"Synthesise the following JSON object attribute-wise without missing any attribute:\n\n{combined_input}\n\nOutput the consolidated attributes."}
     ]
     
-    response = client.chat.completions.create(
+    return dict(
         model="gpt-4o-2024-08-06",
         response_format={ "type": "json_object"},
         messages=messages
     )
+
+def parse_synthesize_context(response):
     log_gpt4_response(response)
-    synthesized_context = response.choices[0].message.content.strip()
+    synthesized_context = message_content(response)
     print(synthesized_context)
+    try:
+        json.loads(synthesized_context)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"The synthesized context is not JSON: {e}")
     return synthesized_context
+
+@timed('synthesize_context')
+def synthesize_context(llm,context_list):
+    return parse_synthesize_context(llm.create(**synthesize_context_request(context_list)))
+
+def synthesize_contexts(runner, extractions, fan_in=FAN_IN, max_tokens=SYNTH_TOKENS, journal=None):
+    """ {website: [extraction]} -> {website: synthesized context} by a tree
+    reduce. Each level merges the extractions of every site in groups of
+    up to fan_in (premerge_extractions first, then one synthesis call per
+    group), all sent together, and the group results are the input of the
+    next level. A site is done when one group is left, so the number of
+    levels grows with log(chunks) and no call gets more than max_tokens of
+    extractions. A call that fails or doesn't answer JSON is replaced by
+    the local merge of its group, so every site gets a context.
+    """
+    pending = {website: items for website, items in extractions.items() if items}
+    contexts = {}
+    level = 0
+    while pending:
+        groups = {}
+        for website, items in pending.items():
+            groups[website] = group_extractions(items, fan_in, max_tokens)
+            if 1 < len(items) == len(groups[website]):
+                # Every item is over max_tokens: merge them anyway rather than loop
+                groups[website] = group_extractions(items, fan_in, float('inf'))
+        requests = {(website, level, i): synthesize_context_request([premerge_extractions(group)])
+                    for website, site_groups in groups.items() for i, group in enumerate(site_groups)}
+        if level:
+            print(f"Synthesis level {level}: {len(requests)} calls for {len(pending)} sites")
+        results = complete_journaled(runner, journal, 'synthesize_context', requests,
+                                     lambda key, response: parse_synthesize_context(response))
+        merged = defaultdict(list)
+        for (website, _, i), request in requests.items():
+            group = groups[website][i]
+            if len(groups[website]) == 1:
+                # A failed or unreadable last call leaves the site its local merge
+                if (website, level, i) in results:
+                    contexts[website] = results[(website, level, i)]
+                else:
+                    contexts[website] = json.dumps(premerge_extractions(group), ensure_ascii=False)
+                continue
+            # A failed or unreadable group goes up as its local merge
+            if (website, level, i) in results:
+                merged[website].append(json.loads(results[(website, level, i)]))
+            else:
+                merged[website].append(premerge_extractions(group))
+        pending = dict(merged)
+        level += 1
+    return contexts
     
 
-def generate_icps(client,consolidated_context_object):
+def generate_icps(llm,consolidated_context_object):
     icp_prompt = f"""
     Given the following information about a company, please identify the ideal customer profiles (ICPs) for the company's products. The company offers a range of products and services described in the provided contextualization. The goal is to derive profiles that would most benefit from the company's ability to solve specific challenges and enhance certain operations, allowing businesses to focus on their core objectives.
 
@@ -120,13 +287,12 @@ def generate_icps(client,consolidated_context_object):
 
     Contextualization Object: {consolidated_context_object}
     """
-    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
     icp_messages = [
         {"role": "system", "content": "You are an expert in sales and marketing."},
         {"role": "user", "content": icp_prompt}
     ]
 
-    icp_response = client.chat.completions.create(
+    icp_response = llm.create(
         model="gpt-4o-2024-08-06",
         response_format={ "type": "json_object"},
         messages=icp_messages
@@ -223,6 +389,208 @@ Provide a detailed analysis of the lead’s fit, including:
     return prompt
 
 
+def context_markdown(context):
+    return "\n".join(f"- **{key}:** {safe_extract(context, key)}"
+                     for key in ['About', 'Mission', 'Products', 'Pricing', 'Customers',
+                                 'Testimonials', 'Industries & Segments'])
+
+def generate_icp_scoring_instructions(icps, company_context):
+    """ Static part of the scoring prompt: instructions, the seller's
+    context and the ICPs. It doesn't depend on the lead, so build it once
+    and send it first in every scoring call. The provider caches a prompt
+    prefix that is byte-identical between calls (from 1024 tokens), so
+    only the lead fields after it are billed and processed in full.
+    """
+    seller = context_markdown(company_context)
+    return f"""You are an expert B2B sales analyst specializing in lead filtering for a company. The company, described below, provides solutions that require alignment with specific Ideal Customer Profiles (ICPs).
+
+### Company Context (Phyllo):
+{seller}
+
+### ICPs:
+Each ICP has an Industry/Segment, Pain Points, Company Size/Type and Decision-Makers.
+{json.dumps(icps, indent=2, sort_keys=True, ensure_ascii=False)}
+
+Your task is to assess a lead’s fit against the provided ICPs and the company's context. The next message describes the lead: the Lead Context Object of the lead's company and the lead's LinkedIn Profile Information.
+
+### Task:
+1. **Industry/Segment Match:**
+   - Assess whether the lead's industry or segment directly relates to Phyllo’s target industries and segments. Assign a "High Match," "Partial Match," or "No Match" accordingly.
+
+2. **Pain Points Evaluation:**
+   - Identify if the lead's pain points are directly related to challenges that can be addressed by Phyllo’s products and services. Be specific about which pain points are aligned and how.
+
+3. **Company Size/Type Compatibility:**
+   - Evaluate whether the lead’s company size and type match the specifications in the ICPs and Phyllo's ideal customer context (e.g., small agencies scaling operations, large platforms requiring data integration).
+
+4. **Decision-Maker Role Assessment:**
+   - Compare the roles mentioned in the lead’s context (e.g., from testimonials or inferred from company structure) with the decision-makers listed in the ICPs. Use the LinkedIn profile title and summary to assess alignment. Provide a judgment on alignment (e.g., "Exact Match," "Similar Role," "Different Role").
+
+5. **Overall Fit Scoring and Categorization:**
+   - Based on the evaluations, assign a detailed score (e.g., 1-5) for each criterion (Industry/Segment, Pain Points, Size/Type, Decision-Makers). Calculate an overall fit score and categorize the lead as "High Fit," "Moderate Fit," or "Low Fit."
+
+### Output:
+Provide a detailed analysis of the lead’s fit, including:
+- **Matching ICP(s):** Specify which ICP(s) the lead aligns with and the level of alignment.
+- **Fit Scores:** A detailed score for each criterion and an overall fit score.
+- **Categorization:** Clear categorization of the lead as "High Fit," "Moderate Fit," or "Low Fit."
+- **Rationale:** Provide a concise explanation for each score and the overall categorization.
+- **Recommended Next Steps:** Suggest specific actions based on the categorization (e.g., "Proceed to outreach," "Conduct further research," "Deprioritize")."""
+
+def generate_icp_lead_prompt(lead_context, linkedin_data):
+    """ Per-lead part of the scoring prompt, sent after
+    generate_icp_scoring_instructions
+    """
+    return f"""### Lead Context Object:
+- **About:** {safe_extract(lead_context, 'About')}
+- **Mission:** {safe_extract(lead_context, 'Mission')}
+- **Products:** {safe_extract(lead_context, 'Products')}
+- **Pricing:** {safe_extract(lead_context, 'Pricing')}
+- **Customers:** {safe_extract(lead_context, 'Customers')}
+- **Testimonials:** {safe_extract(lead_context, 'Testimonials')}
+- **Industries & Segments:** {safe_extract(lead_context, 'Industries & Segments')}
+
+### LinkedIn Profile Information:
+- **Job Title:** {linkedin_data['job_title']}
+- **Headline:** {linkedin_data['headline']}
+- **Summary:** {linkedin_data['summary']}
+- **Company Name:** {linkedin_data['company_name']}
+- **Company Industry:** {linkedin_data['company_industry']}"""
+
+def generate_company_fit_instructions(icps, company_context):
+    """ Static part of the company-level scoring prompt, sent first in
+    every company call like generate_icp_scoring_instructions
+    """
+    return f"""You are an expert B2B sales analyst specializing in lead filtering for a company. The company, described below, provides solutions that require alignment with specific Ideal Customer Profiles (ICPs).
+
+### Company Context (Phyllo):
+{context_markdown(company_context)}
+
+### ICPs:
+{json.dumps(icps, indent=2, sort_keys=True, ensure_ascii=False)}
+
+Your task is to assess how well a lead's company fits the ICPs and the company's context. The next message describes the lead's company. The person at the company is assessed separately, so only judge the company.
+
+### Task:
+1. **Industry/Segment Match:** Assess whether the company's industry or segment directly relates to Phyllo’s target industries and segments. Assign a "High Match," "Partial Match," or "No Match" accordingly.
+2. **Pain Points Evaluation:** Identify if the company's likely pain points are directly related to challenges that can be addressed by Phyllo’s products and services.
+3. **Company Size/Type Compatibility:** Evaluate whether the company's size and type match the specifications in the ICPs.
+
+Score each criterion from 1 (no fit) to 5 (perfect fit).
+
+### Output:
+Answer with a JSON object with these keys:
+- "Matching ICPs": list of the "Industry/Segment" values of the ICPs the company aligns with, possibly empty
+- "Industry/Segment": {{"Match": "High Match" | "Partial Match" | "No Match", "Score": 1-5, "Rationale": one sentence}}
+- "Pain Points": {{"Score": 1-5, "Rationale": one sentence}}
+- "Size/Type": {{"Score": 1-5, "Rationale": one sentence}}"""
+
+def company_fit_request(instructions, profile):
+    """ instructions: generate_company_fit_instructions. profile:
+    scoring.company_profile of the company.
+    """
+    return dict(
+        model="gpt-4o-2024-08-06",
+        response_format={ "type": "json_object"},
+        messages=[
+            {"role": "system", "content": "You are a B2B sales expert with a deep understanding of SaaS products."},
+            {"role": "user", "content": instructions},
+            {"role": "user", "content": f"### Lead Company:\n{json.dumps(profile, indent=2, sort_keys=True, ensure_ascii=False)}"}
+        ]
+    )
+
+def title_fit_request(title, roles):
+    """ Decision-maker fit of one normalized job title against the
+    normalized decision-makers of the company's matching ICPs
+    """
+    prompt = f"""Decision-makers we sell to: {', '.join(roles)}.
+Job title of a lead: {title}
+
+Does the lead hold one of these roles, a similar role with a say in buying (e.g. the same function at another level), or a different role?
+Answer with a JSON object: {{"Match": "Exact Match" | "Similar Role" | "Different Role", "Score": 1-5, "Rationale": one sentence}}"""
+    return dict(
+        model="gpt-4o-2024-08-06",
+        response_format={ "type": "json_object"},
+        max_tokens=150,
+        messages=[
+            {"role": "system", "content": "You are a B2B sales expert with a deep understanding of SaaS products."},
+            {"role": "user", "content": prompt}
+        ]
+    )
+
+def parse_fit(response, criteria=None):
+    """ JSON answer of a company_fit_request (with COMPANY_CRITERIA) or
+    title_fit_request. Raise ValueError when it isn't JSON or misses a
+    score, see scoring.validate_fit.
+    """
+    log_gpt4_response(response)
+    try:
+        fit = json.loads(message_content(response))
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Fit is not JSON: {e}")
+    return validate_fit(fit, criteria)
+
+def score_by_company(runner, store, merged_df, journal=None):
+    """ {row index: ICP Scoring} of merged_df with one LLM call per unique
+    company profile and per unique (decision-makers, title) the local
+    rules can't settle, instead of one call per lead.
+
+    Company fits are memoized on scoring.fit_key of the profile and the
+    fit instructions, and title fits on (fit key, normalized title), in
+    the company_fits and title_fits tables, so a later run only asks about
+    new companies and titles, or about all of them when the ICPs changed.
+    A fit that fails is not stored and its leads are left unscored.
+    """
+    company_fits = {key: json.loads(fit) for key, fit in
+                    store.read('company_fits').itertuples(index=False)}
+    title_fits = {(key, title): json.loads(fit) for key, title, fit in
+                  store.read('title_fits').itertuples(index=False)}
+
+    instructions = generate_company_fit_instructions(icps, company_context)
+    leads = {}
+    profiles = {}
+    for index, row in zip(merged_df.index, merged_df.to_dict('records')):
+        context_value = row["Context"]
+        if context_value is not None and not pd.isna(context_value):
+            lead_context = json.loads(context_value)
+        else:
+            lead_context = {}
+        profile = company_profile(lead_context, row.get("CompanyName", "N/A"), row.get("Industry", "N/A"))
+        key = fit_key(instructions, profile)
+        profiles[key] = profile
+        leads[index] = (key, normalize_title(row.get("Title")))
+    print(f"Scoring {len(leads)} leads: {len(profiles)} companies, "
+          f"{len(set(leads.values()))} company and title pairs")
+
+    requests = {key: company_fit_request(instructions, profile)
+                for key, profile in profiles.items() if key not in company_fits}
+    for key, fit in complete_journaled(runner, journal, 'company_fit', requests,
+                                       lambda key, response: parse_fit(response, COMPANY_CRITERIA)).items():
+        company_fits[key] = fit
+        store.append('company_fits', {'context_hash': key, 'fit': json.dumps(company_fits[key])})
+
+    # Titles the rules can't settle, asked once per set of decision-makers
+    asked = defaultdict(list)
+    for key, title in set(leads.values()):
+        if (key, title) in title_fits or key not in company_fits:
+            continue
+        roles = decision_makers(icps, company_fits[key].get('Matching ICPs'))
+        fit = title_fit_rule(title, roles)
+        if fit is None:
+            asked[(tuple(roles), title)].append(key)
+        else:
+            title_fits[(key, title)] = fit
+    requests = {question: title_fit_request(question[1], question[0]) for question in asked}
+    for question, fit in complete_journaled(runner, journal, 'title_fit', requests,
+                                            lambda key, response: parse_fit(response)).items():
+        for key in asked[question]:
+            title_fits[(key, question[1])] = fit
+            store.append('title_fits', {'context_hash': key, 'title': question[1], 'fit': json.dumps(fit)})
+
+    return {index: format_scoring(company_fits[key], title_fits[(key, title)])
+            for index, (key, title) in leads.items()
+            if key in company_fits and (key, title) in title_fits}
+
 
 # def generate_icp_filtering_prompt(icps, lead_context, linkedin_data, company_context):
 #     # Safely extract LinkedIn-related data
@@ -647,20 +1015,238 @@ icps = [
 
 
 
-def filter_lead_with_gpt(client,prompt):
-    response = client.chat.completions.create(
+def filter_lead_request(prompt, instructions=None):
+    """ instructions: generate_icp_scoring_instructions, sent between the
+    system message and the prompt (then generate_icp_lead_prompt)
+    """
+    messages = [{"role": "system", "content": "You are a B2B sales expert with a deep understanding of SaaS products."}]
+    if instructions is not None:
+        messages.append({"role": "user", "content": instructions})
+    messages.append({"role": "user", "content": prompt})
+    return dict(
+        model="gpt-4o-2024-08-06",
+        messages=messages
+    )
+
+def parse_filter_lead(response):
+    log_gpt4_response(response)
+    return message_content(response)
+
+@timed('filter_lead_with_gpt')
+def filter_lead_with_gpt(llm,prompt,instructions=None):
+    return parse_filter_lead(llm.create(**filter_lead_request(prompt, instructions)))
+
+# Leads scored by one call of score_in_groups
+LEADS_PER_CALL = 20
+
+LEAD_SCORES_SCHEMA = {
+    "name": "lead_scores",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "leads": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "string"},
+                        "matching_icps": {"type": "array", "items": {"type": "string"}},
+                        "industry_segment": {"type": "integer"},
+                        "pain_points": {"type": "integer"},
+                        "size_type": {"type": "integer"},
+                        "decision_makers": {"type": "integer"},
+                        "overall": {"type": "number"},
+                        "category": {"type": "string", "enum": ["High Fit", "Moderate Fit", "Low Fit"]},
+                        "rationale": {"type": "string"}
+                    },
+                    "required": ["id", "matching_icps", "industry_segment", "pain_points", "size_type",
+                                 "decision_makers", "overall", "category", "rationale"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["leads"],
+        "additionalProperties": False
+    }
+}
+
+def lead_scores_request(instructions, leads):
+    """ Scoring of several leads in one call. leads: {lead id: (lead
+    context, linkedin data)}. The context of a company is written once
+    for all its leads.
+    """
+    companies = {}
+    for lead_id, (lead_context, linkedin_data) in leads.items():
+        name = linkedin_data['company_name']
+        companies.setdefault((name, json.dumps(lead_context, sort_keys=True)), (name, lead_context, []))[2].append(
+            f"""#### Lead {lead_id}
+- **Job Title:** {linkedin_data['job_title']}
+- **Headline:** {linkedin_data['headline']}
+- **Summary:** {linkedin_data['summary']}
+- **Company Name:** {linkedin_data['company_name']}
+- **Company Industry:** {linkedin_data['company_industry']}""")
+    sections = [f"### Company: {name}\n\nLead Context Object:\n{context_markdown(lead_context)}\n\n" + "\n\n".join(lead_texts)
+                for name, lead_context, lead_texts in companies.values()]
+    prompt = (f"Score each of the {len(leads)} leads below separately, following the task above. Instead of a "
+              "detailed analysis, answer with one record per lead id: the Industry/Segment of its matching ICPs, a score "
+              "from 1 to 5 for each criterion, the overall score, the categorization and a one-sentence rationale.\n\n"
+              + "\n\n".join(sections))
+    return dict(
         model="gpt-4o-2024-08-06",
+        response_format={"type": "json_schema", "json_schema": LEAD_SCORES_SCHEMA},
         messages=[
             {"role": "system", "content": "You are a B2B sales expert with a deep understanding of SaaS products."},
+            {"role": "user", "content": instructions},
             {"role": "user", "content": prompt}
         ]
     )
-    log_gpt4_response(response)
-    return response.choices[0].message.content.strip()
 
-def main():
+def parse_lead_scores(response, ids):
+    """ {lead id: record} of a lead_scores_request. Raise ValueError when
+    the answer doesn't validate.
+    """
+    log_gpt4_response(response)
+    try:
+        data = json.loads(message_content(response))
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Not JSON: {e}")
+    return validate_lead_records(data, ids)
+
+def score_in_groups(runner, merged_df, leads_per_call=LEADS_PER_CALL, journal=None):
+    """ {row index: ICP Scoring} of merged_df with leads_per_call leads per
+    call, after the shared instructions of generate_icp_scoring_instructions.
+    Leads of a company go to the same call where possible. A call whose
+    answer fails validation is split in two and sent again, down to a
+    single lead; a single lead that still fails is left unscored.
+
+    Each call is keyed (and journaled) by the sorted (LinkedInUrl,
+    website) of its leads, so a rerun finds the groups it already scored
+    even when other leads were added or dropped.
+    """
+    instructions = generate_icp_scoring_instructions(icps, company_context)
+    leads = {}
+    lead_keys = {}
+    for index, row in zip(merged_df.index, merged_df.to_dict('records')):
+        context_value = row["Context"]
+        if context_value is not None and not pd.isna(context_value):
+            lead_context = json.loads(context_value)
+        else:
+            lead_context = {}
+        linkedin_data = {
+            "job_title": row.get("Title", "N/A"),
+            "headline": row.get("headline", "N/A"),
+            "summary": row.get("summary", "N/A"),
+            "company_name": row.get("CompanyName", "N/A"),
+            "company_industry": row.get("Industry", "N/A")
+        }
+        leads[index] = (row["website"], lead_context, linkedin_data)
+        lead_keys[index] = (row["LinkedInUrl"], row["website"])
+    order = sorted(leads, key=lambda index: str(leads[index][0]))
+    pending = [order[i:i + leads_per_call] for i in range(0, len(order), leads_per_call)]
+    scores = {}
+    while pending:
+        requests, ids = {}, {}
+        for group in pending:
+            key = tuple(sorted((lead_keys[index] for index in group), key=str))
+            ids[key] = {f"L{n + 1}": index for n, index in enumerate(group)}
+            requests[key] = lead_scores_request(
+                instructions, {lead_id: leads[index][1:] for lead_id, index in ids[key].items()})
+        results = complete_journaled(runner, journal, 'score_leads', requests,
+                                     lambda key, response: parse_lead_scores(response, ids[key]))
+        retry = []
+        for key, group in zip(requests, pending):
+            if key in results:
+                for lead_id, record in results[key].items():
+                    scores[ids[key][lead_id]] = format_lead_record(record)
+            elif len(group) > 1:
+                print(f"Scoring {len(group)} leads failed, splitting")
+                retry += [group[:len(group) // 2], group[len(group) // 2:]]
+            else:
+                print(f"Scoring lead {group[0]} failed")
+        pending = retry
+    return scores
+
+PREFILTER_RATIONALE = "Pre-filter:"
+
+def prefilter_leads(store, merged_df):
+    """ {row index: ICP Scoring} of the leads of merged_df that the local
+    pre-filter (prefilter.screen) finds a Low Fit, so they aren't sent to
+    the LLM. The threshold is calibrated on the LLM scores of earlier runs
+    in the scores table.
+    """
+    contexts = [json.loads(context_value) if context_value is not None and not pd.isna(context_value) else {}
+                for context_value in merged_df["Context"]]
+    positions = {key: i for i, key in enumerate(zip(merged_df["LinkedInUrl"], merged_df["website"]))}
+    labels = {}
+    for linkedin_url, website, score in store.read('scores').itertuples(index=False):
+        category = parse_category(score)
+        if category and PREFILTER_RATIONALE not in score and (linkedin_url, website) in positions:
+            labels[positions[(linkedin_url, website)]] = category != "Low Fit"
+    rejected = screen(contexts, list(merged_df["Title"]), icps, labels, fields=EXTRACTION_FIELDS)
+    return {merged_df.index[i]: f"**Categorization:** Low Fit\n**Rationale:** {PREFILTER_RATIONALE} {reason}"
+            for i, reason in rejected.items()}
+
+def score_per_lead(runner, merged_df, stable_prompt=True, journal=None):
+    """ {row index: ICP Scoring} of merged_df with one full scoring call
+    per lead
+    """
+    score_requests = {}
+    rows = {}
+    instructions = generate_icp_scoring_instructions(icps, company_context) if stable_prompt else None
+    for index, row in zip(merged_df.index, merged_df.to_dict('records')):
+        context_value = row["Context"]
+        if context_value is not None and not pd.isna(context_value):
+            lead_context = json.loads(context_value)
+        else:
+            lead_context = {}
+        linkedin_data = {
+            "job_title": row.get("Title", "N/A"),
+            "headline": row.get("headline", "N/A"),
+            "summary": row.get("summary", "N/A"),
+            "company_name": row.get("CompanyName", "N/A"),
+            "company_industry": row.get("Industry", "N/A")
+        }
+        if stable_prompt:
+            prompt = generate_icp_lead_prompt(lead_context, linkedin_data)
+        else:
+            prompt = generate_icp_filtering_prompt(icps, lead_context, linkedin_data, company_context)
+        key = (row["LinkedInUrl"], row["website"])
+        score_requests[key] = filter_lead_request(prompt, instructions)
+        rows[key] = index
+    return {rows[key]: score for key, score in complete_journaled(
+        runner, journal, 'filter_lead_with_gpt', score_requests,
+        lambda key, response: parse_filter_lead(response)).items()}
+
+def main(export_excel=False, batch=False, stable_prompt=True, per_lead=False, leads_per_call=None,
+         prefilter=True, resume=True):
+    """ batch: run the three stages through the Batch API instead of
+    synchronous calls. Cheaper and with separate limits, but each stage
+    may take hours to come back.
+    stable_prompt: send the instructions, seller context and ICPs first,
+    identical for every lead, and the lead last, so the provider's prompt
+    cache serves the shared prefix. False scores with the one-piece
+    generate_icp_filtering_prompt.
+    per_lead: score each lead with one full call (with the stable_prompt
+    layout) instead of score_by_company.
+    leads_per_call: score this many leads per call with JSON output
+    (score_in_groups) instead of score_by_company.
+    prefilter: mark the leads that clearly don't fit as Low Fit locally
+    (prefilter_leads) and only send the rest to the LLM.
+    resume: skip the extraction, synthesis and scoring calls that an
+    earlier, interrupted run wrote to the journal (journal.Journal).
+    False starts a new journal.
+    """
     load_dotenv()
-    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    # Retries are done by the executor so they respect the rate limits
+    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+    # Calls already answered in an earlier run are never sent again
+    cache = ResponseCache()
+    llm = LLMExecutor(client, rpm=int(os.getenv('OPENAI_RPM', RPM)),
+                      tpm=int(os.getenv('OPENAI_TPM', TPM)), cache=cache)
+    runner = BatchRunner(client, cache=cache) if batch else llm
+    # Every completed call is journaled, so a crash only loses the calls in flight
+    journal = Journal(resume=resume)
     # iiq_df=pd.read_csv("iiq.csv")
     # x=format_data(client,iiq_df["content"][0])
     # file_path = "iiq.json"
@@ -668,50 +1254,76 @@ def main():
     #     json.dump(x, file, indent=4)
     # with open('iiq.json', 'r') as file:
     #     data = json.load(file)
-    # generate_icps(client,data)
-    lead_website_contents_df=pd.read_excel("/Users/akshaymijar/icp-filtering/lead_website_contents_newrun.xlsx")
+    # generate_icps(llm,data)
+    store = Store()
+    site_contents_df = store.read('site_contents', columns=['website', 'content'],
+                                   where='website IN (SELECT website FROM leads)')
+    print(f"Site contents: {len(site_contents_df)} sites, {sizeof(site_contents_df) / 2 ** 20:.1f} MB")
+    # Big sites are split between paragraphs, small ones share a call
+    extraction_calls = plan_chunks(dict(site_contents_df.itertuples(index=False)))
+    extraction_requests={}
+    for units in extraction_calls:
+        key = tuple((website, chunk) for website, chunk, _ in units)
+        if len(units) == 1:
+            extraction_requests[key] = format_data_request(units[0][2])
+        else:
+            extraction_requests[key] = format_sites_request({website: text for website, _, text in units})
+    print(f"Extraction: {len(site_contents_df)} sites in {len(extraction_requests)} calls")
     responses=defaultdict(list)
-    for index, row in lead_website_contents_df.iterrows():
-        website=row["website"]
-        content=row["content"]
-        length=100000
-        for i in range(0,len(content),length):
-            responses[website].append(format_data(client=client,data=content[i:i+length]))
+    for extractions in complete_journaled(runner, journal, 'format_data', extraction_requests,
+                                          parse_extraction_call).values():
+        for website, chunk, extraction in extractions:
+            responses[website].append(extraction)
+            store.append('extractions', {'website': website, 'chunk': chunk, 'data': extraction})
     print("Extractive QA done")
     file_path = "responses_output.json"
     with open(file_path, 'w') as file:
         json.dump(responses, file, indent=4)
-    lead_contexts={}
-    for website in responses:
-        lead_contexts[website]=synthesize_context(client,responses[website])
+    lead_contexts=synthesize_contexts(runner, responses, journal=journal)
+    for website, context in lead_contexts.items():
+        store.append('contexts', {'website': website, 'context': context})
     file_path = "output.json"
     with open(file_path, 'w') as file:
         json.dump(lead_contexts, file, indent=4)
-    lead_contexts_df = pd.DataFrame(lead_contexts.items(), columns=['Lead', 'Context'])
-    lead_contexts_df.to_excel('lead_contexts.xlsx', index=False)
     print("Synthesizing context and writing to file done. ")
-    lead_contexts_df=pd.read_excel("/Users/akshaymijar/icp-filtering/lead_contexts.xlsx")
-    merged_df = pd.concat([lead_website_contents_df, lead_contexts_df], axis=1)
+    leads_df = store.read_lead_contents(with_content=False)
+    for column in ['Title', 'CompanyName', 'Industry', 'website']:
+        leads_df[column] = leads_df[column].astype('category')
+    contexts_df = store.read('contexts')
+    merged_df = pd.merge(leads_df, contexts_df.rename(columns={'context': 'Context'}), on='website', how='left')
     merged_df['ICP Scoring'] = None
-    for index, row in merged_df.iterrows():
-        context_value = row["Context"]
-        if context_value is not None and not pd.isna(context_value):
-            lead_context = json.loads(context_value)
-        else:
-            lead_context = {}
-        linkedin_data = {
-            "job_title": row.get("Title", "N/A"),
-            "headline": row.get("headline", "N/A"),
-            "summary": row.get("summary", "N/A"),
-            "company_name": row.get("CompanyName", "N/A"),
-            "company_industry": row.get("Industry", "N/A")
-        }
-        prompt = generate_icp_filtering_prompt(icps, lead_context, linkedin_data, company_context)
-        result = filter_lead_with_gpt(client=client,prompt=prompt)
+    print(f"Leads to score: {len(merged_df)} rows, {sizeof(merged_df) / 2 ** 20:.1f} MB")
+    scores = prefilter_leads(store, merged_df) if prefilter else {}
+    to_score = merged_df.drop(index=list(scores))
+    if per_lead:
+        scores.update(score_per_lead(runner, to_score, stable_prompt, journal))
+    elif leads_per_call:
+        scores.update(score_in_groups(runner, to_score, leads_per_call, journal))
+    else:
+        scores.update(score_by_company(runner, store, to_score, journal))
+    for index, result in scores.items():
         merged_df.at[index, 'ICP Scoring'] = result
-    merged_df.to_excel('rb2b_new_classify.xlsx', index=False)
-
-
+        store.append('scores', {'LinkedInUrl': merged_df.at[index, 'LinkedInUrl'],
+                                'website': merged_df.at[index, 'website'], 'score': result})
+    if export_excel:
+        store.export_excel(merged_df, 'rb2b_new_classify.xlsx')
+    store.close()
+    journal.close()
+    llm.close()
+    print(f"LLM usage: {llm.stats()}")
+    print(f"Response cache: {cache.stats()}")
+    cache.close()
+    print(f"Peak RSS {peak_rss_bytes() / 2 ** 20:.0f} MB")
 
 if __name__ == "__main__":
-    main()
+    profile = profiling.from_argv()
+    leads_per_call = next((int(arg.split('=', 1)[1]) for arg in sys.argv
+                           if arg.startswith('--leads-per-call=')), None)
+    try:
+        main(export_excel='--excel' in sys.argv, batch='--batch' in sys.argv,
+             stable_prompt='--legacy-prompt' not in sys.argv, per_lead='--per-lead' in sys.argv,
+             leads_per_call=leads_per_call, prefilter='--no-prefilter' not in sys.argv,
+             resume='--no-resume' not in sys.argv)
+    finally:
+        if profile:
+            profiling.write_report('profile_icp')
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import threading
+
+from llmcache import cache_key
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+logger = logging.getLogger('journal')
+
+# Records written between two fsyncs, and the most seconds a record waits
+# for one (a background thread syncs what is pending that often). Every
+# record is flushed to the OS as soon as it is written, so only a machine
+# crash can lose the records since the last fsync.
+SYNC_EVERY = 50
+SYNC_SECONDS = 2.0
+
+
+def _key(value):
+    """ A unit key read back from JSON: lists are tuples again
+    """
+    if isinstance(value, list):
+        return tuple(_key(item) for item in value)
+    return value
+
+
+class Journal:
+    """ Append-only JSONL record of the completed units of icp.main: site
+    chunk extractions, synthesis calls and lead scores.
+
+    Each line holds the stage, the unit key, the cache_key of the request
+    that produced it and its parsed value. completed() only returns a
+    unit whose request is unchanged, so a unit is redone when its site
+    content, prompt or model changes. A later line for the same unit
+    replaces the earlier one.
+
+    When the journal is opened it is rewritten with one line per unit,
+    so replaced lines and a torn last line (a crash in the middle of a
+    write) don't pile up from run to run. resume=False starts an empty
+    journal.
+    """
+
+    def __init__(self, path=f'{dir_path}/icp_journal.jsonl', resume=True,
+                 sync_every=SYNC_EVERY, sync_seconds=SYNC_SECONDS):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+        self.units = {}
+        if resume and os.path.exists(path):
+            self._load()
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.stopped = threading.Event()
+        self.syncer = threading.Thread(target=self._sync_pending, name='journal-sync', daemon=True)
+        self.syncer.start()
+
+    def _load(self):
+        good, lines = 0, 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self.units[(record['stage'], _key(record['key']))] = (record['request'], record['value'])
+                good += len(line)
+                lines += 1
+        if good < os.path.getsize(self.path):
+            logger.warning('Dropping a torn record at byte %d of %s', good, self.path)
+        if good < os.path.getsize(self.path) or lines > len(self.units):
+            self._compact()
+        print(f"Journal: {len(self.units)} completed units in {self.path}")
+
+    def _compact(self):
+        """ Rewrite the journal with the current line of each unit. The new
+        file replaces the old one only once it is on disk.
+        """
+        with open(f'{self.path}.tmp', 'w', encoding='utf-8') as out:
+            for (stage, key), (request, value) in self.units.items():
+                out.write(json.dumps({'stage': stage, 'key': key, 'request': request, 'value': value},
+                                     ensure_ascii=False, default=str) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def completed(self, stage, requests):
+        """ {key: value} of the {key: chat completion kwargs} already done
+        with the same request
+        """
+        done = {}
+        for key, kwargs in requests.items():
+            unit = self.units.get((stage, key))
+            if unit is not None and unit[0] == cache_key(kwargs):
+                done[key] = unit[1]
+        return done
+
+    def record(self, stage, key, kwargs, value):
+        """ Append a completed unit. value must be JSON serializable.
+        """
+        request = cache_key(kwargs)
+        line = json.dumps({'stage': stage, 'key': key, 'request': request, 'value': value},
+                          ensure_ascii=False, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+            self.units[(stage, key)] = (request, value)
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def _sync_pending(self):
+        while not self.stopped.wait(self.sync_seconds):
+            with self.lock:
+                if self.unsynced:
+                    self._sync()
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            self._sync()
+
+    def close(self):
+        self.stopped.set()
+        self.syncer.join()
+        self.sync()
+        self.file.close()
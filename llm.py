@@ -0,0 +1,227 @@
+import logging
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import openai
+
+import profiling
+
+logger = logging.getLogger('llm')
+
+# Account limits for the model, per minute. Override with the
+# LLMExecutor arguments (icp.main reads OPENAI_RPM and OPENAI_TPM).
+RPM = 500
+TPM = 30000
+
+# Completion tokens reserved for a call that doesn't set max_tokens. The
+# reservation is corrected with the real usage when the response arrives.
+COMPLETION_TOKENS = 1000
+
+# Calls in flight at once
+WORKERS = 8
+
+
+def estimate_tokens(messages):
+    """ Rough prompt size of chat messages: 4 characters per token plus a few
+    tokens of framing per message
+    """
+    chars = sum(len(str(message.get('content') or '')) for message in messages)
+    return math.ceil(chars / 4) + 4 * len(messages) + 3
+
+
+class RateLimiter:
+    """ Requests and tokens per minute as two token buckets that refill
+    continuously. acquire blocks until a call fits in both.
+    """
+
+    def __init__(self, rpm=RPM, tpm=TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens):
+        """ Take one request and tokens from the budget. A call larger than
+        the whole minute's tokens waits for a full bucket and takes it.
+        Return the tokens taken, the amount to settle.
+        """
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.requests >= 1 and self.tokens >= tokens:
+                        self.requests -= 1
+                        self.tokens -= tokens
+                        return tokens
+                    wait = max((1 - self.requests) * 60 / self.rpm,
+                               (tokens - self.tokens) * 60 / self.tpm)
+            time.sleep(max(wait, 0.01))
+
+    def settle(self, reserved, used):
+        """ Give back (or take) the difference between the tokens reserved
+        for a call and the tokens it used
+        """
+        with self.lock:
+            self.tokens = min(self.tpm, self.tokens + reserved - used)
+
+    def pause(self, seconds):
+        """ Hold every call for seconds, e.g. after a 429
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def _retry_after(error, attempt, backoff_factor):
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return backoff_factor * 2 ** attempt * (1 + random.random())
+
+
+class LLMExecutor:
+    """ Chat completions shared by the icp stages.
+
+    create() sends one call once it fits in the requests and tokens per
+    minute budget, and retries rate limit, timeout and server errors. On a
+    429 every caller holds for the retry-after delay, not just the one that
+    got it. submit() runs a function (e.g. icp.format_data) in a bounded
+    thread pool, so the stages can queue work on the same executor.
+
+    The OpenAI client should be created with max_retries=0 so that retries
+    go through the limiter.
+
+    cache: llmcache.ResponseCache. Calls found in it return the stored
+    response without touching the budget.
+    """
+
+    def __init__(self, client, rpm=RPM, tpm=TPM, workers=WORKERS, retries=5,
+                 backoff_factor=1.0, cache=None):
+        self.client = client
+        self.cache = cache
+        self.limiter = RateLimiter(rpm, tpm)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='llm')
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.tokens = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.rate_limited = 0
+
+    def create(self, **kwargs):
+        """ client.chat.completions.create(**kwargs) within the budget
+        """
+        if self.cache is not None:
+            cached = self.cache.get(kwargs)
+            if cached is not None:
+                return cached
+        reserved = estimate_tokens(kwargs['messages']) + kwargs.get('max_tokens', COMPLETION_TOKENS)
+        for attempt in range(self.retries + 1):
+            taken = self.limiter.acquire(reserved)
+            try:
+                response = self.client.chat.completions.create(**kwargs)
+            except openai.RateLimitError as e:
+                self.limiter.settle(taken, 0)
+                if attempt == self.retries:
+                    raise
+                delay = _retry_after(e, attempt, self.backoff_factor)
+                logger.warning('Rate limited, holding calls for %.1f s', delay)
+                with self.lock:
+                    self.rate_limited += 1
+                self.limiter.pause(delay)
+                continue
+            except (openai.APITimeoutError, openai.APIConnectionError,
+                    openai.InternalServerError) as e:
+                self.limiter.settle(taken, 0)
+                if attempt == self.retries:
+                    raise
+                delay = _retry_after(e, attempt, self.backoff_factor)
+                logger.warning('%s on attempt %d, retrying in %.1f s', type(e).__name__, attempt + 1, delay)
+                time.sleep(delay)
+                continue
+            used = response.usage.total_tokens if response.usage else taken
+            self.limiter.settle(taken, used)
+            details = getattr(response.usage, 'prompt_tokens_details', None)
+            with self.lock:
+                self.calls += 1
+                self.tokens += used
+                if response.usage:
+                    self.prompt_tokens += response.usage.prompt_tokens
+                    self.cached_tokens += (details.cached_tokens or 0) if details else 0
+            if self.cache is not None:
+                self.cache.put(kwargs, response)
+            return response
+
+    def submit(self, fn, *args, **kwargs):
+        return self.pool.submit(fn, *args, **kwargs)
+
+    def _create_in_span(self, stage, kwargs):
+        with profiling.span(stage):
+            return self.create(**kwargs)
+
+    def complete_all(self, stage, requests, on_result=None):
+        """ {key: chat completion kwargs} -> {key: response}, sent
+        concurrently. Same interface as batch.BatchRunner.complete_all.
+
+        on_result(key, response) is called in the calling thread as each
+        response arrives, e.g. to journal it.
+
+        A request the API rejects (a 4xx other than 429, e.g. a prompt
+        over the context length) is logged and left out of the results,
+        like a failed request of a batch, so the rest of the stage goes on.
+        When a call fails otherwise (retries ran out) or on_result fails,
+        the other calls still finish and the first error is raised after
+        them.
+        """
+        futures = {self.submit(self._create_in_span, stage, kwargs): key
+                   for key, kwargs in requests.items()}
+        results, error = {}, None
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                response = future.result()
+            except openai.APIStatusError as e:
+                if isinstance(e, (openai.RateLimitError, openai.InternalServerError)):
+                    error = error or e
+                else:
+                    logger.error('%s request %s failed: %s', stage, key, e)
+                continue
+            except Exception as e:
+                error = error or e
+                continue
+            results[key] = response
+            try:
+                if on_result is not None:
+                    on_result(key, response)
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return {key: results[key] for key in requests if key in results}
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'tokens': self.tokens,
+                    'rate_limited': self.rate_limited,
+                    'prompt_tokens': self.prompt_tokens,
+                    'cached_tokens': self.cached_tokens}
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from openai.types.chat import ChatCompletion
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+logger = logging.getLogger('llmcache')
+
+# Arguments that don't change the answer and are left out of the key
+IGNORED_PARAMS = {'timeout', 'extra_headers', 'user', 'metadata', 'store'}
+
+
+def cache_key(kwargs):
+    """ Hash of the model, messages and every other parameter of a chat
+    completion call
+    """
+    params = {key: value for key, value in kwargs.items() if key not in IGNORED_PARAMS}
+    return hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False,
+                                     default=str).encode()).hexdigest()
+
+
+class ResponseCache:
+    """ Chat completion responses stored in SQLite by cache_key of the
+    call, with their token usage.
+
+    When the stored responses exceed max_bytes, the least recently used
+    are evicted down to 90% of it. Hits, misses and the tokens they saved
+    are counted for this process in stats(), and per entry in the table.
+    Safe to share between threads and processes.
+
+    A response the caller can't use (not JSON, refused, failing its
+    schema) should be dropped with invalidate(), or every rerun would get
+    it back.
+    """
+
+    def __init__(self, path=f'{dir_path}/llm_cache.db', max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            model TEXT,
+            response TEXT NOT NULL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            total_tokens INTEGER,
+            size INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at REAL,
+            used_at REAL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used_at)')
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        # Running total of the stored sizes, so a put doesn't scan the table.
+        # Other processes' writes are only seen when it is recounted in _evict.
+        self.size = self._total()
+
+    def _total(self):
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, kwargs):
+        """ Cached response of a call, or None. The response has
+        cache_hit = True.
+        """
+        key = cache_key(kwargs)
+        with self.lock:
+            row = self.conn.execute('SELECT response, total_tokens FROM responses WHERE key = ?',
+                                    (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute('UPDATE responses SET hits = hits + 1, used_at = ? WHERE key = ?',
+                              (time.time(), key))
+            self.hits += 1
+            self.saved_tokens += row[1] or 0
+        response = ChatCompletion.model_validate_json(row[0])
+        response.cache_hit = True
+        return response
+
+    def put(self, kwargs, response):
+        data = response.model_dump_json()
+        usage = response.usage
+        now = time.time()
+        key = cache_key(kwargs)
+        with self.lock:
+            old = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses (key, model, response, prompt_tokens, '
+                'completion_tokens, total_tokens, size, created_at, used_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, kwargs.get('model'), data,
+                 usage.prompt_tokens if usage else None,
+                 usage.completion_tokens if usage else None,
+                 usage.total_tokens if usage else None,
+                 len(data), now, now))
+            self.size += len(data) - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def invalidate(self, kwargs):
+        """ Drop the cached response of a call, if any
+        """
+        key = cache_key(kwargs)
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.size -= row[0]
+        return row is not None
+
+    def _evict(self):
+        total = self.size = self._total()
+        if total <= self.max_bytes:
+            return
+        target = total - int(0.9 * self.max_bytes)
+        freed, evicted = 0, []
+        for key, size in self.conn.execute('SELECT key, size FROM responses ORDER BY used_at'):
+            evicted.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        self.conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
+        self.size -= freed
+        logger.info('Evicted %d cached responses (%.1f MB)', len(evicted), freed / 2 ** 20)
+
+    def stats(self):
+        """ Hits, misses and saved tokens of this process, and the size of
+        the cache
+        """
+        with self.lock:
+            entries, size, hits = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) '
+                'FROM responses').fetchone()
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'saved_tokens': self.saved_tokens, 'entries': entries,
+                    'bytes': size, 'total_hits': hits}
+
+    def close(self):
+        self.conn.close()
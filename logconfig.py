@@ -0,0 +1,122 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import sys
+from datetime import datetime
+
+# Per-module levels applied by setup_logging. Chatty third-party loggers are
+# kept out of the hot path.
+DEFAULT_LEVELS = {
+    'urllib3': logging.WARNING,
+    'filelock': logging.WARNING,
+    'openai': logging.WARNING,
+    'httpx': logging.WARNING,
+}
+
+# Attributes every LogRecord has. Anything else was passed with extra=
+# and goes into the JSON event.
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'taskName'}
+
+_listener = None
+_worker_config = None
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line: time, level, logger, message and any
+    fields passed with extra=
+    """
+
+    def format(self, record):
+        event = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                event[key] = value
+        if record.exc_info:
+            event['exc'] = self.formatException(record.exc_info)
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+def setup_logging(name='script', log_dir='logs', level=logging.INFO,
+                  levels=None, stdout=True):
+    """ Log through a QueueHandler so callers only pay for putting the record
+    on a queue. A QueueListener thread formats and writes JSON events to
+    log_dir/<name>_<time>.log and, if stdout, plain lines to stdout.
+
+    The queue is a multiprocessing.Queue: process pools created with
+    pool_kwargs() send their workers' records to the same listener.
+
+    levels: dict of logger name to level, on top of DEFAULT_LEVELS,
+            e.g. {'crawl': logging.DEBUG}
+    Return the log file path.
+    """
+    global _listener, _worker_config
+    if _listener is not None:
+        return _listener.log_filepath
+
+    os.makedirs(log_dir, exist_ok=True)
+    log_filepath = os.path.join(
+        log_dir, datetime.now().strftime(f'{name}_%Y%m%d_%H%M%S.log'))
+
+    file_handler = logging.FileHandler(log_filepath)
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if stdout:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+        handlers.append(stream_handler)
+
+    log_queue = multiprocessing.Queue()
+    levels = {**DEFAULT_LEVELS, **(levels or {})}
+    init_worker(log_queue, level, levels)
+    _worker_config = (log_queue, level, levels)
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True)
+    _listener.log_filepath = log_filepath
+    _listener.start()
+    atexit.register(stop_logging)
+    return log_filepath
+
+
+def init_worker(log_queue, level=logging.INFO, levels=None):
+    """ Send this process's records to log_queue. Used by setup_logging
+    and as the initializer of worker processes.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    for logger_name, logger_level in (levels or {}).items():
+        logging.getLogger(logger_name).setLevel(logger_level)
+
+
+def pool_kwargs():
+    """ initializer and initargs for a ProcessPoolExecutor whose workers
+    should log through the listener of setup_logging. Empty when logging
+    isn't set up.
+    """
+    if _worker_config is None:
+        return {}
+    return {'initializer': init_worker, 'initargs': _worker_config}
+
+
+def stop_logging():
+    """ Flush queued records and stop the listener thread
+    """
+    global _listener, _worker_config
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        _worker_config = None
@@ -0,0 +1,224 @@
+import logging
+import multiprocessing
+import os
+import resource
+import signal
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+logger = logging.getLogger('memory')
+
+_page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# Largest size seen for each kind of structure, see record_size
+_sizes = {}
+_sizes_lock = threading.Lock()
+
+
+def rss_bytes(pid=None):
+    """ Current resident set size of a process (this one by default), from
+    /proc or, on systems without it (macOS), from ps. None when it can't
+    be measured.
+    """
+    try:
+        with open(f'/proc/{pid or "self"}/statm', 'r') as f:
+            return int(f.read().split()[1]) * _page_size
+    except (OSError, IndexError, ValueError):
+        pass
+    try:
+        output = subprocess.run(['ps', '-o', 'rss=', '-p', str(pid or os.getpid())],
+                                capture_output=True, text=True, timeout=5).stdout
+        # kilobytes
+        return int(output.split()[0]) * 1024
+    except (OSError, subprocess.SubprocessError, IndexError, ValueError):
+        return None
+
+
+def peak_rss_bytes(children=False):
+    """ Peak RSS of this process, or of its largest finished child
+    """
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def total_rss_bytes():
+    """ RSS of this process plus its live child processes (process pools),
+    or None when it can't be measured
+    """
+    own = rss_bytes()
+    if own is None:
+        return None
+    # A child that exited since it was listed counts as 0
+    return own + sum(rss_bytes(child.pid) or 0
+                     for child in multiprocessing.active_children())
+
+
+def sizeof(obj):
+    """ Approximate memory held by the structures the pipeline keeps big:
+    Bloom filters, DataFrames, bytes/str buffers. Falls back to
+    sys.getsizeof for anything else.
+    """
+    if hasattr(obj, 'num_bits') and hasattr(obj, 'bitarray'):
+        return obj.num_bits // 8
+    if hasattr(obj, 'memory_usage') and hasattr(obj, 'columns'):
+        return int(obj.memory_usage(deep=True).sum())
+    return sys.getsizeof(obj)
+
+
+def record_size(name, obj=None, size=None):
+    """ Keep the largest size seen for a kind of structure, e.g.
+    record_size('bloom_filter', bf). Return the size.
+    """
+    size = sizeof(obj) if size is None else size
+    with _sizes_lock:
+        count, largest = _sizes.get(name, (0, 0))
+        _sizes[name] = (count + 1, max(largest, size))
+    return size
+
+
+def sizes():
+    with _sizes_lock:
+        return {name: {'count': count, 'max_bytes': largest}
+                for name, (count, largest) in _sizes.items()}
+
+
+def log_size(name, obj):
+    size = record_size(name, obj)
+    logger.info('%s uses %.1f MB', name, size / 2 ** 20,
+                extra={'structure': name, 'bytes': size})
+    return size
+
+
+def tracemalloc_snapshot(path=None, limit=25, frames=10):
+    """ Write the top allocation sites to a file. Starts tracemalloc on
+    the first call, so the first snapshot only covers what came after it.
+    Return the file path.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    path = path or os.path.join(
+        'logs', datetime.now().strftime('tracemalloc_%Y%m%d_%H%M%S.txt'))
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    snapshot = tracemalloc.take_snapshot()
+    with open(path, 'w') as out:
+        out.write(f'RSS {(rss_bytes() or 0) / 2 ** 20:.1f} MB, '
+                  f'total with children {(total_rss_bytes() or 0) / 2 ** 20:.1f} MB, '
+                  f'peak {peak_rss_bytes() / 2 ** 20:.1f} MB\n')
+        for name, info in sorted(sizes().items()):
+            out.write(f'{name}: {info}\n')
+        for stat in snapshot.statistics('traceback')[:limit]:
+            out.write(f'\n{stat}\n')
+            out.write('\n'.join(stat.traceback.format()) + '\n')
+    logger.info('tracemalloc snapshot written to %s', path)
+    return path
+
+
+def install_snapshot_signal(signum=getattr(signal, 'SIGUSR1', None)):
+    """ Take a tracemalloc snapshot whenever the process gets signum,
+    e.g. kill -USR1 <pid>. The first signal starts tracing.
+    """
+    if signum is None:
+        return
+    signal.signal(signum, lambda *args: tracemalloc_snapshot())
+
+
+class MemoryMonitor(threading.Thread):
+    """ Samples the RSS of this process and its children every interval.
+
+    track(key) starts following the peak for a key (a site, a stage) and
+    untrack(key) returns the peak seen while it was tracked. Only the
+    process as a whole is measured, so that peak includes everything else
+    running at the same time.
+
+    With a budget in bytes, wait_for_room blocks callers while the
+    process-wide RSS is above high_water * budget, so new work is throttled
+    before the OOM killer steps in. Throttling needs the current RSS: where
+    it can't be measured, it is turned off with a warning rather than
+    based on the peak, which never goes down.
+    """
+
+    def __init__(self, interval=0.5, budget=None, high_water=0.85):
+        super().__init__(name='memory-monitor', daemon=True)
+        self.interval = interval
+        current = total_rss_bytes()
+        if current is None and budget is not None:
+            logger.warning('The current RSS of this process can\'t be measured here, '
+                           'memory throttling is off')
+            budget = None
+        self.budget = budget
+        self.high_water = high_water
+        self.current = current if current is not None else peak_rss_bytes()
+        self.peak = self.current
+        self.peaks = {}
+        self.lock = threading.Lock()
+        self.room = threading.Condition(self.lock)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        current = total_rss_bytes()
+        if current is None:
+            # Only reported, throttling is off
+            current = peak_rss_bytes()
+        with self.lock:
+            self.current = current
+            self.peak = max(self.peak, current)
+            for key in self.peaks:
+                self.peaks[key] = max(self.peaks[key], current)
+            if not self.over_budget():
+                self.room.notify_all()
+        return current
+
+    def over_budget(self):
+        return self.budget is not None and self.current > self.high_water * self.budget
+
+    def track(self, key):
+        with self.lock:
+            self.peaks[key] = self.current
+
+    def untrack(self, key):
+        with self.lock:
+            return self.peaks.pop(key, self.current)
+
+    def wait_for_room(self, name='', timeout=None):
+        """ Block while memory is over the high-water mark. Return False if
+        timeout ran out first.
+        """
+        with self.lock:
+            if not self.over_budget():
+                return True
+            logger.warning('Memory %.0f MB over %.0f%% of the %.0f MB budget, holding %s',
+                           self.current / 2 ** 20, 100 * self.high_water,
+                           self.budget / 2 ** 20, name)
+            start = time.monotonic()
+            ok = self.room.wait_for(lambda: not self.over_budget(), timeout)
+            logger.info('Released %s after %.1f s', name, time.monotonic() - start)
+            return ok
+
+    def stop(self):
+        self.stopped.set()
+
+    def summary(self):
+        return {'current_bytes': self.current, 'peak_bytes': self.peak,
+                'peak_rss_self': peak_rss_bytes(),
+                'peak_rss_children': peak_rss_bytes(children=True),
+                'sizes': sizes()}
+
+
+def parse_size(text):
+    """ '4G', '512M', '1000000' -> bytes
+    """
+    text = str(text).strip().upper()
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
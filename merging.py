@@ -0,0 +1,87 @@
+import json
+import re
+
+from chunking import count_tokens
+
+# Extraction fields holding lists of items. Their items are merged and
+# deduplicated locally before any synthesis call.
+LIST_FIELDS = ['Products', 'Customers', 'Testimonials']
+
+# Extractions merged by one synthesis call
+FAN_IN = 4
+
+# Most tokens of extractions sent to one synthesis call
+SYNTH_TOKENS = 20000
+
+EMPTY = {'', 'null', 'none', 'n/a', 'na', 'not mentioned', 'not available'}
+
+
+def _normalize(value):
+    """ Comparison key of an extracted item: case, spacing and trailing
+    punctuation don't make two items different
+    """
+    if isinstance(value, dict):
+        return json.dumps({key: _normalize(item) for key, item in value.items()}, sort_keys=True)
+    if isinstance(value, list):
+        return json.dumps([_normalize(item) for item in value])
+    return re.sub(r'\s+', ' ', str(value)).strip().strip('.;,').casefold()
+
+
+def _is_empty(value):
+    if value is None:
+        return True
+    if isinstance(value, (list, dict)):
+        return not value
+    return str(value).strip().casefold() in EMPTY
+
+
+def _unique(items):
+    seen, result = set(), []
+    for item in items:
+        if _is_empty(item):
+            continue
+        key = _normalize(item)
+        if key not in seen:
+            seen.add(key)
+            result.append(item)
+    return result
+
+
+def premerge_extractions(extractions):
+    """ Merge extraction dicts without the LLM. Items of the LIST_FIELDS
+    are concatenated and deduplicated; other fields keep their one value,
+    or the list of their distinct values when the extractions disagree.
+    Empty values are dropped. The result only depends on the order of
+    the extractions.
+    """
+    values = {}
+    for extraction in extractions:
+        for field, value in extraction.items():
+            items = value if isinstance(value, list) else [value]
+            values.setdefault(field, []).extend(items)
+    merged = {}
+    for field, items in values.items():
+        items = _unique(items)
+        if field in LIST_FIELDS or len(items) > 1:
+            merged[field] = items
+        else:
+            merged[field] = items[0] if items else None
+    return merged
+
+
+def group_extractions(extractions, fan_in=FAN_IN, max_tokens=SYNTH_TOKENS):
+    """ Split extractions into consecutive groups of up to fan_in whose
+    merge stays under max_tokens. An extraction bigger than max_tokens
+    is a group on its own.
+    """
+    groups, current = [], []
+    for extraction in extractions:
+        candidate = current + [extraction]
+        if current and (len(candidate) > fan_in or
+                        count_tokens(json.dumps(premerge_extractions(candidate))) > max_tokens):
+            groups.append(current)
+            candidate = [extraction]
+        current = candidate
+    if current:
+        groups.append(current)
+    return groups
@@ -0,0 +1,149 @@
+import re
+import time
+import zlib
+
+import numpy as np
+from unidecode import unidecode
+
+from scoring import is_junior_title, normalize_title, title_fit_rule
+
+# Hashed feature space of the word and word pair counts
+DIM = 2 ** 18
+
+# Leads whose best ICP similarity is below THRESHOLD are Low Fit without
+# asking the LLM. On the scored leads of merged_df.xlsx, the 21 High and
+# Moderate Fits whose context has text in the extraction fields are all
+# above it (the lowest at 0.015), and 23 of the 65 Low Fits are below. The
+# other 6 High and Moderate Fits have no such text and go to the LLM
+# unscreened. Recalibrated from earlier LLM scores once there are
+# MIN_LABELS of them, so that at most MAX_MISS of the leads the LLM found
+# a High or Moderate Fit would have been filtered out.
+THRESHOLD = 0.012
+MIN_LABELS = 50
+MAX_MISS = 0.02
+
+# A lead whose title is one of the ICP decision-makers only needs this
+# share of the threshold
+ROLE_MATCH_DISCOUNT = 0.5
+
+STOPWORDS = {'the', 'and', 'for', 'with', 'that', 'this', 'are', 'our', 'you', 'your', 'their',
+             'from', 'they', 'its', 'into', 'can', 'has', 'have', 'all', 'not', 'but', 'was',
+             'who', 'which', 'what', 'how', 'more', 'also', 'such', 'other', 'than', 'them',
+             'null', 'none'}
+
+
+def flatten(value):
+    """ The text of a context or ICP: its string values, recursively
+    """
+    if isinstance(value, dict):
+        return ' '.join(flatten(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return ' '.join(flatten(item) for item in value)
+    if value is None or value != value:
+        return ''
+    return str(value)
+
+
+def tokenize(text):
+    words = re.findall(r'[a-z0-9]+', unidecode(text).lower())
+    return [word for word in words if len(word) > 2 and word not in STOPWORDS]
+
+
+def features(text):
+    """ Hashed word and word pair indexes of text and their log-scaled
+    counts
+    """
+    tokens = tokenize(text)
+    grams = tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+    indexes = np.fromiter((zlib.crc32(gram.encode()) % DIM for gram in grams),
+                          dtype=np.int64, count=len(grams))
+    indexes, counts = np.unique(indexes, return_counts=True)
+    return indexes, 1 + np.log(counts)
+
+
+def similarities(documents, icp_documents):
+    """ Cosine similarity of the TF-IDF vectors of each document to each
+    ICP document, as a (documents, ICPs) array. IDF is fitted on both sets.
+    The documents stay sparse: their rows are concatenated index and value
+    arrays, and the products with the dense ICP matrix are summed per row
+    with np.bincount.
+    """
+    docs = [features(text) for text in documents]
+    icp_docs = [features(text) for text in icp_documents]
+    if not icp_docs:
+        return np.zeros((len(docs), 0))
+    df = np.bincount(np.concatenate([indexes for indexes, _ in docs + icp_docs] + [np.zeros(0, np.int64)]),
+                     minlength=DIM)
+    idf = np.log((1 + len(docs) + len(icp_docs)) / (1 + df)) + 1
+
+    def weights(indexes, tf):
+        values = tf * idf[indexes]
+        norm = np.sqrt(np.dot(values, values))
+        return values / norm if norm else values
+
+    icp_matrix = np.zeros((len(icp_docs), DIM))
+    for k, (indexes, tf) in enumerate(icp_docs):
+        icp_matrix[k, indexes] = weights(indexes, tf)
+    rows = np.repeat(np.arange(len(docs)), [len(indexes) for indexes, _ in docs])
+    indexes = np.concatenate([indexes for indexes, _ in docs] + [np.zeros(0, np.int64)])
+    values = np.concatenate([weights(*doc) for doc in docs] + [np.zeros(0)])
+    return np.stack([np.bincount(rows, weights=values * icp_matrix[k, indexes], minlength=len(docs))
+                     for k in range(len(icp_docs))], axis=1)
+
+
+def calibrate(scores, positive, max_miss=MAX_MISS, min_labels=MIN_LABELS):
+    """ Threshold below which at most max_miss of the positive leads fall,
+    or None with fewer than min_labels labelled leads. scores: best ICP
+    similarity per labelled lead, positive: whether the LLM found it a
+    High or Moderate Fit.
+    """
+    scores, positive = np.asarray(scores), np.asarray(positive, dtype=bool)
+    if len(scores) < min_labels or not positive.any():
+        return None
+    return float(np.quantile(scores[positive], max_miss))
+
+
+def screen(contexts, titles, icps, labels=None, threshold=THRESHOLD, fields=None):
+    """ Local ICP fit of leads. contexts: per lead, the context dict of its
+    website; titles: per lead, its job title; labels: {lead position: True
+    when the LLM found it a High or Moderate Fit} from earlier runs, to
+    calibrate the threshold; fields: the keys a context is expected to
+    have (e.g. icp.EXTRACTION_FIELDS).
+
+    Return {lead position: reason} for the leads that are Low Fit: a
+    junior title, or a best ICP similarity below the threshold. Leads
+    whose context has no information, or none of the fields (a synthesis
+    answer that put its text in the keys), are left to the LLM, which
+    still has their LinkedIn data. Leads sharing a context are vectorized
+    once.
+    """
+    start = time.perf_counter()
+    texts = [flatten(context) if fields is None or (isinstance(context, dict) and set(context) & set(fields))
+             else '' for context in contexts]
+    unique = {text: i for i, text in enumerate(dict.fromkeys(texts))}
+    sims = similarities(list(unique), [flatten(icp) for icp in icps]).max(axis=1, initial=0.0)
+    empty = [not tokenize(text) for text in unique]
+    best = sims[[unique[text] for text in texts]]
+    labels = {i: positive for i, positive in (labels or {}).items() if not empty[unique[texts[i]]]}
+    if labels:
+        calibrated = calibrate(best[list(labels)], list(labels.values()))
+        if calibrated is not None:
+            # Only leads above the threshold get LLM scores, so a higher
+            # calibrated threshold would keep rising from run to run
+            threshold = min(threshold, calibrated)
+            print(f"Pre-filter threshold calibrated on {len(labels)} scored leads: {threshold:.3f}")
+    roles = sorted({normalize_title(role) for icp in icps for role in icp['Decision-Makers']})
+    rejected = {}
+    for i, (text, title) in enumerate(zip(texts, titles)):
+        title = normalize_title(title)
+        if is_junior_title(title):
+            rejected[i] = f'"{title}" is not a decision-making role.'
+        elif not empty[unique[text]]:
+            fit = title_fit_rule(title, roles)
+            needed = threshold * (ROLE_MATCH_DISCOUNT if fit and fit['Match'] == 'Exact Match' else 1)
+            if best[i] < needed:
+                rejected[i] = f'Similarity to the ICPs {best[i]:.3f} is below {needed:.3f}.'
+    elapsed = time.perf_counter() - start
+    print(f"Pre-filter: {len(rejected)} of {len(texts)} leads Low Fit, "
+          f"{len(unique)} contexts, {len(texts) / max(elapsed, 1e-9):.0f} leads/s")
+    return rejected
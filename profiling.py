@@ -0,0 +1,258 @@
+import cProfile
+import contextlib
+import functools
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+# Off unless enable() is called, e.g. by an entry point run with --profile.
+# When off, span() returns a shared no-op context manager and timed
+# functions make one global lookup before calling through.
+_enabled = False
+_cprofile = False
+_lock = threading.Lock()
+_spans = {}
+_profiles = defaultdict(list)
+_local = threading.local()
+# Innermost open span of each thread, for the sampler
+_thread_spans = {}
+_sampler = None
+_null = contextlib.nullcontext()
+
+
+def enabled():
+    return _enabled
+
+
+def enable(cprofile=False, sampling=False, interval=0.005):
+    """ Start recording spans.
+    cprofile: also run cProfile inside the outermost span of each thread,
+              one profile per span name. On Python 3.12+ only one runs at
+              a time; spans starting while it runs are timed only.
+    sampling: sample every thread's stack each interval seconds for a
+              collapsed-stack flame graph file.
+    """
+    global _enabled, _cprofile, _sampler
+    _enabled = True
+    _cprofile = cprofile
+    if sampling and _sampler is None:
+        _sampler = StackSampler(interval)
+        _sampler.start()
+
+
+def disable():
+    global _enabled, _sampler
+    _enabled = False
+    if _sampler is not None:
+        _sampler.stop()
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _profiles.clear()
+
+
+def _record(name, elapsed):
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            _spans[name] = [1, elapsed, elapsed, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed < stats[2]:
+                stats[2] = elapsed
+            if elapsed > stats[3]:
+                stats[3] = elapsed
+
+
+@contextlib.contextmanager
+def _span(name):
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    profile = None
+    if _cprofile and not stack:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active profiler per process, so
+            # while another thread's span is profiled this one is only timed
+            profile = None
+    stack.append(name)
+    thread_id = threading.get_ident()
+    _thread_spans[thread_id] = name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start)
+        stack.pop()
+        _thread_spans[thread_id] = stack[-1] if stack else None
+        if profile is not None:
+            profile.disable()
+            with _lock:
+                _profiles[name].append(profile)
+
+
+def span(name):
+    """ Context manager timing a stage under name
+    """
+    if not _enabled:
+        return _null
+    return _span(name)
+
+
+def timed(name=None):
+    """ Decorator timing every call of a function as a span
+    """
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    with _lock:
+        return {name: list(stats) for name, stats in _spans.items()}
+
+
+def merge(spans):
+    """ Add span statistics recorded elsewhere, e.g. in a worker process
+    """
+    with _lock:
+        for name, (count, total, low, high) in spans.items():
+            stats = _spans.get(name)
+            if stats is None:
+                _spans[name] = [count, total, low, high]
+            else:
+                stats[0] += count
+                stats[1] += total
+                stats[2] = min(stats[2], low)
+                stats[3] = max(stats[3], high)
+
+
+def _child_call(fn, args):
+    reset()
+    enable()
+    try:
+        return fn(*args), snapshot()
+    finally:
+        disable()
+
+
+def call_in_pool(pool, fn, *args):
+    """ Run fn in a process pool and wait for it. When profiling, spans
+    recorded in the worker process are merged back into this process.
+    """
+    if not _enabled:
+        return pool.submit(fn, *args).result()
+    result, spans = pool.submit(_child_call, fn, args).result()
+    merge(spans)
+    return result
+
+
+class StackSampler(threading.Thread):
+    """ Samples the stack of every thread and counts collapsed stacks
+    ('thread;span;module:function;...') for flame graphs
+    """
+
+    def __init__(self, interval=0.005):
+        super().__init__(name='profiling-sampler', daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+                    frames.append(f'{module}:{code.co_name}')
+                    frame = frame.f_back
+                thread_name = names.get(thread_id, str(thread_id)).split('-')[0]
+                span_name = _thread_spans.get(thread_id) or '-'
+                self.stacks[';'.join([thread_name, span_name] + frames[::-1])] += 1
+
+    def stop(self):
+        self.stopped.set()
+
+
+def report():
+    """ Span statistics sorted by total time
+    """
+    rows = []
+    for name, (count, total, low, high) in snapshot().items():
+        rows.append({'span': name, 'count': count, 'total_s': total,
+                     'mean_ms': 1000 * total / count, 'min_ms': 1000 * low,
+                     'max_ms': 1000 * high})
+    return sorted(rows, key=lambda row: row['total_s'], reverse=True)
+
+
+def write_report(prefix='profile', out_dir='logs'):
+    """ Write <prefix>_summary.json and .txt, a cProfile .pstats file per
+    span name when cprofile was on, and <prefix>.collapsed when sampling
+    was on. Return the summary rows.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, prefix)
+    rows = report()
+    with open(f'{path}_summary.json', 'w') as out:
+        json.dump(rows, out, indent=4)
+    lines = [f'{"span":<24}{"count":>8}{"total s":>12}{"mean ms":>12}{"max ms":>12}']
+    for row in rows:
+        lines.append(f'{row["span"]:<24}{row["count"]:>8}{row["total_s"]:>12.3f}'
+                     f'{row["mean_ms"]:>12.2f}{row["max_ms"]:>12.2f}')
+    summary = '\n'.join(lines)
+    with open(f'{path}_summary.txt', 'w') as out:
+        out.write(summary + '\n')
+        with _lock:
+            profiles = {name: list(items) for name, items in _profiles.items()}
+        for name, items in profiles.items():
+            stats = pstats.Stats(items[0])
+            for profile in items[1:]:
+                stats.add(profile)
+            stats.dump_stats(f'{path}_{name}.pstats')
+            top = io.StringIO()
+            pstats.Stats(f'{path}_{name}.pstats', stream=top).sort_stats('cumulative').print_stats(15)
+            out.write(f'\n### {name}\n{top.getvalue()}')
+    if _sampler is not None:
+        with open(f'{path}.collapsed', 'w') as out:
+            for stack, count in _sampler.stacks.most_common():
+                out.write(f'{stack} {count}\n')
+    print(summary)
+    return rows
+
+
+def from_argv(argv=None):
+    """ Turn profiling on if argv has --profile. --profile-cprofile and
+    --profile-sampling add the optional profilers. Return whether it is on.
+    """
+    argv = sys.argv if argv is None else argv
+    if not any(arg.startswith('--profile') for arg in argv):
+        return False
+    enable(cprofile='--profile-cprofile' in argv,
+           sampling='--profile-sampling' in argv)
+    return True
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import re
+
+from unidecode import unidecode
+
+# Abbreviations expanded in titles and ICP decision-makers before they are
+# compared
+TITLE_ALIASES = {
+    'ceo': 'chief executive officer',
+    'cto': 'chief technology officer',
+    'cmo': 'chief marketing officer',
+    'coo': 'chief operations officer',
+    'cfo': 'chief financial officer',
+    'cpo': 'chief product officer',
+    'cro': 'chief revenue officer',
+    'vp': 'vice president',
+    'svp': 'senior vice president',
+    'evp': 'executive vice president',
+    'avp': 'assistant vice president',
+    'pm': 'product manager',
+    'mgr': 'manager',
+    'dir': 'director',
+    'sr': 'senior',
+    'operating': 'operations',
+}
+
+# Words of titles that don't hold a decision: these leads are a
+# "Different Role" without asking the LLM
+JUNIOR_WORDS = {'intern', 'internship', 'student', 'trainee', 'apprentice', 'volunteer',
+                'junior', 'retired', 'freelance', 'freelancer'}
+
+# 'assistant' is junior too ('Marketing Assistant', 'Assistant to the CEO'),
+# unless it comes before one of these ranks ('Assistant Vice President',
+# 'Assistant Director')
+ASSISTANT_RANKS = {'vice', 'director', 'manager', 'head', 'general', 'chief', 'dean',
+                   'professor', 'secretary', 'treasurer', 'controller', 'superintendent'}
+
+# Decision-maker score of each alignment, and the overall score needed for
+# each categorization
+ROLE_SCORES = {'Exact Match': 5, 'Similar Role': 3, 'Different Role': 1}
+CATEGORIES = [(4.0, 'High Fit'), (3.0, 'Moderate Fit'), (0.0, 'Low Fit')]
+
+COMPANY_CRITERIA = ['Industry/Segment', 'Pain Points', 'Size/Type']
+
+# Criterion scores of a lead record of a multi-lead scoring call
+LEAD_RECORD_SCORES = {'Industry/Segment': 'industry_segment', 'Pain Points': 'pain_points',
+                      'Size/Type': 'size_type', 'Decision-Makers': 'decision_makers'}
+
+
+def company_profile(lead_context, company_name, company_industry):
+    """ What the company-level fit of a lead depends on: the synthesized
+    context of its website, or its LinkedIn company fields when there is
+    no context
+    """
+    if lead_context:
+        return lead_context
+    return {'Company Name': company_name, 'Company Industry': company_industry}
+
+
+def context_hash(profile):
+    return hashlib.sha1(json.dumps(profile, sort_keys=True, ensure_ascii=False,
+                                   default=str).encode()).hexdigest()
+
+
+def fit_key(instructions, profile):
+    """ Memo key of the company fit of a profile: its context_hash
+    combined with the instructions (ICPs and seller context) it was scored
+    against, so changed ICPs are scored again
+    """
+    return context_hash([context_hash(instructions), profile])
+
+
+def _singular(word):
+    return word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+
+
+def normalize_title(title):
+    """ Lower case ASCII words of a title with abbreviations expanded and
+    plurals dropped, so 'Sr. VP, Marketing' and 'senior vice president
+    marketing' are the same title
+    """
+    if title is None or title != title:
+        return ''
+    words = re.sub(r'[^a-z0-9]+', ' ', unidecode(str(title)).lower()).split()
+    words = ' '.join(TITLE_ALIASES.get(_singular(word), word) for word in words).split()
+    return ' '.join(_singular(word) for word in words)
+
+
+def is_junior_title(title):
+    """ Whether a normalized title is one of the roles that don't hold a
+    decision, see JUNIOR_WORDS
+    """
+    words = title.split()
+    if set(words) & JUNIOR_WORDS:
+        return True
+    return any(word == 'assistant' and (i + 1 == len(words) or words[i + 1] not in ASSISTANT_RANKS)
+               for i, word in enumerate(words))
+
+
+def decision_makers(icps, matching=None):
+    """ Normalized decision-makers of the ICPs named in matching (by
+    Industry/Segment), or of every ICP when none of them matched
+    """
+    matched = [icp for icp in icps if icp['Industry/Segment'] in (matching or [])] or icps
+    return sorted({normalize_title(role) for icp in matched for role in icp['Decision-Makers']})
+
+
+def title_fit_rule(title, roles):
+    """ Decision-maker fit of a normalized title against normalized roles
+    from the local rules, or None when the LLM has to judge it
+    """
+    if not title:
+        return {'Match': 'Different Role', 'Score': ROLE_SCORES['Different Role'],
+                'Rationale': 'No job title.'}
+    if is_junior_title(title):
+        return {'Match': 'Different Role', 'Score': ROLE_SCORES['Different Role'],
+                'Rationale': f'"{title}" is not a decision-making role.'}
+    for role in roles:
+        if re.search(rf'\b{re.escape(role)}\b', title):
+            return {'Match': 'Exact Match', 'Score': ROLE_SCORES['Exact Match'],
+                    'Rationale': f'"{title}" is one of the ICP decision-makers ({role}).'}
+    return None
+
+
+def _score(value):
+    try:
+        return min(5.0, max(1.0, float(value)))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def validate_fit(fit, criteria=None):
+    """ Return a company fit if it has a Score under each of criteria, or
+    a title fit (criteria None) if it has a Score of its own. Raise
+    ValueError otherwise.
+    """
+    if not isinstance(fit, dict):
+        raise ValueError(f'Fit is not an object: {fit!r:.100}')
+    for name, part in ([('fit', fit)] if criteria is None else [(c, fit.get(c)) for c in criteria]):
+        score = part.get('Score') if isinstance(part, dict) else None
+        try:
+            float(score)
+        except (TypeError, ValueError):
+            raise ValueError(f'{name} has no score: {part!r:.100}')
+    return fit
+
+
+def overall_fit(company_fit, title_fit):
+    """ Mean of the three company scores and the decision-maker score, and
+    its categorization
+    """
+    scores = [_score((company_fit.get(criterion) or {}).get('Score')) for criterion in COMPANY_CRITERIA]
+    scores.append(_score(title_fit.get('Score')))
+    overall = sum(scores) / len(scores)
+    category = next(name for threshold, name in CATEGORIES if overall >= threshold)
+    return overall, category
+
+
+def format_scoring(company_fit, title_fit):
+    """ The ICP Scoring text of a lead, in the sections of the per-lead
+    scoring prompt's output
+    """
+    overall, category = overall_fit(company_fit, title_fit)
+    lines = [f"**Matching ICP(s):** {', '.join(company_fit.get('Matching ICPs') or []) or 'None'}",
+             "**Fit Scores:**"]
+    for criterion, fit in [(criterion, company_fit.get(criterion) or {}) for criterion in COMPANY_CRITERIA] + \
+            [('Decision-Makers', title_fit)]:
+        match = f"{fit['Match']}, " if fit.get('Match') else ''
+        lines.append(f"- {criterion}: {match}{_score(fit.get('Score')):.0f}/5. {fit.get('Rationale', '')}".rstrip())
+    lines.append(f"- Overall: {overall:.1f}/5")
+    lines.append(f"**Categorization:** {category}")
+    return '\n'.join(lines)
+
+
+def format_lead_record(record):
+    """ The ICP Scoring text of a lead scored in a multi-lead call, from its
+    validated record
+    """
+    lines = [f"**Matching ICP(s):** {', '.join(record['matching_icps']) or 'None'}",
+             "**Fit Scores:**"]
+    for criterion, field in LEAD_RECORD_SCORES.items():
+        lines.append(f"- {criterion}: {record[field]}/5")
+    lines.append(f"- Overall: {record['overall']:.1f}/5")
+    lines.append(f"**Categorization:** {record['category']}")
+    lines.append(f"**Rationale:** {record['rationale']}")
+    return '\n'.join(lines)
+
+
+def validate_lead_records(data, ids):
+    """ {lead id: record} of a multi-lead scoring answer. Raise ValueError
+    unless it has exactly one well-formed record per id.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('leads'), list):
+        raise ValueError('Answer has no leads array')
+    records = {}
+    for record in data['leads']:
+        if not isinstance(record, dict) or record.get('id') not in ids:
+            raise ValueError(f'Unexpected record {record!r:.100}')
+        if record['id'] in records:
+            raise ValueError(f'Two records for {record["id"]}')
+        for field in LEAD_RECORD_SCORES.values():
+            if not isinstance(record.get(field), int) or not 1 <= record[field] <= 5:
+                raise ValueError(f'{record["id"]}: {field} is {record.get(field)!r}, not 1-5')
+        if not isinstance(record.get('overall'), (int, float)) or not 1 <= record['overall'] <= 5:
+            raise ValueError(f'{record["id"]}: overall is {record.get("overall")!r}')
+        if record.get('category') not in [name for _, name in CATEGORIES]:
+            raise ValueError(f'{record["id"]}: category is {record.get("category")!r}')
+        if not isinstance(record.get('matching_icps'), list):
+            raise ValueError(f'{record["id"]}: matching_icps is not a list')
+        record.setdefault('rationale', '')
+        records[record['id']] = record
+    missing = set(ids) - set(records)
+    if missing:
+        raise ValueError(f'No record for {", ".join(sorted(missing))}')
+    return records
+
+
+def parse_category(text):
+    """ High Fit, Moderate Fit or Low Fit from an ICP Scoring text, or None
+    """
+    match = re.search(r'Categori[sz]ation:?\**:?\s*\**\s*"?(High|Moderate|Low) Fit', str(text), re.IGNORECASE)
+    return f'{match.group(1).capitalize()} Fit' if match else None
@@ -0,0 +1,171 @@
+import json
+import os
+import sqlite3
+
+import pandas as pd
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+# Intermediate state of the pipeline. Text columns have no size limit,
+# unlike Excel cells which are truncated at 32,767 characters.
+TABLES = {
+    'pages': {
+        'columns': ['website', 'idx', 'url', 'content'],
+        'key': ['website', 'idx'],
+    },
+    'site_contents': {
+        'columns': ['website', 'content', 'len', 'fingerprint'],
+        'key': ['website'],
+    },
+    'leads': {
+        # SQLite column names are case-insensitive, so the raw Website
+        # url of the leads export is stored as WebsiteUrl
+        'columns': ['LinkedInUrl', 'Title', 'WebsiteUrl', 'CompanyName',
+                    'Industry', 'website'],
+        'key': ['LinkedInUrl', 'website'],
+    },
+    'extractions': {
+        'columns': ['website', 'chunk', 'data'],
+        'key': ['website', 'chunk'],
+    },
+    'contexts': {
+        'columns': ['website', 'context'],
+        'key': ['website'],
+    },
+    'scores': {
+        'columns': ['LinkedInUrl', 'website', 'score'],
+        'key': ['LinkedInUrl', 'website'],
+    },
+    # Memoized scoring parts of icp.score_by_company, as JSON. context_hash
+    # is scoring.fit_key: the company profile and the fit instructions.
+    'company_fits': {
+        'columns': ['context_hash', 'fit'],
+        'key': ['context_hash'],
+    },
+    'title_fits': {
+        'columns': ['context_hash', 'title', 'fit'],
+        'key': ['context_hash', 'title'],
+    },
+}
+
+
+class Store:
+    """ SQLite store for pages, site contents, leads, extractions, contexts
+    and scores.
+
+    Writes are appends (a row with an existing key replaces that row only),
+    so a stage never rewrites a whole file. Reads can project the columns
+    they need, so the scoring stage doesn't load every site's content.
+    """
+
+    def __init__(self, path=f'{dir_path}/pipeline.db'):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for table, schema in TABLES.items():
+            columns = ', '.join(f'"{column}"' for column in schema['columns'])
+            key = ', '.join(f'"{column}"' for column in schema['key'])
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                              f'({columns}, PRIMARY KEY ({key}))')
+            # Add columns introduced after the table was created
+            existing = set(row[1] for row in
+                           self.conn.execute(f'PRAGMA table_info({table})'))
+            for column in schema['columns']:
+                if column not in existing:
+                    self.conn.execute(f'ALTER TABLE {table} '
+                                      f'ADD COLUMN "{column}"')
+        self.conn.commit()
+
+    def append(self, table, records):
+        """ records: a dict, a list of dicts or a DataFrame.
+        Missing columns are stored as NULL, unknown ones are ignored.
+        """
+        if isinstance(records, dict):
+            records = [records]
+        elif isinstance(records, pd.DataFrame):
+            records = records.to_dict('records')
+        columns = TABLES[table]['columns']
+        rows = [tuple(_to_sql(record.get(column)) for column in columns)
+                for record in records]
+        if not rows:
+            return 0
+        names = ', '.join(f'"{column}"' for column in columns)
+        marks = ', '.join('?' for _ in columns)
+        with self.conn:
+            self.conn.executemany(f'INSERT OR REPLACE INTO {table} '
+                                  f'({names}) VALUES ({marks})', rows)
+        return len(rows)
+
+    def clear(self, table):
+        """ Delete every row of the table. Return the number of rows deleted.
+        """
+        with self.conn:
+            return self.conn.execute(f'DELETE FROM {table}').rowcount
+
+    def delete(self, table, column, values):
+        """ Delete the rows whose column is one of values. Return the
+        number of rows deleted.
+        """
+        values = list(values)
+        with self.conn:
+            return sum(self.conn.execute(f'DELETE FROM {table} WHERE "{column}" = ?', (value,)).rowcount
+                       for value in values)
+
+    def read(self, table, columns=None, where=None, params=()):
+        """ Return the table as a DataFrame with only the requested columns
+        """
+        columns = columns or TABLES[table]['columns']
+        names = ', '.join(f'"{column}"' for column in columns)
+        query = f'SELECT {names} FROM {table}'
+        if where:
+            query += f' WHERE {where}'
+        return pd.read_sql_query(query + ' ORDER BY rowid', self.conn,
+                                 params=params)
+
+    def keys(self, table, column):
+        """ Set of values stored in one column of the table
+        """
+        cursor = self.conn.execute(f'SELECT DISTINCT "{column}" FROM {table}')
+        return set(row[0] for row in cursor)
+
+    def read_lead_contents(self, lead_columns=None, with_content=True):
+        """ Leads joined with the content of their crawled website
+        """
+        lead_columns = lead_columns or TABLES['leads']['columns']
+        names = ', '.join(f'l."{column}"' for column in lead_columns)
+        if with_content:
+            names += ', s.content, s.len'
+        query = (f'SELECT {names} FROM leads l '
+                 f'JOIN site_contents s ON l.website = s.website '
+                 f'ORDER BY l.rowid')
+        return pd.read_sql_query(query, self.conn)
+
+    def export_excel(self, df, path):
+        """ Optional final export. Long text is truncated to Excel's limit.
+        """
+        df = df.copy()
+        for column in df.columns:
+            if df[column].dtype == object:
+                df[column] = df[column].map(
+                    lambda x: x[:32767] if isinstance(x, str) else x)
+        df.to_excel(path, index=False)
+        print(f'Exported {len(df)} rows to {path}')
+
+    def close(self):
+        self.conn.close()
+
+
+def _to_sql(value):
+    if value is None:
+        return None
+    try:
+        if pd.isna(value):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+from openai import OpenAI
+
+import batch_stub
+from batch import BatchRunner
+from llmcache import ResponseCache
+
+
+def responder(body):
+    """ Echo the user message, fail the requests asking for it
+    """
+    text = body['messages'][-1]['content']
+    if 'fail' in text:
+        raise ValueError('asked to fail')
+    return f'answer to {text}'
+
+
+def requests_for(*texts):
+    return {(text,): {'model': 'stub', 'messages': [{'role': 'user', 'content': text}]}
+            for text in texts}
+
+
+@pytest.fixture
+def stub():
+    def start(expire_after=None):
+        url, server = batch_stub.serve(responder=responder, delay=0, expire_after=expire_after)
+        servers.append(server)
+        return OpenAI(api_key='stub', base_url=url, max_retries=0), server.stub
+
+    servers = []
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def answers(results):
+    return {key: response.choices[0].message.content for key, response in results.items()}
+
+
+def test_complete_all(stub, tmp_path):
+    client, server = stub()
+    runner = BatchRunner(client, out_dir=str(tmp_path), poll_interval=0.05)
+    seen = {}
+    requests = requests_for('b', 'fail', 'a')
+    results = runner.complete_all('stage', requests,
+                                  on_result=lambda key, response: seen.setdefault(key, response))
+    assert answers(results) == {('b',): 'answer to b', ('a',): 'answer to a'}
+    # In the order of the requests, failed ones left out
+    assert list(results) == [('b',), ('a',)]
+    assert seen.keys() == results.keys()
+    assert len(server.batches) == 1
+
+
+def test_rerun_uses_saved_results(stub, tmp_path):
+    client, server = stub()
+    requests = requests_for('a', 'b')
+    BatchRunner(client, out_dir=str(tmp_path), poll_interval=0.05).complete_all('stage', requests)
+    results = BatchRunner(client, out_dir=str(tmp_path), poll_interval=0.05).complete_all('stage', requests)
+    assert answers(results) == {('a',): 'answer to a', ('b',): 'answer to b'}
+    assert len(server.batches) == 1
+    state = json.loads((tmp_path / 'stage_0_state.json').read_text())
+    assert state['status'] == 'completed'
+
+
+def test_parts(stub, tmp_path):
+    client, server = stub()
+    runner = BatchRunner(client, out_dir=str(tmp_path), poll_interval=0.05, max_requests=2)
+    results = runner.complete_all('stage', requests_for('a', 'b', 'c'))
+    assert list(answers(results).values()) == ['answer to a', 'answer to b', 'answer to c']
+    assert len(server.batches) == 2
+
+
+def test_expired_batch_keeps_finished_requests(stub, tmp_path):
+    client, server = stub(expire_after=2)
+    cache = ResponseCache(path=str(tmp_path / 'cache.db'))
+    runner = BatchRunner(client, out_dir=str(tmp_path), poll_interval=0.05, cache=cache)
+    requests = requests_for('a', 'b', 'c')
+    results = runner.complete_all('stage', requests)
+    assert answers(results) == {('a',): 'answer to a', ('b',): 'answer to b'}
+
+    # The rerun only sends what the expired batch didn't answer
+    server.expire_after = None
+    results = runner.complete_all('stage', requests)
+    assert answers(results) == {('a',): 'answer to a', ('b',): 'answer to b',
+                                ('c',): 'answer to c'}
+    assert len(server.batches) == 2
+    last = list(server.batches.values())[-1]
+    assert last['request_counts']['total'] == 1
+    cache.close()
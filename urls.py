@@ -1,28 +1,74 @@
+import contextlib
+import zlib
+
 import requests
 import xml.etree.ElementTree as ET
 
-def fetch_sitemap_urls(url):
+from crawl import read_body
+from profiling import timed
+
+# Largest sitemap read when there is no site budget: the sitemap
+# protocol's limit on an uncompressed sitemap file
+SITEMAP_MAX_BYTES = 50 * 1024 * 1024
+
+def gunzip(data, max_bytes):
+    """ Decompress gzip data, stopping at max_bytes of output.
+    Return (content, complete): complete is False for a cut or truncated
+    stream.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    content = decompressor.decompress(data, max_bytes)
+    return content, decompressor.eof
+
+def fetch_sitemap_urls(url, timeout=30, budget=None):
+    """ budget: SiteBudget of the site. The request timeout is cut to its
+    deadline, and the sitemap is read in chunks and decompressed up to
+    the bytes left in it, which are charged to it. Without a budget at
+    most SITEMAP_MAX_BYTES are read. Return None for a sitemap that
+    doesn't fit.
+    """
+    if budget is not None:
+        if budget.exhausted():
+            print(f"Site budget used up, skipping sitemap {url}")
+            return None
+        timeout = budget.timeout(timeout)
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
     }
+    max_bytes = budget.remaining_bytes() if budget is not None else None
+    if max_bytes is None:
+        max_bytes = SITEMAP_MAX_BYTES
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status() 
-        return response.content
-    except requests.RequestException as e:
+        with budget.running() if budget is not None else contextlib.nullcontext():
+            with requests.get(url, headers=headers, timeout=timeout, stream=True) as response:
+                response.raise_for_status()
+                # Content-Encoding is undone chunk by chunk as it is read
+                response.raw.decode_content = True
+                content, complete = read_body(response.raw, max_bytes, budget)
+        # .xml.gz sitemaps come compressed without a Content-Encoding
+        if complete and content[:2] == b'\x1f\x8b':
+            content, complete = gunzip(content, max_bytes)
+        if budget is not None:
+            budget.charge(len(content))
+            budget.exhausted()
+        if not complete:
+            print(f"Sitemap {url} is incomplete or over {max_bytes} bytes, skipping it")
+            return None
+        return content
+    except (requests.RequestException, zlib.error) as e:
         print(f"Error fetching sitemap: {e}")
         return None
 
-def extract_urls_from_sitemap(sitemap_url):
-    sitemap_content = fetch_sitemap_urls(sitemap_url)
+def extract_urls_from_sitemap(sitemap_url, budget=None):
+    sitemap_content = fetch_sitemap_urls(sitemap_url, budget=budget)
     if sitemap_content:
-        urls = parse_sitemap(sitemap_content)
+        urls = parse_sitemap(sitemap_content, budget)
         return urls
     else:
         print("Failed to retrieve or parse sitemap.")
         return 
 
-def parse_sitemap(content):
+def parse_sitemap(content, budget=None):
     urls = []
     root = ET.fromstring(content)
     for elem in root:
@@ -31,9 +77,9 @@ def parse_sitemap(content):
             for sitemap in elem:
                 if sitemap.tag.endswith('loc'):
                     sub_sitemap_url = sitemap.text
-                    sub_sitemap_content = fetch_sitemap_urls(sub_sitemap_url)
+                    sub_sitemap_content = fetch_sitemap_urls(sub_sitemap_url, budget=budget)
                     if sub_sitemap_content:
-                        urls.extend(parse_sitemap(sub_sitemap_content))
+                        urls.extend(parse_sitemap(sub_sitemap_content, budget))
         elif elem.tag.endswith('url'):
             # It's a regular sitemap
             for url in elem:
@@ -42,8 +88,9 @@ def parse_sitemap(content):
     return urls
     
 
-def traverse_sitemap(sitemap_url):
-    urls = extract_urls_from_sitemap(sitemap_url)
+@timed('sitemap')
+def traverse_sitemap(sitemap_url, budget=None):
+    urls = extract_urls_from_sitemap(sitemap_url, budget)
     urls=[url.strip() for url in urls]
     urls=sorted(urls, key=lambda url: (len(url.split('/')), url))
     print(len(urls))
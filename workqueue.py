@@ -0,0 +1,213 @@
+import argparse
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+logger = logging.getLogger('workqueue')
+
+# pending -> leased -> done / partial / empty / failed
+# A leased site whose lease expires (its worker died) is pending again.
+STATUSES = ['pending', 'leased', 'done', 'partial', 'empty', 'failed']
+
+
+class WorkQueue:
+    """ Durable queue of sites to crawl, shared through a SQLite file.
+
+    Workers lease sites for lease_seconds and extend the lease with
+    heartbeat while they work. A site whose lease expires goes back to the
+    queue, so a crashed worker only loses the sites it was holding. A site
+    is retried until it has been leased max_attempts times.
+    Any number of processes can use the same file concurrently.
+    """
+
+    def __init__(self, path=f'{dir_path}/workqueue.db', lease_seconds=600,
+                 max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS sites (
+            url TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            lease_expires REAL,
+            heartbeat_at REAL,
+            error TEXT,
+            updated_at REAL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS sites_status '
+                          'ON sites (status, lease_expires)')
+
+    def _write(self, query, params=(), many=False):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                if many:
+                    cursor = self.conn.executemany(query, params)
+                else:
+                    cursor = self.conn.execute(query, params)
+                self.conn.execute('COMMIT')
+                return cursor.rowcount
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def add(self, urls):
+        """ Queue urls that aren't in the queue yet. Return how many were new.
+        """
+        now = time.time()
+        rows = [(url.strip(), now) for url in urls if url.strip()]
+        return self._write('INSERT OR IGNORE INTO sites (url, updated_at) '
+                           'VALUES (?, ?)', rows, many=True)
+
+    def lease(self, owner, n=1):
+        """ Lease up to n sites for owner. Return their urls.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Expired leases whose attempts are used up won't come back
+                self.conn.execute(
+                    "UPDATE sites SET status = 'failed', owner = NULL, "
+                    "error = 'lease expired', updated_at = ? "
+                    "WHERE status = 'leased' AND lease_expires < ? "
+                    "AND attempts >= ?", (now, now, self.max_attempts))
+                urls = [row[0] for row in self.conn.execute(
+                    "SELECT url FROM sites WHERE status = 'pending' "
+                    "OR (status = 'leased' AND lease_expires < ?) "
+                    "ORDER BY attempts, rowid LIMIT ?", (now, n))]
+                self.conn.executemany(
+                    "UPDATE sites SET status = 'leased', owner = ?, "
+                    "attempts = attempts + 1, lease_expires = ?, "
+                    "heartbeat_at = ?, updated_at = ? WHERE url = ?",
+                    [(owner, now + self.lease_seconds, now, now, url)
+                     for url in urls])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return urls
+
+    def heartbeat(self, owner, urls):
+        """ Extend the leases owner still holds on urls
+        """
+        now = time.time()
+        return self._write(
+            "UPDATE sites SET lease_expires = ?, heartbeat_at = ? "
+            "WHERE url = ? AND owner = ? AND status = 'leased'",
+            [(now + self.lease_seconds, now, url, owner) for url in urls],
+            many=True)
+
+    def complete(self, owner, url, status='done'):
+        return self._write(
+            "UPDATE sites SET status = ?, owner = NULL, error = NULL, "
+            "updated_at = ? WHERE url = ? AND owner = ?",
+            (status, time.time(), url, owner))
+
+    def fail(self, owner, url, error=''):
+        """ Put the site back in the queue, or mark it failed if it has used
+        all its attempts
+        """
+        return self._write(
+            "UPDATE sites SET status = CASE WHEN attempts >= ? "
+            "THEN 'failed' ELSE 'pending' END, owner = NULL, error = ?, "
+            "updated_at = ? WHERE url = ? AND owner = ?",
+            (self.max_attempts, str(error), time.time(), url, owner))
+
+    def stats(self):
+        """ Number of sites per status
+        """
+        with self.lock:
+            counts = dict(self.conn.execute(
+                'SELECT status, COUNT(*) FROM sites GROUP BY status'))
+        return {status: counts.get(status, 0) for status in STATUSES}
+
+    def close(self):
+        self.conn.close()
+
+
+def run_worker(path=f'{dir_path}/workqueue.db', owner=None, batch=16,
+               concurrency=None, lease_seconds=600, max_attempts=3):
+    """ Crawl sites from the queue until it is empty.
+    Sites are leased batch at a time and fed to a download.CrawlPipeline.
+    A heartbeat thread keeps the leases of in-flight sites alive.
+    """
+    from download import CrawlPipeline
+
+    owner = owner or f'{socket.gethostname()}-{os.getpid()}'
+    work_queue = WorkQueue(path, lease_seconds, max_attempts)
+    in_flight = set()
+    in_flight_lock = threading.Lock()
+    stop = threading.Event()
+
+    def on_done(website_url, status):
+        with in_flight_lock:
+            in_flight.discard(website_url)
+        work_queue.complete(owner, website_url, status)
+
+    def heartbeat():
+        while not stop.wait(lease_seconds / 3):
+            with in_flight_lock:
+                urls = list(in_flight)
+            if urls:
+                work_queue.heartbeat(owner, urls)
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    pipeline = CrawlPipeline(concurrency, on_done=on_done)
+    try:
+        while True:
+            urls = work_queue.lease(owner, batch)
+            if not urls:
+                break
+            with in_flight_lock:
+                in_flight.update(urls)
+            for url in urls:
+                pipeline.submit(url)
+            pipeline.drain()
+            # Sites that never reported back raised inside a stage
+            with in_flight_lock:
+                failed = list(in_flight)
+                in_flight.clear()
+            for url in failed:
+                work_queue.fail(owner, url, 'not completed')
+            logger.info('Worker %s: %s', owner, work_queue.stats())
+    finally:
+        stop.set()
+        pipeline.close()
+        work_queue.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shared queue of sites to crawl')
+    parser.add_argument('command', choices=['add', 'work', 'stats'])
+    parser.add_argument('file', nargs='?', default='leads.txt',
+                        help='file of website urls for add')
+    parser.add_argument('--db', default=f'{dir_path}/workqueue.db')
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--owner', default=None)
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        with open(args.file, 'r') as f:
+            print(f'{WorkQueue(args.db).add(f)} sites added')
+    elif args.command == 'work':
+        from logconfig import setup_logging
+        setup_logging('worker')
+        for folder in ['websites', 'to_scrape', 'scraped']:
+            os.makedirs(folder, exist_ok=True)
+        run_worker(args.db, args.owner, args.batch)
+    print(WorkQueue(args.db).stats())
+
+
+if __name__ == "__main__":
+    main()